@@ -0,0 +1,69 @@
+'''
+measures the import time of the scanner and checks that it does not load the heavy scientific stack
+
+Every cron tick starts scanner.py, so anything imported at module level is paid for every 10 minutes even when there
+are no new objects. bilby, nmma, matplotlib, seaborn, astropy, pandas and GitPython should only be imported by the
+functions that use them.
+
+Usage:
+    python benchmarks/import_time.py [--module scanner] [--repeat 5] [--top 15]
+
+Exits with status 1 if any of the heavy modules is imported.
+'''
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['bilby', 'nmma', 'matplotlib', 'seaborn', 'astropy', 'pandas', 'scipy', 'git']
+
+
+def measure_import(module):
+    '''
+    imports a module in a fresh interpreter with -X importtime
+
+    Args:
+        module (str): name of module to import
+
+    Returns:
+        total (float): wall time of the import in seconds
+        timings (list): list of (cumulative time in seconds, module name) from -X importtime
+        loaded (list): top-level names of all modules loaded by the import
+    '''
+    code = ('import sys, time, json; t0 = time.perf_counter(); import {}; t1 = time.perf_counter(); '
+            'print(json.dumps([t1 - t0, sorted({{name.split(".")[0] for name in sys.modules}})]))').format(module)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=REPO_DIRECTORY, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError('importing {} failed:\n{}'.format(module, result.stderr.strip().splitlines()[-1]))
+    total, loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        timings.append((int(cumulative) / 1e6, name.strip()))
+    return total, timings, loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='measure the import time of a module of the pipeline')
+    parser.add_argument('--module', default='scanner', help='module to import (default: scanner)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh interpreters to time (default: 5)')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to list (default: 15)')
+    args = parser.parse_args()
+
+    totals = []
+    for _ in range(args.repeat):
+        total, timings, loaded = measure_import(args.module)
+        totals.append(total)
+    print('import {}: best {:.3f} s, median {:.3f} s over {} runs'.format(args.module, min(totals), sorted(totals)[len(totals) // 2], len(totals)))
+    for cumulative, name in sorted(timings, reverse=True)[:args.top]:
+        print('  {:8.3f} s  {}'.format(cumulative, name))
+
+    heavy = [name for name in HEAVY_MODULES if name in loaded]
+    if len(heavy) > 0:
+        print('heavy modules imported by {}: {}'.format(args.module, ', '.join(heavy)))
+        sys.exit(1)
+    print('no heavy modules imported')
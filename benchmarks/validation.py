@@ -0,0 +1,54 @@
+'''
+measures the throughput of the pre-fit lightcurve validation on synthetic .dat files
+
+Usage:
+    python benchmarks/validation.py [--num-files 500] [--num-points 100]
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.files import get_settings
+from utils.conversion import write_dat, mjd_to_isot
+from utils.validation import validate_lightcurve
+
+
+def write_synthetic_lightcurves(directory, num_files, num_points, seed=42):
+    '''
+    writes lightcurves with random times over a week in g, r and i, a tenth of them upper limits
+
+    Returns:
+        lc_paths (list): paths to the written files
+    '''
+    rng = np.random.default_rng(seed)
+    lc_paths = []
+    for i in range(num_files):
+        mjd = 60000 + np.sort(rng.uniform(0, 7, num_points))
+        mag = rng.uniform(18, 21, num_points)
+        mag_unc = np.where(rng.uniform(size=num_points) < 0.1, np.inf, 0.1)
+        lc_path = os.path.join(directory, 'ZTF{:06d}.dat'.format(i))
+        write_dat(lc_path, mjd_to_isot(mjd), rng.choice(['g', 'r', 'i'], num_points), mag, mag_unc)
+        lc_paths.append(lc_path)
+    return lc_paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='measure the throughput of lightcurve validation')
+    parser.add_argument('--settings', default='./settings.json', help='path to settings file, for the models and thresholds (default: ./settings.json)')
+    parser.add_argument('--num-files', type=int, default=500, help='number of lightcurves (default: 500)')
+    parser.add_argument('--num-points', type=int, default=100, help='number of points per lightcurve (default: 100)')
+    args = parser.parse_args()
+
+    models_dicts, settings_dict = get_settings(args.settings)
+    with tempfile.TemporaryDirectory() as directory:
+        lc_paths = write_synthetic_lightcurves(directory, args.num_files, args.num_points)
+        start = time.perf_counter()
+        reports = [validate_lightcurve(lc_path, models=models_dicts, settings=settings_dict) for lc_path in lc_paths]
+        elapsed = time.perf_counter() - start
+    print('validated {} files of {} points in {:.2f} s ({:.0f} files/s), {} valid'.format(
+        len(reports), args.num_points, elapsed, len(reports) / elapsed, sum(report['valid'] for report in reports)))
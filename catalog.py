@@ -0,0 +1,66 @@
+'''
+queries the catalog of completed fits, e.g. which objects prefer the kilonova model over the supernova model:
+
+    python catalog.py compare Kilonova Supernova --min-delta 5
+
+models can be given by name or alias from settings.json, and provisional triage fits are left out with --full-only
+'''
+import argparse
+
+from utils.files import get_settings
+from utils.catalog import get_model_name, query_fits, compare_models, rank_models, catalog_fits
+from utils.tracking import load_fit_states, DONE
+
+
+def print_rows(rows, columns=None):
+    import pandas as pd
+
+    if len(rows) == 0:
+        print('No matching fits')
+        return
+    df = pd.DataFrame(rows)
+    print(df[columns].to_string(index=False) if columns is not None else df.to_string(index=False))
+
+def backfill(models_dicts, settings_dict):
+    '''
+    adds completed fits tracked before the catalog existed (or whose insertion failed) to the catalog
+
+    Returns:
+        num_added (int): number of fits added
+    '''
+    cataloged = {(row['object'], row['model']) for row in query_fits(settings_dict)}
+    records = [record for record in load_fit_states(settings_dict)['fits'].values()
+               if record['state'] == DONE and (record['object'], record['model']) not in cataloged]
+    return catalog_fits(settings_dict, records, models=models_dicts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='query the catalog of completed fits')
+    parser.add_argument('--settings', default='./settings.json', help='path to settings file (default: ./settings.json)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    show_parser = subparsers.add_parser('show', help='list fits in the catalog')
+    show_parser.add_argument('--object', default=None, help='only fits of this object')
+    show_parser.add_argument('--model', default=None, help='only fits of this model')
+    show_parser.add_argument('--min-log-evidence', type=float, default=None, help='only fits with at least this log evidence')
+    rank_parser = subparsers.add_parser('rank', help='rank the models of each object by evidence')
+    rank_parser.add_argument('--object', default=None, help='only rank the models of this object')
+    compare_parser = subparsers.add_parser('compare', help='objects preferring MODEL over OTHER by a log Bayes factor above --min-delta')
+    compare_parser.add_argument('model', help='preferred model')
+    compare_parser.add_argument('other', help='model compared against')
+    compare_parser.add_argument('--min-delta', type=float, default=0.0, help='minimum difference in log evidence (default: 0)')
+    for subparser in [show_parser, rank_parser, compare_parser]:
+        subparser.add_argument('--full-only', action='store_true', help='leave out provisional triage fits')
+    subparsers.add_parser('backfill', help='add completed fits missing from the catalog')
+    args = parser.parse_args()
+
+    models_dicts, settings_dict = get_settings(args.settings)
+    if args.command == 'show':
+        model = get_model_name(models_dicts, args.model) if args.model is not None else None
+        print_rows(query_fits(settings_dict, object=args.object, model=model, min_log_evidence=args.min_log_evidence, full_only=args.full_only),
+                   columns=['object', 'model', 'alias', 'stage', 'log_evidence', 'log_evidence_err', 'log_bayes_factor', 'log_likelihood', 'num_samples'])
+    elif args.command == 'rank':
+        print_rows(rank_models(settings_dict, models_dicts, object=args.object, full_only=args.full_only))
+    elif args.command == 'compare':
+        print_rows(compare_models(settings_dict, get_model_name(models_dicts, args.model), get_model_name(models_dicts, args.other), min_delta=args.min_delta, full_only=args.full_only))
+    elif args.command == 'backfill':
+        print('Added {} fits to the catalog'.format(backfill(models_dicts, settings_dict)))
@@ -0,0 +1,93 @@
+'''
+inspects and reorders the queue of fits waiting to be submitted (see utils/fit_queue.py), e.g. to fit an object ahead of
+everything else:
+
+    python fit_queue.py top ZTF23abcdefg
+
+models can be given by name or alias from settings.json
+'''
+import argparse
+
+from utils.files import get_settings, get_state_path, scan_lock
+from utils.catalog import get_model_name
+from utils.conversion import convert_to_dat
+from utils.triage import get_stage_model
+from utils.fit_queue import list_queue, enqueue_fits, update_queued_fits, requeue_fits, get_queue_settings, FitQueue, QUEUED, IN_FLIGHT, DONE
+
+
+def print_rows(rows):
+    import pandas as pd
+
+    if len(rows) == 0:
+        print('The queue is empty')
+        return
+    columns = ['object', 'model', 'user', 'state', 'priority', 'user_priority', 'last_detection', 'peak_mag', 'rise_rate']
+    print(pd.DataFrame(rows)[columns].to_string(index=False, float_format='{:.2f}'.format))
+
+def move_to_top(settings, object, model=None):
+    '''
+    raises the user priority of the queued fits of an object so they are ahead of every other queued fit
+
+    Returns:
+        num_updated (int): number of fits moved
+    '''
+    rows = list_queue(settings, states=[QUEUED])
+    own_rows = [row for row in rows if row['object'] == object and (model is None or row['model'] == model)]
+    if len(own_rows) == 0:
+        return 0
+    lead = max(row['priority'] for row in rows) - min(row['priority'] for row in own_rows) + 1
+    user_priority = max(row['user_priority'] for row in own_rows) + lead / get_queue_settings(settings)['weights']['user']
+    return update_queued_fits(settings, object, model=model, user_priority=user_priority)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='inspect and reorder the queue of fits waiting to be submitted')
+    parser.add_argument('--settings', default='./settings.json', help='path to settings file (default: ./settings.json)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list', help='list queued and in-flight fits, highest priority first')
+    list_parser.add_argument('--all', action='store_true', help='include finished fits')
+    add_parser = subparsers.add_parser('add', help='queue fits of a lightcurve')
+    add_parser.add_argument('path', help='path to lightcurve file')
+    add_parser.add_argument('--model', default=None, help='only fit this model (default: all models)')
+    add_parser.add_argument('--user', default=None, help='user or allocation the fits are charged to')
+    add_parser.add_argument('--priority', type=float, default=None, help='user priority (default: 0)')
+    priority_parser = subparsers.add_parser('priority', help='set the user priority of the fits of an object')
+    priority_parser.add_argument('object', help='name of object')
+    priority_parser.add_argument('value', type=float, help='user priority')
+    priority_parser.add_argument('--model', default=None, help='only the fit of this model')
+    user_parser = subparsers.add_parser('user', help='set the user of the fits of an object')
+    user_parser.add_argument('object', help='name of object')
+    user_parser.add_argument('value', help='user or allocation')
+    user_parser.add_argument('--model', default=None, help='only the fit of this model')
+    for command, help in [('top', 'move the queued fits of an object ahead of all others'), ('requeue', 'cancel the in-flight fits of an object and queue them again')]:
+        command_parser = subparsers.add_parser(command, help=help)
+        command_parser.add_argument('object', help='name of object')
+        command_parser.add_argument('--model', default=None, help='only the fit of this model')
+    subparsers.add_parser('dispatch', help='submit the queued fits that fit within the caps (with the local backend, waits for them to finish)')
+    args = parser.parse_args()
+
+    models_dicts, settings_dict = get_settings(args.settings)
+    model = get_model_name(models_dicts, args.model) if getattr(args, 'model', None) is not None else None
+    if args.command == 'list':
+        print_rows(list_queue(settings_dict, states=[QUEUED, IN_FLIGHT, DONE] if args.all else [QUEUED, IN_FLIGHT]))
+    elif args.command == 'add':
+        with scan_lock(settings_dict):
+            data = convert_to_dat(args.path, get_state_path(settings_dict, 'converted'))
+            for name in [model] if model is not None else models_dicts.keys():
+                enqueue_fits(settings_dict, [data], get_stage_model(models_dicts[name], settings_dict), user=args.user, user_priority=args.priority)
+        print('Queued {} fits of {}'.format(1 if model is not None else len(models_dicts), data))
+    elif args.command == 'priority':
+        print('Updated {} fits'.format(update_queued_fits(settings_dict, args.object, model=model, user_priority=args.value)))
+    elif args.command == 'user':
+        print('Updated {} fits'.format(update_queued_fits(settings_dict, args.object, model=model, user=args.value)))
+    elif args.command == 'top':
+        print('Moved {} fits to the top of the queue'.format(move_to_top(settings_dict, args.object, model=model)))
+    elif args.command == 'requeue':
+        with scan_lock(settings_dict):
+            print('Requeued {} fits'.format(requeue_fits(settings_dict, args.object, model=model)))
+    elif args.command == 'dispatch':
+        fit_queue = FitQueue(settings_dict)
+        with scan_lock(settings_dict):
+            fit_queue.dispatch()
+        fit_queue.wait()
+        fit_queue.shutdown()
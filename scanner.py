@@ -1,60 +1,231 @@
 '''
 Primary script, used to scan through the candidate directory to find new objects, and then submit jobs to the cluster to fit those objects.
+
+By default this runs once (as from cron/scrontab). With --daemon it keeps running, watching the candidate directory and
+dispatching new objects within seconds of them appearing. Both modes take the same scan lock and share the scan index,
+so a daemon can run alongside an existing cron deployment without objects being submitted twice.
 '''
 import os
 import sys
 import time
- 
-from utils.files import scan_objects, check_fit_completion, get_settings
+import argparse
+
+from utils.files import scan_objects, commit_scan_records, get_settings, get_state_path, scan_lock
 from utils.tools import current_time
-from utils.fitting import generate_job, submit_job
-from utils.plotting import plot_lightcurves
-from utils.git_tools import git_pull, git_push
+from utils.conversion import set_lightcurve_cache_directory, convert_to_dat
+from utils.validation import validate_objects
+from utils.postprocess import PostProcessor, postprocess_objects
+from utils.git_tools import git_pull, enqueue_objects, publish_pending, PublishQueue
+from utils.watcher import DirectoryWatcher
+from utils.tracking import update_fit_states, get_finished_objects, mark_published, release_failed_objects, is_finished, get_submitted_models, load_fit_states
+from utils.triage import get_stage_model, get_triage_settings, promote_triaged_objects
+from utils.fit_queue import get_queued_backend, get_queue_settings
+from utils.refit import split_refits, get_refit_settings, restart_rejected_refits
+
+
+def scan_and_submit(settings_file, backend=None, settle_time=0):
+    '''
+    scans the candidate directory for new objects and submits a fit for each model (a triage fit if triage is enabled,
+    see utils.triage, or a warm-start refit of an updated object with new epochs if refits are enabled, see utils.refit)
+
+    Args:
+        settings_file (str): path to settings file
+        backend (SlurmBackend, LocalBackend or FitQueue): execution backend (default: None, uses the backend named in
+            settings.json, behind the fit queue if it is enabled)
+        settle_time (float): skip files modified less than this many seconds ago (default: 0)
+
+    Returns:
+        new_objects (list): list of submitted objects (False if no new objects found)
+    '''
+    models_dicts, settings_dict = get_settings(settings_file)
+    lc_path = settings_dict['candidate_directory']
+    fit_path = settings_dict['fit_directory']
+    assert os.path.exists(lc_path), 'Candidate directory does not exist'
+    backend = get_queued_backend(settings_dict) if backend is None else backend
+
+    with scan_lock(settings_dict): ## scanning and submission are atomic with respect to other scanner processes
+        scan_start = time.time()
+        index_path = get_state_path(settings_dict, 'scan_index.jsonl')
+        pending_records = {} ## index records of the new objects, committed once their fits are recorded
+        new_objects = scan_objects(lc_path, fit_path, index_path, settle_time=settle_time, pending=pending_records) ## will return False if no new or updated objects found
+        if new_objects == False:
+            return False
+
+        valid_paths = validate_objects([os.path.join(lc_path, object) for object in new_objects], models_dicts, settings_dict) ## malformed files are quarantined rather than fit
+        commit_scan_records(index_path, [pending_records[object] for object in new_objects if os.path.join(lc_path, object) not in valid_paths]) ## not retried until the file changes
+        object_paths = [] ## lightcurves in other formats (csv, json) are converted to .dat in the state directory, as nmma expects
+        for valid_path in valid_paths:
+            try:
+                object_paths.append(convert_to_dat(valid_path, get_state_path(settings_dict, 'converted')))
+            except ValueError as e:
+                print('[{}] Skipping {}: {}'.format(current_time(), os.path.basename(valid_path), e))
+        num_fits = len(models_dicts.keys()) *  len(object_paths) ## total number of fits to be performed
+        anticipated_fit_count = 0 ## counter for number of fits that have been submitted
+        for model in models_dicts.keys():
+            new_paths, refits = split_refits(object_paths, models_dicts[model], settings_dict)
+            for object_path, refit_model in refits: ## each refit has its own narrowed prior
+                backend.submit([object_path], refit_model)
+            if len(new_paths) > 0:
+                backend.submit(new_paths, get_stage_model(models_dicts[model], settings_dict))
+            anticipated_fit_count += len(object_paths)
+            print('[{}] {} of {} fits submitted ({} backend)'.format(current_time(), anticipated_fit_count, num_fits, backend.name))
+        submitted_models = get_submitted_models(settings_dict, since=scan_start)
+        submitted = [object for object in new_objects if submitted_models.get(object.split('.')[0], set()) >= set(models_dicts.keys())]
+        commit_scan_records(index_path, [pending_records[object] for object in submitted])
+        if len(submitted) < len(valid_paths): ## e.g. failed conversion or sbatch call, left out of the index so the next scan retries them
+            print('[{}] Not all fits of {} were submitted, retrying next scan'.format(current_time(), [object for object in new_objects if object not in submitted and os.path.join(lc_path, object) in valid_paths]))
+        print('[{}] All fits submitted'.format(current_time()))
+    return new_objects
 
-git_pull() ## pull from github to get latest version of code
+def publish_fits(completed_objects, settings, publish_queue=None):
+    '''
+    queues the post-processed fits to be pushed to github
 
-settings_file = './settings.json'
+    Args:
+        completed_objects (list): names of objects whose results have been saved and plotted
+        settings (dict): dictionary of settings from settings.json
+        publish_queue (PublishQueue): background publishing queue (default: None, anything queued, including objects
+            left over from a failed push in an earlier run, is committed and pushed right away)
 
-models_dicts, settings_dict = get_settings(settings_file)
-    
-lc_path = settings_dict['candidate_directory']
-fit_path = settings_dict['fit_directory']
+    Returns:
+        None
+    '''
+    if publish_queue is not None:
+        publish_queue.submit(completed_objects)
+        return
+    if len(completed_objects) > 0:
+        enqueue_objects(settings, completed_objects)
+    publish_pending(settings)
 
-assert os.path.exists(lc_path), 'Candidate directory does not exist'
+def track_and_publish(settings_file, postprocessor=None, publish_queue=None, backend=None):
+    '''
+    advances the state of all submitted fits (including those submitted by earlier scanner runs), post-processes each
+    object as soon as all of its fits have finished and publishes the results. With triage enabled, the full fits of
+    the competitive models of an object are submitted once its triage fits have finished (and are published as provisional),
+    warm-start refits whose posterior piles up against their narrowed prior are refit from scratch (see utils.refit),
+    and queued fits (in the fit queue if it is enabled, or local fits waiting for cpus) are dispatched as slots free up.
 
-new_objects = scan_objects(lc_path, fit_path) ## will return False if no new objects found
+    Args:
+        settings_file (str): path to settings file
+        postprocessor (PostProcessor): pool to post-process objects in the background (default: None, objects are
+            post-processed in parallel and waited for before returning)
+        publish_queue (PublishQueue): background publishing queue (default: None, published before returning)
+        backend (SlurmBackend, LocalBackend or FitQueue): execution backend for full fits after triage, rejected refits and queued fits
+            (default: None, uses the backend named in settings.json, behind the fit queue if it is enabled)
 
-sys.exit() if new_objects == False else None ## exit if no new objects found
-    
-num_fits = len(models_dicts.keys()) *  len(new_objects) ## total number of fits to be performed
+    Returns:
+        tracker (dict): updated fit tracker (see utils.tracking.update_fit_states)
+    '''
+    models_dicts, settings_dict = get_settings(settings_file)
+    with scan_lock(settings_dict):
+        tracker = update_fit_states(settings_dict, models=models_dicts)
+        if get_refit_settings(settings_dict)['enabled']: ## before looking for finished objects, so they are not published with a rejected warm start
+            backend = get_queued_backend(settings_dict) if backend is None else backend
+            if restart_rejected_refits(settings_dict, models_dicts, backend) > 0:
+                tracker = load_fit_states(settings_dict)
+        finished_objects = get_finished_objects(tracker)
+        if len(finished_objects) > 0:
+            mark_published(settings_dict, list(finished_objects.keys())) ## claimed before publishing so another scanner process does not publish them too
+        if get_triage_settings(settings_dict)['enabled'] or get_queue_settings(settings_dict)['enabled']:
+            backend = get_queued_backend(settings_dict) if backend is None else backend
+        if get_triage_settings(settings_dict)['enabled']:
+            tracker = promote_triaged_objects(settings_dict, models_dicts, backend)
+        if backend is not None: ## queued fits, and local fits waiting for cpus
+            backend.dispatch()
+    if postprocessor is None:
+        completed_objects = postprocess_objects(finished_objects, settings_file, workers=settings_dict.get('postprocess_workers', 1)) if len(finished_objects) > 0 else []
+        failed_objects = [object for object in finished_objects if object not in completed_objects]
+    else:
+        postprocessor.submit(finished_objects)
+        completed_objects = postprocessor.collect()
+        failed_objects = postprocessor.pop_failed()
+    if len(failed_objects) > 0:
+        with scan_lock(settings_dict): ## claimed objects whose post-processing failed are released for the next tick
+            release_failed_objects(settings_dict, failed_objects)
+    publish_fits(completed_objects, settings_dict, publish_queue=publish_queue) ## combined dataframes and plots are written atomically, so they can be pushed right away
+    return tracker
 
-## to do: implement check for formatting of lightcurve files and have them be corrected if necessary (basic function is in utils/fileChecks.py as parse_csv)
+def run_once(settings_file, settle_time=0, wait=True):
+    '''
+    single scan as run by cron: resumes tracking of earlier submissions, submits fits for any new objects and (optionally) waits for them to complete
 
-anticipated_fit_count = 0 ## counter for number of fits that have been submitted
-for object in new_objects:
-    for model in models_dicts.keys():
-        jobFile = generate_job(object, model, settings_dict)
-        submit_job(jobFile)
-        anticipated_fit_count += 1
-        print('[{}] {} of {} fits submitted'.format(current_time(), anticipated_fit_count, num_fits))
-print('[{}] All fits submitted'.format(current_time()))
-t0 = time.time()
-while True:
+    Args:
+        settings_file (str): path to settings file
+        settle_time (float): skip files modified less than this many seconds ago (default: 0)
+        wait (bool): whether to wait for the new fits to complete; if False, they are published by a later run (default: True)
+
+    Returns:
+        None
+    '''
+    _, settings_dict = get_settings(settings_file)
+    git_pull(settings_dict) ## pull from github to get latest version of code
+    if settings_dict.get('lightcurve_cache', False):
+        set_lightcurve_cache_directory(get_state_path(settings_dict, 'lightcurve_cache'))
+    backend = get_queued_backend(settings_dict)
+    track_and_publish(settings_file, backend=backend)
+    new_objects = scan_and_submit(settings_file, backend=backend, settle_time=settle_time)
+    sys.exit() if new_objects == False or (not wait and backend.name != 'local') else None ## exit if no new objects found (or not waiting on cluster jobs)
+    backend.wait() ## local fits run in this process, so it has to stay alive until they finish
+
+    new_object_names = [object.split('.')[0] for object in new_objects]
+    while True:
+        tracker = track_and_publish(settings_file, backend=backend)
+        if is_finished(tracker, new_object_names): break
         time.sleep(60)
-        elapsed_time = (time.time() - t0)/60/60 ## elapsed time in hours
-        completion_state = check_fit_completion(new_objects, models_dicts, settings_dict, elapsed_time)
-        if completion_state == True: break
-        
-## plot lightcurves
-for object in new_objects:
-    plot_lightcurves(object, settings_file)
-time.sleep(60) ## wait 1 minute to make sure all plots have been saved (may be unnecessary)
-
-commit_message = 'Added fits for objects: {}'.format(', '.join(new_objects))
-git_push(commit_message)
-## schematically from here:
-## 1. Do plotting of results (plot best fit of each of the models_dicts along with the data onto one plot, save to root directory of object fit)
-## 2. Have an automated push to github of results (maybe try to automate the commit message to include the object names that have been fit in the commit)
-
-
-        
+
+def run_daemon(settings_file, min_interval=2, max_interval=60, settle_time=5, pull_interval=60):
+    '''
+    long-running scanner that watches the candidate directory and dispatches new objects as soon as they have settled
+
+    Args:
+        settings_file (str): path to settings file
+        min_interval (float): shortest polling interval in seconds when inotify is unavailable (default: 2)
+        max_interval (float): longest polling interval in seconds (default: 60)
+        settle_time (float): seconds a file must be left unmodified before it is dispatched (default: 5)
+        pull_interval (float): seconds between pulls from github, which is how new objects usually arrive (default: 60)
+
+    Returns:
+        None (runs until interrupted)
+    '''
+    _, settings_dict = get_settings(settings_file)
+    if settings_dict.get('lightcurve_cache', False):
+        set_lightcurve_cache_directory(get_state_path(settings_dict, 'lightcurve_cache'))
+    backend = get_queued_backend(settings_dict) ## kept alive for the lifetime of the daemon so local fits run in the background
+    postprocessor = PostProcessor(settings_file, workers=settings_dict.get('postprocess_workers', 1))
+    publish_queue = PublishQueue(settings_dict) ## commits and pushes in the background, so a slow or failing push does not hold up scanning
+    watcher = DirectoryWatcher(settings_dict['candidate_directory'], min_interval=min_interval, max_interval=min(max_interval, pull_interval), settle_time=settle_time)
+    last_pull = 0
+    try:
+        while True:
+            if time.time() - last_pull > pull_interval:
+                git_pull(settings_dict)
+                last_pull = time.time()
+            ## scanning is cheap (only changed files are hashed), so the directory is also rescanned on every timeout as a safety net
+            scan_and_submit(settings_file, backend=backend, settle_time=settle_time)
+            track_and_publish(settings_file, postprocessor=postprocessor, publish_queue=publish_queue, backend=backend)
+            watcher.wait()
+    except KeyboardInterrupt:
+        print('[{}] Scanner daemon stopped'.format(current_time()))
+    finally:
+        watcher.close()
+        backend.shutdown()
+        publish_queue.submit(postprocessor.collect(wait=True)) ## objects still being post-processed are published before exiting
+        with scan_lock(settings_dict):
+            release_failed_objects(settings_dict, postprocessor.pop_failed())
+        postprocessor.shutdown()
+        publish_queue.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='scan the candidate directory for new lightcurves and fit them')
+    parser.add_argument('--settings', default='./settings.json', help='path to settings file (default: ./settings.json)')
+    parser.add_argument('--daemon', action='store_true', help='keep running and watch the candidate directory instead of scanning once')
+    parser.add_argument('--settle-time', type=float, default=5, help='seconds a file must be left unmodified before it is dispatched (default: 5)')
+    parser.add_argument('--no-wait', action='store_true', help='exit right after submitting; fits are tracked and published by the next run')
+    parser.add_argument('--pull-interval', type=float, default=60, help='seconds between pulls from github in daemon mode (default: 60)')
+    args = parser.parse_args()
+
+    if args.daemon:
+        run_daemon(args.settings, settle_time=args.settle_time, pull_interval=args.pull_interval)
+    else:
+        run_once(args.settings, settle_time=args.settle_time, wait=not args.no_wait)
@@ -0,0 +1,86 @@
+'''
+batched submission through a stub sbatch (settings['scheduler']['sbatch']): job ids are parsed from --parsable output and
+each array task runs the line of commands.txt matching its task id
+
+Usage:
+    python -m pytest tests
+'''
+import os
+import json
+import stat
+
+import pytest
+
+from utils.fitting import SlurmBackend, submit_job, get_scheduler_command
+from utils.tracking import load_fit_states, ingest_submissions, fit_key
+
+OBJECTS = ['ZTF23aaa', 'ZTF23bbb', 'ZTF23ccc']
+
+
+def write_stub(path, script):
+    path.write_text('#!/bin/sh\n' + script)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+@pytest.fixture
+def cluster(tmp_path):
+    '''
+    three objects, one model and a stub sbatch logging its arguments and answering like sbatch --parsable on a federated cluster
+    '''
+    objects = []
+    for name in OBJECTS:
+        lc_path = tmp_path / (name + '.dat')
+        lc_path.write_text('2023-01-01T00:00:00.000 g 19.0 0.1\n2023-01-02T00:00:00.000 r 19.5 0.1\n')
+        objects.append(str(lc_path))
+    prior_path = tmp_path / 'model.prior'
+    prior_path.write_text('x = Uniform(minimum=0, maximum=1, name="x")\n')
+    sbatch = write_stub(tmp_path / 'sbatch', 'echo "$@" >> {}\necho "4242;cluster"\n'.format(tmp_path / 'sbatch.log'))
+    settings = {'repo_directory':str(tmp_path), 'fit_directory':str(tmp_path / 'fits'), 'state_directory':str(tmp_path / 'state'),
+                'env':{'path':'activate', 'name':'nmma'}, 'svd_path':'svdmodels', 'error_budget':1.0, 'Ebv_max':0.0,
+                'fit_trigger_time':True, 'trigger_time_heuristic':False, 't0':1, 'timeout':8, 'fit_cache':False,
+                'batch_submission':True, 'scheduler':{'sbatch':sbatch}}
+    model = {'name':'Bu2019lm', 'alias':'Kilonova', 'prior':str(prior_path), 'model':'Bu2019lm', 'job':{'time':'07:59:59', 'cpus-per-task':1},
+             'tmin':0.0, 'tmax':7.0, 'dt':0.1, 'nlive':1024, 'color':'C1'}
+    return settings, model, objects
+
+def test_scheduler_command_from_settings(cluster):
+    settings, _, _ = cluster
+    assert get_scheduler_command(settings, 'sbatch') == settings['scheduler']['sbatch']
+    assert get_scheduler_command(settings, 'squeue') == 'squeue'
+
+def test_submit_job_parses_parsable_output(cluster, tmp_path):
+    settings, _, _ = cluster
+    job_file = tmp_path / 'job.sh'
+    job_file.write_text('#!/bin/bash\n')
+    assert submit_job(str(job_file), sbatch=settings['scheduler']['sbatch']) == '4242'
+    assert (tmp_path / 'sbatch.log').read_text().split() == ['--parsable', str(job_file)]
+    assert submit_job(str(job_file), sbatch=write_stub(tmp_path / 'failing_sbatch', 'echo "error" >&2\nexit 1\n')) is None
+
+def test_array_tasks_map_to_commands(cluster, tmp_path):
+    settings, model, objects = cluster
+    job_ids = SlurmBackend(settings).submit(objects, model)
+    assert job_ids == ['4242_0', '4242_1', '4242_2']
+
+    calls = (tmp_path / 'sbatch.log').read_text().splitlines()
+    assert len(calls) == 1 ## one sbatch call for the whole array
+    job_file = calls[0].split()[1]
+    with open(job_file, 'r') as f:
+        job_script = f.read()
+    assert '#SBATCH --array=0-2' in job_script
+    array_directory = os.path.dirname(job_file)
+    with open(os.path.join(array_directory, 'commands.txt'), 'r') as f:
+        commands = f.read().splitlines()
+    assert 'sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {}'.format(os.path.join(array_directory, 'commands.txt')) in job_script
+    for task_id, (object, command) in enumerate(zip(objects, commands)):
+        assert '--data {} '.format(object) in command
+        assert '--label {}_Kilonova '.format(OBJECTS[task_id]) in command
+        assert command.endswith('> {0}.out 2> {0}.err'.format(os.path.join(settings['fit_directory'], OBJECTS[task_id], model['name'], model['name'])))
+
+    with open(os.path.join(array_directory, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    assert manifest['array_job_id'] == '4242'
+    assert [(task['task_id'], task['object'], task['job_id']) for task in manifest['tasks']] == [(n, name, '4242_{}'.format(n)) for n, name in enumerate(OBJECTS)]
+
+    tracker = load_fit_states(settings)
+    ingest_submissions(settings, tracker)
+    assert [tracker['fits'][fit_key(name, model['name'])]['job_id'] for name in OBJECTS] == job_ids
@@ -0,0 +1,82 @@
+'''
+publishing through PublishQueue to a local bare repository standing in for github: only the files matched by
+PUBLISH_PATTERNS (and the shared catalog) are committed, never result files or sampler output
+
+Usage:
+    python -m pytest tests
+'''
+import os
+import subprocess
+
+import pytest
+
+from utils.git_tools import PublishQueue, git_push, load_pending
+
+
+def run_git(*args, cwd=None):
+    return subprocess.run(['git'] + list(args), cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+def write_fits(fit_directory, object):
+    '''
+    writes the published files of an object along with the result file and sampler output left next to them
+    '''
+    os.makedirs(os.path.join(fit_directory, object, 'Bu2019lm'), exist_ok=True)
+    for name in ['combined_fits.csv', 'combined_fits.parquet', '{}_lightcurve.png'.format(object),
+                 'Bu2019lm/{}_Kilonova_result.json'.format(object), 'Bu2019lm/Bu2019lm.out', 'Bu2019lm/Bu2019lm.sh']:
+        with open(os.path.join(fit_directory, object, name), 'w') as f:
+            f.write(name)
+
+@pytest.fixture
+def repository(tmp_path):
+    '''
+    a clone of a bare remote with a fit directory inside it, as the scanner publishes from
+    '''
+    remote = str(tmp_path / 'remote.git')
+    repo_directory = str(tmp_path / 'repo')
+    run_git('init', '--bare', '--initial-branch=main', remote)
+    run_git('clone', remote, repo_directory)
+    run_git('config', 'user.email', 'scanner@example.com', cwd=repo_directory)
+    run_git('config', 'user.name', 'scanner', cwd=repo_directory)
+    run_git('checkout', '-b', 'main', cwd=repo_directory)
+    with open(os.path.join(repo_directory, 'README.md'), 'w') as f:
+        f.write('fits\n')
+    run_git('add', 'README.md', cwd=repo_directory)
+    run_git('commit', '-m', 'initial commit', cwd=repo_directory)
+    run_git('push', 'origin', 'main', cwd=repo_directory)
+    fit_directory = os.path.join(repo_directory, 'fits')
+    settings = {'repo_directory':repo_directory, 'fit_directory':fit_directory, 'state_directory':str(tmp_path / 'state'),
+                'publish':{'remote':'origin', 'branch':'main'}}
+    return settings, remote
+
+def get_remote_files(remote):
+    return sorted(run_git('ls-tree', '-r', '--name-only', 'main', cwd=remote).split())
+
+def test_publish_queue_commits_only_published_files(repository):
+    settings, remote = repository
+    for object in ['ZTF23aaa', 'ZTF23bbb']:
+        write_fits(settings['fit_directory'], object)
+    with open(os.path.join(settings['fit_directory'], 'fit_catalog.csv'), 'w') as f:
+        f.write('object,model\n')
+
+    publish_queue = PublishQueue(settings, batch_interval=3600) ## published by the flush on shutdown
+    publish_queue.submit(['ZTF23aaa'])
+    publish_queue.submit(['ZTF23bbb'])
+    publish_queue.shutdown()
+
+    assert get_remote_files(remote) == ['README.md', 'fits/ZTF23aaa/ZTF23aaa_lightcurve.png', 'fits/ZTF23aaa/combined_fits.csv',
+                                        'fits/ZTF23aaa/combined_fits.parquet', 'fits/ZTF23bbb/ZTF23bbb_lightcurve.png',
+                                        'fits/ZTF23bbb/combined_fits.csv', 'fits/ZTF23bbb/combined_fits.parquet', 'fits/fit_catalog.csv']
+    assert len(run_git('log', '--format=%s', 'main', cwd=remote).splitlines()) == 2 ## both objects in one commit
+    assert load_pending(settings) == {'objects':[], 'unpushed':False}
+
+def test_failed_push_is_retried(repository):
+    settings, remote = repository
+    write_fits(settings['fit_directory'], 'ZTF23aaa')
+    os.rename(remote, remote + '.offline')
+    assert not git_push(settings, objects=['ZTF23aaa'])
+    assert load_pending(settings)['unpushed']
+
+    os.rename(remote + '.offline', remote)
+    assert git_push(settings)
+    assert 'fits/ZTF23aaa/combined_fits.csv' in get_remote_files(remote)
+    assert load_pending(settings) == {'objects':[], 'unpushed':False}
@@ -0,0 +1,72 @@
+'''
+promotion of triage fits: once all triage fits of an object have finished, only the models within max_log_bayes_factor
+of the best are fit in full, and the triage fits of the other models are marked as promoted so this is done once
+
+Usage:
+    python -m pytest tests
+'''
+import os
+import stat
+
+import pytest
+
+from utils import triage
+from utils.fitting import SlurmBackend
+from utils.files import get_result_stage
+from utils.tracking import load_fit_states, save_fit_states, fit_key, ingest_submissions
+
+MODELS = ['Bu2019lm', 'nugent-hyper', 'TrPi2018', 'Piro2021']
+
+
+@pytest.fixture
+def triaged_object(tmp_path):
+    '''
+    an object whose triage fits to four models have all finished, with a fake sbatch
+    '''
+    lc_path = tmp_path / 'ZTF23abc.dat'
+    lc_path.write_text('2023-01-01T00:00:00.000 g 19.0 0.1\n2023-01-02T00:00:00.000 r 19.5 0.1\n2023-01-03T00:00:00.000 g 19.8 0.1\n')
+    prior_path = tmp_path / 'model.prior'
+    prior_path.write_text('x = Uniform(minimum=0, maximum=1, name="x")\n')
+    sbatch = tmp_path / 'sbatch'
+    sbatch.write_text('#!/bin/sh\nn=$(cat {0} 2>/dev/null || echo 100); n=$((n+1)); echo $n > {0}; echo $n\n'.format(tmp_path / 'job_counter'))
+    sbatch.chmod(sbatch.stat().st_mode | stat.S_IEXEC)
+    settings = {'repo_directory':str(tmp_path), 'fit_directory':str(tmp_path / 'fits'), 'state_directory':str(tmp_path / 'state'),
+                'env':{'path':'activate', 'name':'nmma'}, 'svd_path':'svdmodels', 'error_budget':1.0, 'Ebv_max':0.0,
+                'fit_trigger_time':True, 'trigger_time_heuristic':False, 't0':1, 'timeout':8, 'fit_cache':False,
+                'scheduler':{'sbatch':str(sbatch), 'squeue':'true', 'sacct':'true', 'scancel':'true'},
+                'triage':{'enabled':True, 'max_log_bayes_factor':5}}
+    os.makedirs(settings['state_directory'])
+    models = {name:{'name':name, 'alias':name, 'prior':str(prior_path), 'model':name, 'job':{'time':'07:59:59', 'cpus-per-task':1},
+                    'tmin':0.0, 'tmax':7.0, 'dt':0.1, 'nlive':1024, 'color':'C1'} for name in MODELS}
+    tracker = {'offset':0, 'fits':{}}
+    for name in MODELS:
+        outdir = os.path.join(settings['fit_directory'], 'ZTF23abc', name, 'triage')
+        tracker['fits'][fit_key('ZTF23abc', name)] = {'object':'ZTF23abc', 'model':name, 'job_id':'triage-' + name, 'outdir':outdir,
+                                                      'data':str(lc_path), 'submitted':0, 'stage':'triage', 'state':'done',
+                                                      'result_file':os.path.join(outdir, 'ZTF23abc_{}_result.json'.format(name)),
+                                                      'updated':0, 'published':True}
+    save_fit_states(settings, tracker)
+    return settings, models
+
+def set_triage_evidences(monkeypatch, log_evidences):
+    monkeypatch.setattr(triage, 'read_result_summary', lambda result_file: {'log_evidence':log_evidences[os.path.basename(os.path.dirname(os.path.dirname(result_file)))]})
+
+def test_promotion_marks_uncompetitive_triage_fits(triaged_object, monkeypatch):
+    settings, models = triaged_object
+    set_triage_evidences(monkeypatch, {'Bu2019lm':0.0, 'nugent-hyper':-1.0, 'TrPi2018':-20.0, 'Piro2021':-30.0})
+    backend = SlurmBackend(settings)
+    triage.promote_triaged_objects(settings, models, backend)
+
+    records = load_fit_states(settings)['fits']
+    assert [records[fit_key('ZTF23abc', name)]['state'] for name in MODELS] == ['pending', 'pending', 'done', 'done']
+    assert [records[fit_key('ZTF23abc', name)].get('stage') for name in MODELS] == [None, None, 'triage', 'triage']
+    assert all(records[fit_key('ZTF23abc', name)]['promoted'] for name in ['TrPi2018', 'Piro2021'])
+
+    triage.promote_triaged_objects(settings, models, backend) ## nothing left to promote
+    tracker = load_fit_states(settings)
+    ingest_submissions(settings, tracker)
+    assert sorted(record['job_id'] for record in tracker['fits'].values()) == ['101', '102', 'triage-Piro2021', 'triage-TrPi2018']
+
+def test_result_stage_from_directory(tmp_path):
+    assert get_result_stage(str(tmp_path / 'ZTF23abc' / 'Bu2019lm' / 'triage' / 'ZTF23abc_Bu2019lm_result.json')) == 'triage'
+    assert get_result_stage(str(tmp_path / 'ZTF23abc' / 'Bu2019lm' / 'ZTF23abc_Bu2019lm_result.json')) == 'full'
@@ -0,0 +1,64 @@
+'''
+triage promotion through a capped fit queue: the full fits still waiting in the queue must stay in the tracker, so the
+object is not considered finished (and published) as soon as the one dispatched fit ends
+
+Usage:
+    python -m pytest tests
+'''
+import os
+import stat
+
+import pytest
+
+from utils import triage
+from utils.fitting import SlurmBackend
+from utils.fit_queue import FitQueue, list_queue, IN_FLIGHT, QUEUED
+from utils.tracking import load_fit_states, save_fit_states, fit_key, get_finished_objects, is_finished
+
+MODELS = ['Bu2019lm', 'nugent-hyper', 'TrPi2018', 'Piro2021']
+
+
+@pytest.fixture
+def triaged_object(tmp_path):
+    '''
+    an object whose triage fits to four models have all finished, with a fake sbatch and the fit queue capped at one fit in flight
+    '''
+    lc_path = tmp_path / 'ZTF23abc.dat'
+    lc_path.write_text('2023-01-01T00:00:00.000 g 19.0 0.1\n2023-01-02T00:00:00.000 r 19.5 0.1\n2023-01-03T00:00:00.000 g 19.8 0.1\n')
+    prior_path = tmp_path / 'model.prior'
+    prior_path.write_text('x = Uniform(minimum=0, maximum=1, name="x")\n')
+    sbatch = tmp_path / 'sbatch'
+    sbatch.write_text('#!/bin/sh\nn=$(cat {0} 2>/dev/null || echo 100); n=$((n+1)); echo $n > {0}; echo $n\n'.format(tmp_path / 'job_counter'))
+    sbatch.chmod(sbatch.stat().st_mode | stat.S_IEXEC)
+    settings = {'repo_directory':str(tmp_path), 'fit_directory':str(tmp_path / 'fits'), 'state_directory':str(tmp_path / 'state'),
+                'env':{'path':'activate', 'name':'nmma'}, 'svd_path':'svdmodels', 'error_budget':1.0, 'Ebv_max':0.0,
+                'fit_trigger_time':True, 'trigger_time_heuristic':False, 't0':1, 'timeout':8, 'fit_cache':False,
+                'scheduler':{'sbatch':str(sbatch), 'squeue':'true', 'sacct':'true', 'scancel':'true'},
+                'triage':{'enabled':True}, 'queue':{'enabled':True, 'max_in_flight':1}}
+    os.makedirs(settings['state_directory'])
+    models = {name:{'name':name, 'alias':name, 'prior':str(prior_path), 'model':name, 'job':{'time':'07:59:59', 'cpus-per-task':1},
+                    'tmin':0.0, 'tmax':7.0, 'dt':0.1, 'nlive':1024, 'color':'C1'} for name in MODELS}
+    tracker = {'offset':0, 'fits':{}}
+    for name in MODELS:
+        outdir = os.path.join(settings['fit_directory'], 'ZTF23abc', name, 'triage')
+        tracker['fits'][fit_key('ZTF23abc', name)] = {'object':'ZTF23abc', 'model':name, 'job_id':'triage-' + name, 'outdir':outdir,
+                                                      'data':str(lc_path), 'submitted':0, 'stage':'triage', 'state':'done',
+                                                      'result_file':os.path.join(outdir, 'ZTF23abc_{}_result.json'.format(name)),
+                                                      'updated':0, 'published':True}
+    save_fit_states(settings, tracker)
+    return settings, models
+
+def set_triage_evidences(monkeypatch, log_evidences):
+    monkeypatch.setattr(triage, 'read_result_summary', lambda result_file: {'log_evidence':log_evidences[os.path.basename(os.path.dirname(os.path.dirname(result_file)))]})
+
+def test_promotion_keeps_queued_fits(triaged_object, monkeypatch):
+    settings, models = triaged_object
+    set_triage_evidences(monkeypatch, {name:0.0 for name in MODELS}) ## all competitive
+    triage.promote_triaged_objects(settings, models, FitQueue(settings, SlurmBackend(settings)))
+
+    states = sorted(record['state'] for record in load_fit_states(settings)['fits'].values())
+    assert states == ['pending', 'queued', 'queued', 'queued']
+    assert [row['state'] for row in list_queue(settings)] == [IN_FLIGHT, QUEUED, QUEUED, QUEUED]
+    tracker = load_fit_states(settings)
+    assert not is_finished(tracker, ['ZTF23abc'])
+    assert 'ZTF23abc' not in get_finished_objects(tracker)
@@ -0,0 +1,307 @@
+'''
+adaptive sampler budget: picks nlive, cpus, memory and walltime for each fit from the lightcurve being fit and a cost
+model fitted to the runtimes of earlier fits
+
+nlive scales with the square root of the number of detections inside the model's tmin/tmax window (relative to
+reference_detections, between nlive_min and the model's nlive). Once enough runtimes have been recorded, the log
+runtime is modelled as linear in log nlive, log cpus, log detections, number of filters and the fraction of the window
+spanned by the data (least squares, per model when it has enough runs), and the walltime is sized from the predicted
+runtime (up to the model's walltime, or max_time_hours if set, so dense fits do not time out). Terms that do not vary
+across the recorded runs are left out of the fit, as is a cpus term that would make fits slower with more cpus; only
+when the recorded runs show fits getting faster with more cpus are the cpus chosen so the predicted runtime fits in
+target_runtime_hours, otherwise the model's cpus-per-task is kept. Runtimes come from the "Sampling time" reported in
+the fit's .out file, or the elapsed time from sacct, and are appended to runtimes.jsonl in the state directory.
+'''
+import os
+import re
+import json
+import math
+import time
+
+import numpy as np
+
+from utils.tools import current_time
+from utils.files import get_state_path
+from utils.conversion import load_lightcurve
+from utils.validation import get_window_reference
+
+MEMORY_UNITS = {'k':1<<10, 'm':1<<20, 'g':1<<30, 't':1<<40}
+SAMPLING_TIME = re.compile(r'Sampling time:\s*(?:(\d+) days?, )?(\d+):(\d+):([\d.]+)')
+
+CPUS_COLUMN = 2 ## column of log cpus in the design matrix
+_cost_models = {} ## (runtimes path, mtime, size) -> {model name or None: coefficients}
+
+
+def get_budget_settings(settings):
+    '''
+    retrieve the budget settings (settings['budget']) with defaults filled in
+    '''
+    budget_settings = {'enabled':False, 'nlive_min':256, 'reference_detections':50, 'target_runtime_hours':2,
+                       'max_cpus':16, 'time_safety':2.0, 'mem_safety':1.5, 'min_records':10, 'max_time_hours':None}
+    budget_settings.update(settings.get('budget', {}))
+    return budget_settings
+
+def parse_slurm_time(slurm_time):
+    '''
+    converts a slurm time ([D-]HH:MM:SS, MM:SS or minutes) to seconds
+    '''
+    days, _, clock = str(slurm_time).rpartition('-')
+    fields = [float(field) for field in clock.split(':')]
+    if len(fields) == 1: ## minutes
+        fields = [0, fields[0], 0]
+    elif len(fields) == 2:
+        fields = [0] + fields
+    return (int(days) if days else 0) * 86400 + fields[0] * 3600 + fields[1] * 60 + fields[2]
+
+def format_slurm_time(seconds):
+    '''
+    converts seconds to a slurm time (D-HH:MM:SS, rounded up to the minute)
+    '''
+    minutes = int(math.ceil(seconds / 60))
+    return '{}-{:02d}:{:02d}:00'.format(minutes // 1440, (minutes % 1440) // 60, minutes % 60)
+
+def parse_memory(memory):
+    '''
+    converts a slurm memory size (e.g. 8gb, 8G, 1234K, as in settings.json or sacct MaxRSS) to bytes (None if empty)
+    '''
+    memory = str(memory).strip().lower().rstrip('b')
+    if memory == '':
+        return None
+    if memory[-1] in MEMORY_UNITS:
+        return float(memory[:-1]) * MEMORY_UNITS[memory[-1]]
+    return float(memory) * MEMORY_UNITS['m'] ## slurm defaults to megabytes
+
+def parse_sampling_time(output):
+    '''
+    retrieve the sampling time bilby logs at the end of a fit (to the .err file, as its logger writes to stderr, or the
+    .out file)
+
+    Args:
+        output (str): path to the fit's logs without extension (<fit directory>/<model>)
+
+    Returns:
+        seconds (float): sampling time in seconds (None if the file does not report one)
+    '''
+    matches = []
+    for log_file in [output + '.err', output + '.out']:
+        if os.path.exists(log_file):
+            with open(log_file, 'r', errors='replace') as f:
+                matches += SAMPLING_TIME.findall(f.read())
+    if len(matches) == 0:
+        return None
+    days, hours, minutes, seconds = matches[-1]
+    return (int(days) if days else 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def get_fit_features(object, model, settings):
+    '''
+    summarises the data a fit will see: detections within the model's tmin/tmax window, the filters they are in, and
+    the fraction of the window they span
+
+    Args:
+        object (str): path to object lightcurve
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        features (dict): dictionary with keys num_detections, num_filters and span
+    '''
+    lightcurve = load_lightcurve(object)
+    detected = lightcurve.detected
+    reference = get_window_reference(lightcurve.mjd, detected, settings) if detected.any() else None
+    if reference is None:
+        in_window = detected
+        t = lightcurve.mjd - (lightcurve.mjd[detected].min() if detected.any() else 0)
+    else:
+        t = lightcurve.mjd - reference
+        in_window = detected & (t >= model['tmin']) & (t <= model['tmax'])
+    span = (t[in_window].max() - t[in_window].min()) / (model['tmax'] - model['tmin']) if in_window.sum() > 1 else 0.0
+    return {'num_detections':int(in_window.sum()), 'num_filters':len(np.unique(lightcurve.filter[in_window])), 'span':float(min(span, 1.0))}
+
+def get_design_matrix(rows):
+    '''
+    builds the cost model design matrix: [1, log nlive, log cpus, log(1 + detections), filters, span]
+    '''
+    return np.array([[1.0, np.log(row['nlive']), np.log(row['cpus']), np.log1p(row['num_detections']), row['num_filters'], row['span']] for row in rows])
+
+def load_runtimes(settings):
+    runtimes_path = get_state_path(settings, 'runtimes.jsonl')
+    if not os.path.exists(runtimes_path):
+        return []
+    with open(runtimes_path, 'r') as f:
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+def fit_cost_model(rows):
+    '''
+    fits the cost model coefficients by least squares on the log runtimes of recorded fits. Columns that are constant
+    across the fits (e.g. cpus while every fit of a model used the same cpus-per-task) cannot be told apart from the
+    intercept and get a coefficient of 0, as does the cpus column if the fit would have more cpus slow a fit down.
+
+    Args:
+        rows (list): list of runtime records from runtimes.jsonl
+
+    Returns:
+        coefficients (np.ndarray): coefficients for get_design_matrix
+    '''
+    design_matrix, log_runtimes = get_design_matrix(rows), np.log([row['runtime'] for row in rows])
+    varying = np.ptp(design_matrix, axis=0) > 0
+    varying[0] = True ## intercept
+    for _ in range(2):
+        coefficients = np.zeros(design_matrix.shape[1])
+        coefficients[varying], _, _, _ = np.linalg.lstsq(design_matrix[:, varying], log_runtimes, rcond=None)
+        if coefficients[CPUS_COLUMN] <= 0:
+            break
+        varying[CPUS_COLUMN] = False
+    return coefficients
+
+def get_cost_model(settings, model_name):
+    '''
+    retrieve the cost model coefficients for a model, fitted by least squares on the log runtimes recorded for it (or on
+    all recorded runtimes if the model has fewer than min_records), refitted only when runtimes.jsonl changes
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        model_name (str): name of model
+
+    Returns:
+        coefficients (np.ndarray): coefficients for get_design_matrix (None if too few runtimes have been recorded)
+    '''
+    runtimes_path = get_state_path(settings, 'runtimes.jsonl')
+    if not os.path.exists(runtimes_path):
+        return None
+    stat = os.stat(runtimes_path)
+    cache_key = (runtimes_path, stat.st_mtime, stat.st_size)
+    if cache_key not in _cost_models:
+        min_records = get_budget_settings(settings)['min_records']
+        rows = [row for row in load_runtimes(settings) if row.get('runtime')]
+        groups = {None:rows}
+        for row in rows:
+            groups.setdefault(row['model'], []).append(row)
+        coefficients = {}
+        for name, group in groups.items():
+            if len(group) >= min_records:
+                coefficients[name] = fit_cost_model(group)
+        _cost_models.clear()
+        _cost_models[cache_key] = coefficients
+    coefficients = _cost_models[cache_key]
+    return coefficients.get(model_name, coefficients.get(None))
+
+def predict_runtime(coefficients, features, nlive, cpus):
+    '''
+    retrieve the runtime in seconds predicted by a cost model
+    '''
+    return float(np.exp(get_design_matrix([dict(features, nlive=nlive, cpus=cpus)])[0] @ coefficients))
+
+def get_memory_estimate(settings, model_name):
+    '''
+    retrieve the 95th percentile of the peak memory (bytes) recorded for a model (None if fewer than min_records)
+    '''
+    max_rss = [row['max_rss'] for row in load_runtimes(settings) if row['model'] == model_name and row.get('max_rss')]
+    if len(max_rss) < get_budget_settings(settings)['min_records']:
+        return None
+    return float(np.percentile(max_rss, 95))
+
+def get_fit_budget(object, model, settings):
+    '''
+    chooses nlive and the job resources for a fit of an object to a model (the model's own settings if the budget is not
+    enabled in settings.json)
+
+    Args:
+        object (str): path to object lightcurve
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        budget (dict): dictionary with keys nlive, job (job settings as in settings.json), features and predicted_runtime
+    '''
+    budget_settings = get_budget_settings(settings)
+    features = get_fit_features(object, model, settings)
+    job = dict(model['job'])
+    budget = {'nlive':model['nlive'], 'job':job, 'features':features, 'predicted_runtime':None}
+    if not budget_settings['enabled']:
+        return budget
+
+    scale = math.sqrt(max(features['num_detections'], 1) / budget_settings['reference_detections'])
+    nlive = int(round(model['nlive'] * scale / 32)) * 32 ## multiple of 32
+    budget['nlive'] = int(min(max(nlive, budget_settings['nlive_min']), model['nlive']))
+
+    coefficients = get_cost_model(settings, model['name'])
+    if coefficients is not None:
+        cpus = int(job.get('cpus-per-task', 1))
+        if coefficients[CPUS_COLUMN] < 0: ## only when the recorded runs show fits getting faster with more cpus
+            candidate_cpus = sorted({candidate for candidate in [1, 2, 4, 8, 16, 32, 64, cpus] if candidate <= budget_settings['max_cpus']})
+            target_runtime = budget_settings['target_runtime_hours'] * 3600
+            cpus = next((candidate for candidate in candidate_cpus if predict_runtime(coefficients, features, budget['nlive'], candidate) <= target_runtime), candidate_cpus[-1])
+        predicted_runtime = predict_runtime(coefficients, features, budget['nlive'], cpus)
+        max_time = parse_slurm_time(job['time']) if 'time' in job else settings['timeout'] * 3600
+        if budget_settings['max_time_hours'] is not None and model.get('stage') != 'triage': ## dense fits may run past the model's walltime, though not past the tracker's timeout
+            max_time = max(max_time, min(budget_settings['max_time_hours'], settings['timeout']) * 3600)
+        job['cpus-per-task'] = cpus
+        job['time'] = format_slurm_time(min(max(budget_settings['time_safety'] * predicted_runtime, 900), max_time))
+        budget['predicted_runtime'] = predicted_runtime
+
+    memory = get_memory_estimate(settings, model['name'])
+    if memory is not None:
+        max_memory = parse_memory(job['mem']) if 'mem' in job else float('inf')
+        job['mem'] = '{}gb'.format(int(math.ceil(min(budget_settings['mem_safety'] * memory, max_memory) / MEMORY_UNITS['g'])))
+    return budget
+
+def merge_jobs(jobs):
+    '''
+    retrieve job settings covering several budgeted fits (the largest of each resource), for the header of an array job
+    '''
+    merged = dict(jobs[0])
+    for key, parse in [('cpus-per-task', int), ('mem', parse_memory), ('time', parse_slurm_time)]:
+        values = [job[key] for job in jobs if key in job]
+        if len(values) > 0:
+            merged[key] = max(values, key=parse)
+    return merged
+
+def get_budgeted_model(object, model, settings):
+    '''
+    retrieve a copy of a model with the nlive and job settings chosen by get_fit_budget
+
+    Returns:
+        budgeted_model (dict): dictionary of model with nlive and job replaced
+        budget (dict): budget returned by get_fit_budget
+    '''
+    budget = get_fit_budget(object, model, settings)
+    return dict(model, nlive=budget['nlive'], job=budget['job']), budget
+
+def write_budget_file(outdir, model_name, budget):
+    '''
+    writes the budget of a fit next to its job files (<model>.budget.json), so its runtime can be recorded once it finishes
+    '''
+    with open(os.path.join(outdir, model_name + '.budget.json'), 'w') as f:
+        json.dump(dict(budget, submitted=time.time()), f, indent=1)
+
+def record_runtimes(settings, records, accounting=None):
+    '''
+    appends the runtimes of finished fits to runtimes.jsonl in the state directory, for the cost model
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        records (list): list of tracked fit records that have just finished
+        accounting (dict): dictionary of job id to {'elapsed', 'max_rss'} from sacct (default: None, runtimes from the .out files only)
+
+    Returns:
+        num_recorded (int): number of runtimes recorded
+    '''
+    accounting = accounting or {}
+    rows = []
+    for record in records:
+        budget_file = os.path.join(record['outdir'], record['model'] + '.budget.json')
+        if not os.path.exists(budget_file):
+            continue ## e.g. reused cached fits
+        with open(budget_file, 'r') as f:
+            budget = json.load(f)
+        job_accounting = accounting.get(record.get('job_id'), {})
+        runtime = parse_sampling_time(os.path.join(record['outdir'], record['model'])) or job_accounting.get('elapsed')
+        if runtime is None:
+            continue
+        rows.append(dict(budget['features'], model=record['model'], nlive=budget['nlive'], cpus=int(budget['job'].get('cpus-per-task', 1)),
+                         runtime=runtime, max_rss=job_accounting.get('max_rss'), predicted_runtime=budget.get('predicted_runtime'), recorded=time.time()))
+    if len(rows) > 0:
+        with open(get_state_path(settings, 'runtimes.jsonl'), 'a') as f:
+            f.write(''.join(json.dumps(row) + '\n' for row in rows))
+        print('[{}] Recorded {} fit runtimes'.format(current_time(), len(rows)))
+    return len(rows)
@@ -0,0 +1,222 @@
+'''
+sqlite catalog of completed fits (evidences and best fit parameters of every object and model), maintained as fits
+finish so model comparisons across objects do not need to reload the result files
+
+Each fit has a stage: 'full', or 'triage' for the provisional result of a cheap triage fit (see utils.triage), which is
+replaced by the full fit of the model if there is one. Queries can be restricted to full fits with full_only.
+'''
+import os
+import json
+import time
+import sqlite3
+from contextlib import closing
+
+from utils.tools import current_time
+from utils.files import get_state_path
+from utils.results import read_result_summary, get_top_samples
+
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fits (
+    object TEXT NOT NULL,
+    model TEXT NOT NULL,
+    alias TEXT,
+    stage TEXT,
+    log_evidence REAL,
+    log_evidence_err REAL,
+    log_bayes_factor REAL,
+    log_likelihood REAL,
+    num_samples INTEGER,
+    parameters TEXT,
+    result_file TEXT,
+    updated REAL,
+    PRIMARY KEY (object, model)
+);
+CREATE INDEX IF NOT EXISTS fits_object ON fits (object);
+CREATE INDEX IF NOT EXISTS fits_model_evidence ON fits (model, log_evidence);
+CREATE INDEX IF NOT EXISTS fits_evidence ON fits (log_evidence);
+'''
+CATALOG_COLUMNS = ['object', 'model', 'alias', 'stage', 'log_evidence', 'log_evidence_err', 'log_bayes_factor', 'log_likelihood',
+                   'num_samples', 'parameters', 'result_file', 'updated']
+
+
+def get_catalog_path(settings):
+    '''
+    retrieve the path to the catalog database (settings['catalog_file'], default: catalog.sqlite in the state directory)
+    '''
+    return settings.get('catalog_file') or get_state_path(settings, 'catalog.sqlite')
+
+def connect_catalog(settings):
+    '''
+    opens the catalog database, creating the table and indexes if needed
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        conn (sqlite3.Connection): connection to the catalog (rows can be accessed by column name)
+    '''
+    catalog_path = get_catalog_path(settings)
+    os.makedirs(os.path.dirname(os.path.abspath(catalog_path)), exist_ok=True)
+    conn = sqlite3.connect(catalog_path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL') ## queries do not block the scanner (and vice versa)
+    conn.executescript(CATALOG_SCHEMA)
+    if 'stage' not in [column['name'] for column in conn.execute('PRAGMA table_info(fits)')]: ## catalogs created before fits had a stage
+        with conn:
+            conn.execute('ALTER TABLE fits ADD COLUMN stage TEXT')
+            conn.execute("UPDATE fits SET stage = 'full'")
+    return conn
+
+def get_model_name(models, model):
+    '''
+    retrieve the name of a model in settings.json from its name or alias (e.g. Bu2019lm or Kilonova)
+
+    Raises:
+        KeyError: if no model in settings.json has this name or alias
+    '''
+    for model_dict in models.values():
+        if model in [model_dict['name'], model_dict['alias']]:
+            return model_dict['name']
+    raise KeyError('Unknown model {} (not in settings.json)'.format(model))
+
+def get_fit_row(object, model, result_file, alias=None, stage='full'):
+    '''
+    summarises a completed fit as a catalog row from its result store (evidences and maximum likelihood parameters)
+
+    Args:
+        object (str): name of object
+        model (str): name of model
+        result_file (str): path to result file
+        alias (str): alias of model (default: None)
+        stage (str): fitting stage, 'full' or 'triage' (default: 'full')
+
+    Returns:
+        row (dict): dictionary with keys CATALOG_COLUMNS
+    '''
+    summary = read_result_summary(result_file)
+    best_parameters_dict = get_top_samples(result_file, top_k=1)[0] if summary['num_samples'] > 0 else {}
+    return {'object':object, 'model':model, 'alias':alias, 'stage':stage,
+            'log_evidence':summary['log_evidence'], 'log_evidence_err':summary['log_evidence_err'],
+            'log_bayes_factor':summary['log_bayes_factor'], 'log_likelihood':best_parameters_dict.get('log_likelihood'),
+            'num_samples':summary['num_samples'], 'parameters':json.dumps(best_parameters_dict),
+            'result_file':result_file, 'updated':time.time()}
+
+def add_fits(settings, rows):
+    '''
+    inserts catalog rows, replacing earlier fits of the same object and model
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        rows (list): list of rows returned by get_fit_row
+
+    Returns:
+        None
+    '''
+    if len(rows) == 0:
+        return
+    with closing(connect_catalog(settings)) as conn, conn:
+        conn.executemany('INSERT OR REPLACE INTO fits ({}) VALUES ({})'.format(', '.join(CATALOG_COLUMNS), ', '.join(':' + column for column in CATALOG_COLUMNS)), rows)
+
+def catalog_fits(settings, records, models=None):
+    '''
+    adds completed fits to the catalog, as called by the tracker when fits finish (a fit that cannot be summarised is
+    reported and skipped so it does not hold up the others)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        records (list): list of tracked fit records with a result_file (see utils.tracking)
+        models (dict): dictionary of models from settings.json, used for the aliases (default: None)
+
+    Returns:
+        num_added (int): number of fits added
+    '''
+    aliases = {model_dict['name']:model_dict['alias'] for model_dict in (models or {}).values()}
+    rows = []
+    for record in records:
+        try:
+            rows.append(get_fit_row(record['object'], record['model'], record['result_file'], alias=aliases.get(record['model']), stage=record.get('stage') or 'full'))
+        except (OSError, ValueError, KeyError) as e:
+            print('[{}] Could not add {} {} to the catalog: {}'.format(current_time(), record['object'], record['model'], e))
+    add_fits(settings, rows)
+    return len(rows)
+
+def query_fits(settings, object=None, model=None, min_log_evidence=None, full_only=False):
+    '''
+    retrieve fits from the catalog
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        object (str): only fits of this object (default: None, all objects)
+        model (str): only fits of this model name (default: None, all models)
+        min_log_evidence (float): only fits with at least this log evidence (default: None)
+        full_only (bool): leave out provisional triage fits (default: False)
+
+    Returns:
+        rows (list): list of dictionaries with keys CATALOG_COLUMNS (parameters decoded), ordered by object and decreasing log evidence
+    '''
+    conditions, values = [], []
+    for column, condition, value in [('object', '=', object), ('model', '=', model), ('log_evidence', '>=', min_log_evidence)]:
+        if value is not None:
+            conditions.append('{} {} ?'.format(column, condition))
+            values.append(value)
+    if full_only:
+        conditions.append("stage = 'full'")
+    query = 'SELECT * FROM fits' + (' WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else '') + ' ORDER BY object, log_evidence DESC'
+    with closing(connect_catalog(settings)) as conn:
+        rows = [dict(row) for row in conn.execute(query, values)]
+    for row in rows:
+        row['parameters'] = json.loads(row['parameters']) if row['parameters'] else {}
+    return rows
+
+def compare_models(settings, model, other_model, min_delta=0.0, full_only=False):
+    '''
+    retrieve the objects that prefer one model over another, i.e. with log Bayes factor ln Z_model - ln Z_other > min_delta
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        model (str): name of the preferred model
+        other_model (str): name of the model compared against
+        min_delta (float): minimum difference in log evidence (default: 0)
+        full_only (bool): leave out objects where either fit is a provisional triage fit (default: False)
+
+    Returns:
+        rows (list): list of dictionaries (keys: object, stage, other_stage, log_evidence, other_log_evidence,
+            delta_log_evidence, delta_log_evidence_err), ordered by decreasing delta_log_evidence
+    '''
+    query = '''
+        SELECT a.object, a.stage, b.stage AS other_stage, a.log_evidence, b.log_evidence AS other_log_evidence,
+               a.log_evidence - b.log_evidence AS delta_log_evidence,
+               sqrt(coalesce(a.log_evidence_err, 0) * coalesce(a.log_evidence_err, 0) + coalesce(b.log_evidence_err, 0) * coalesce(b.log_evidence_err, 0)) AS delta_log_evidence_err
+        FROM fits a JOIN fits b ON a.object = b.object
+        WHERE a.model = ? AND b.model = ? AND a.log_evidence - b.log_evidence > ?{}
+        ORDER BY delta_log_evidence DESC
+    '''.format(" AND a.stage = 'full' AND b.stage = 'full'" if full_only else '')
+    with closing(connect_catalog(settings)) as conn:
+        conn.create_function('sqrt', 1, lambda x: None if x is None else x ** 0.5)
+        return [dict(row) for row in conn.execute(query, (model, other_model, min_delta))]
+
+def rank_models(settings, models, object=None, full_only=False):
+    '''
+    ranks the models in settings.json for each object by evidence, with the log Bayes factor of each model against the
+    best one (0 for the best model, negative otherwise)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        models (dict): dictionary of models from settings.json (only these models are ranked)
+        object (str): only rank the models of this object (default: None, all objects)
+        full_only (bool): leave out provisional triage fits (default: False)
+
+    Returns:
+        rows (list): list of dictionaries (keys: object, model, alias, stage, log_evidence, rank, log_bayes_factor_vs_best), ordered by object and rank
+    '''
+    names = [model_dict['name'] for model_dict in models.values()]
+    query = '''
+        SELECT object, model, alias, stage, log_evidence,
+               RANK() OVER (PARTITION BY object ORDER BY log_evidence DESC) AS rank,
+               log_evidence - MAX(log_evidence) OVER (PARTITION BY object) AS log_bayes_factor_vs_best
+        FROM fits
+        WHERE log_evidence IS NOT NULL AND model IN ({}){}{}
+        ORDER BY object, rank
+    '''.format(', '.join('?' * len(names)), ' AND object = ?' if object is not None else '', " AND stage = 'full'" if full_only else '')
+    with closing(connect_catalog(settings)) as conn:
+        return [dict(row) for row in conn.execute(query, names + ([object] if object is not None else []))]
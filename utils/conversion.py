@@ -0,0 +1,441 @@
+'''
+loading and conversion of lightcurve files (.dat, ZTF forced photometry, ALeRCE/Fritz csv and json) into the columnar format shared by the rest of the pipeline
+
+pandas is imported by the readers that use it, so lightcurves found in the on-disk cache are loaded without it
+'''
+import os
+import re
+import json
+import hashlib
+from typing import NamedTuple
+from collections import OrderedDict
+
+import numpy as np
+
+
+MJD_EPOCH = np.datetime64('1858-11-17T00:00:00', 'us') ## mjd 0
+JD_MJD_OFFSET = 2400000.5 ## jd - mjd
+DAY = np.timedelta64(86400000000, 'us')
+
+def jd_to_mjd(jd):
+    '''converts an array of julian dates to modified julian dates'''
+    return np.asarray(jd, dtype=np.float64) - JD_MJD_OFFSET
+
+def mjd_to_jd(mjd):
+    '''converts an array of modified julian dates to julian dates'''
+    return np.asarray(mjd, dtype=np.float64) + JD_MJD_OFFSET
+
+def isot_to_mjd(isot):
+    '''
+    converts an array of isot strings (utc) to modified julian dates in one vectorized operation
+
+    Args:
+        isot (array-like): times in isot format, e.g. '2020-09-01T07:40:03.003'
+
+    Returns:
+        mjd (np.ndarray): modified julian dates (float)
+
+    Raises:
+        ValueError: if any of the strings is not a valid isot time
+    '''
+    return (np.asarray(isot, dtype='datetime64[us]') - MJD_EPOCH) / DAY
+
+def mjd_to_isot(mjd):
+    '''
+    converts an array of modified julian dates to isot strings (utc) with millisecond precision, as astropy's isot format
+
+    Args:
+        mjd (array-like): modified julian dates
+
+    Returns:
+        isot (np.ndarray): times in isot format (str)
+    '''
+    milliseconds = np.rint(np.asarray(mjd, dtype=np.float64) * 86400e3).astype(np.int64) ## rounded to the nearest ms, as astropy does
+    return np.datetime_as_string(MJD_EPOCH + milliseconds.astype('timedelta64[ms]'), unit='ms')
+
+def isot_to_jd(isot):
+    '''converts an array of isot strings (utc) to julian dates'''
+    return mjd_to_jd(isot_to_mjd(isot))
+
+def jd_to_isot(jd):
+    '''converts an array of julian dates to isot strings (utc) with millisecond precision'''
+    return mjd_to_isot(jd_to_mjd(jd))
+
+def apply_upper_limits(mag, mag_unc, limiting_mag, non_detection_mag=99.0):
+    '''
+    replaces non-detections (magnitudes equal to non_detection_mag) with the limiting magnitude and an infinite uncertainty,
+    the format nmma expects for upper limits
+
+    Args:
+        mag (array-like): magnitudes
+        mag_unc (array-like): magnitude uncertainties
+        limiting_mag (array-like): limiting magnitude of each observation
+        non_detection_mag (float): magnitude used to flag non-detections (default: 99.0)
+
+    Returns:
+        mag (np.ndarray): magnitudes, with limiting magnitudes for non-detections
+        mag_unc (np.ndarray): magnitude uncertainties, inf for non-detections
+    '''
+    mag = np.asarray(mag, dtype=np.float64)
+    mag_unc = np.asarray(mag_unc, dtype=np.float64)
+    non_detected = mag == non_detection_mag
+    return np.where(non_detected, np.asarray(limiting_mag, dtype=np.float64), mag), np.where(non_detected, np.inf, mag_unc)
+
+def write_dat(out_file, t, filter, mag, mag_unc):
+    '''
+    writes a lightcurve to a .dat file in the format desired by NMMA with a single write
+
+    Args:
+        out_file (str): path to .dat file
+        t (array-like): times in isot format
+        filter (array-like): filters
+        mag (array-like): magnitudes
+        mag_unc (array-like): magnitude uncertainties
+
+    Returns:
+        None
+    '''
+    columns = [np.asarray(column).astype(str) for column in [t, filter, mag, mag_unc]]
+    with open(out_file, 'w') as f:
+        f.write(''.join(' '.join(row) + '\n' for row in zip(*columns)))
+
+
+class LightCurve(NamedTuple):
+    '''
+    columnar lightcurve, one numpy array per column (all of the same length)
+
+    Attributes:
+        t (np.ndarray): observation times in isot format (str)
+        mjd (np.ndarray): observation times in mjd (float)
+        filter (np.ndarray): filter of each observation (str)
+        mag (np.ndarray): magnitude, or limiting magnitude for non-detections (float)
+        mag_unc (np.ndarray): magnitude uncertainty, inf for non-detections (float)
+        hash (str): sha1 hash of the file contents the lightcurve was read from
+    '''
+    t: np.ndarray
+    mjd: np.ndarray
+    filter: np.ndarray
+    mag: np.ndarray
+    mag_unc: np.ndarray
+    hash: str
+
+    @property
+    def detected(self):
+        '''boolean mask of detections (finite magnitude uncertainty)'''
+        return self.mag_unc != np.inf
+
+    def to_dataframe(self):
+        '''
+        converts the lightcurve to a pandas dataframe with columns t (isot), mjd, filter, mag, mag_unc
+        '''
+        import pandas as pd
+
+        return pd.DataFrame({'t':self.t, 'mjd':self.mjd, 'filter':self.filter, 'mag':self.mag, 'mag_unc':self.mag_unc})
+
+
+## both caches are least recently used first and bounded, as the scanner daemon sees every lightcurve it ever fits
+MAX_CACHED_LIGHTCURVES = 256
+MAX_CACHED_HASHES = 4096
+_lightcurve_cache = OrderedDict() ## content hash -> LightCurve
+_hash_cache = OrderedDict() ## (path, mtime, size) -> content hash, so unchanged files are not re-read to be hashed
+_cache_directory = None ## directory for .npz sidecars (None disables the on-disk cache)
+
+def set_lightcurve_cache_directory(cache_directory):
+    '''
+    sets the directory used to store parsed lightcurves as .npz sidecars, shared between processes and scanner runs
+
+    Args:
+        cache_directory (str): path to cache directory (None disables the on-disk cache)
+
+    Returns:
+        None
+    '''
+    global _cache_directory
+    if cache_directory is not None:
+        os.makedirs(cache_directory, exist_ok=True)
+    _cache_directory = cache_directory
+
+def cache_value(cache, key, value, max_entries):
+    '''
+    adds a value to a least recently used cache, evicting the oldest entries beyond max_entries
+    '''
+    cache[key] = value
+    while len(cache) > max_entries:
+        cache.popitem(last=False)
+    return value
+
+def get_content_hash(lc_path):
+    '''
+    retrieve the sha1 hash of a lightcurve file's contents, memoized on the file's path, mtime and size
+    '''
+    stat = os.stat(lc_path)
+    stat_key = (os.path.abspath(lc_path), stat.st_mtime_ns, stat.st_size)
+    if stat_key in _hash_cache:
+        _hash_cache.move_to_end(stat_key)
+        return _hash_cache[stat_key]
+    with open(lc_path, 'rb') as f:
+        return cache_value(_hash_cache, stat_key, hashlib.sha1(f.read()).hexdigest(), MAX_CACHED_HASHES)
+
+FILTER_ALIASES = {'ztfg':'g', 'ztfr':'r', 'ztfi':'i', 'ztf_g':'g', 'ztf_r':'r', 'ztf_i':'i', 'zg':'g', 'zr':'r', 'zi':'i',
+                  'sdssu':'u', 'sdssg':'g', 'sdssr':'r', 'sdssi':'i', 'sdssz':'z', 'ps1::y':'y', 'ps1__y':'y'}
+ALERCE_FIDS = {1:'g', 2:'r', 3:'i'}
+
+def normalise_filters(filters):
+    '''
+    maps survey-specific filter names (e.g. ztfg, ZTF_g, sdssr) onto the nmma filter names (u,g,r,i,z,y,J,H,K)
+
+    Args:
+        filters (array-like): filter names
+
+    Returns:
+        filters (np.ndarray): normalised filter names (names without a known alias are returned unchanged)
+    '''
+    filters = np.asarray(filters).astype(str)
+    unique_filters, inverse = np.unique(filters, return_inverse=True) ## map each distinct name once
+    mapped = np.array([FILTER_ALIASES.get(filter.lower(), filter) for filter in unique_filters], dtype=str)
+    return mapped[inverse].reshape(filters.shape)
+
+def from_columns(mjd, filter, mag, mag_unc, content_hash, t=None):
+    '''
+    builds the canonical lightcurve from column arrays, sorted by time
+    '''
+    mjd = np.asarray(mjd, dtype=np.float64)
+    order = np.argsort(mjd, kind='stable')
+    t = mjd_to_isot(mjd) if t is None else np.asarray(t).astype(str)
+    return LightCurve(t[order], mjd[order], normalise_filters(filter)[order],
+                      np.asarray(mag, dtype=np.float64)[order], np.asarray(mag_unc, dtype=np.float64)[order], content_hash)
+
+def concatenate_chunks(chunks):
+    '''
+    concatenates per-chunk column dictionaries (as produced while streaming a file) into one dictionary of arrays
+    '''
+    chunks = list(chunks)
+    if len(chunks) == 0:
+        return {'mjd':np.array([]), 'filter':np.array([], dtype=str), 'mag':np.array([]), 'mag_unc':np.array([])}
+    return {key:np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0].keys()}
+
+
+## reader registry: name -> (sniff, read). sniff(header) receives the first few kB of the file and returns True if the
+## reader handles it; read(lc_path, content_hash, chunksize) returns a LightCurve. Readers are tried in registration order.
+READERS = {}
+
+def register_reader(name, sniff):
+    '''
+    decorator registering a lightcurve reader along with the function used to recognise its files
+
+    Args:
+        name (str): name of the format
+        sniff (function): takes the start of the file (str) and returns True if the file is in this format
+
+    Returns:
+        decorator (function): registers the decorated read function
+    '''
+    def decorator(read):
+        READERS[name] = (sniff, read)
+        return read
+    return decorator
+
+def get_csv_header(header):
+    '''retrieve the lowercase column names of a csv file from its first line'''
+    first_line = header.lstrip().split('\n')[0]
+    if ',' not in first_line or first_line[:1] in ['{', '[']: ## not a csv file (e.g. json)
+        return []
+    return [column.strip().strip('"').lower() for column in first_line.split(',')]
+
+def sniff_dat(header):
+    lines = [line for line in header.split('\n')[:-1] if line.strip()] or [header] ## last line may be truncated
+    fields = lines[0].split()
+    return len(fields) == 4 and ',' not in lines[0] and 'T' in fields[0] and fields[0][:4].isdigit()
+
+@register_reader('dat', sniff_dat)
+def read_dat(lc_path, content_hash, chunksize=100000):
+    '''
+    parses a .dat lightcurve file (space separated columns: isot time, filter, mag, mag_unc)
+    '''
+    import pandas as pd
+
+    def read_chunk(df):
+        t = df['t'].to_numpy(dtype=str)
+        return {'t':t, 'mjd':isot_to_mjd(t), 'filter':df['filter'].to_numpy(dtype=str), 'mag':df['mag'].to_numpy(), 'mag_unc':df['mag_unc'].to_numpy()}
+    reader = pd.read_csv(lc_path, sep=' ', header=None, names=['t', 'filter', 'mag', 'mag_unc'], chunksize=chunksize,
+                         dtype={'t':str, 'filter':str, 'mag':np.float64, 'mag_unc':np.float64})
+    columns = concatenate_chunks(read_chunk(df) for df in reader) ## mjd converted once per chunk, never per row
+    if len(columns['mjd']) == 0:
+        columns['t'] = np.array([], dtype=str)
+    ## the file order is kept (rather than sorting by time) so the lightcurve matches the file it was read from
+    return LightCurve(columns['t'], columns['mjd'], columns['filter'], columns['mag'], columns['mag_unc'], content_hash)
+
+def sniff_ztf_forced_csv(header):
+    first_line = header.lstrip().split('\n')[0].lower()
+    columns = get_csv_header(header)
+    return 'forcediffimflux' in re.split(r'[,\s]+', first_line) or (len(columns) >= 6 and columns[1] == 'jd')
+
+def get_table_layout(lc_path):
+    '''
+    retrieve the layout of a table that may start with # comment lines (as IPAC forced photometry does): the number of
+    lines before its data, its lowercase column names and its separator (commas, or whitespace as in IPAC output)
+    '''
+    with open(lc_path, 'r', errors='replace') as f:
+        num_skipped, line = 0, f.readline()
+        while line != '' and (line.strip() == '' or line.lstrip().startswith('#')):
+            num_skipped, line = num_skipped + 1, f.readline()
+        data_line = f.readline()
+    names = [name.strip('"') for name in re.split(r'[,\s]+', line.strip().lower())]
+    return num_skipped + 1, names, ',' if ',' in data_line else r'\s+'
+
+@register_reader('ztf_forced_csv', sniff_ztf_forced_csv)
+def read_ztf_forced_csv(lc_path, content_hash, chunksize=100000, snr_threshold=3.0):
+    '''
+    parses ZTF forced photometry files, either from the IPAC forced photometry service (fluxes, converted to magnitudes
+    with detections above snr_threshold and diffmaglim as upper limits otherwise; as csv, or as served, with # comment
+    lines and whitespace separated values) or in the layout handled by utils.tools.parse_csv (columns: index, jd, mag,
+    mag_unc, filter, limiting mag with mag = 99.0 for non-detections)
+    '''
+    import pandas as pd
+
+    def read_chunk(df):
+        df.columns = [column.strip().lower() for column in df.columns]
+        if 'forcediffimflux' in df.columns:
+            flux = pd.to_numeric(df['forcediffimflux'], errors='coerce').to_numpy(dtype=np.float64)
+            flux_unc = pd.to_numeric(df['forcediffimfluxunc'], errors='coerce').to_numpy(dtype=np.float64)
+            detected = (flux_unc > 0) & (flux / flux_unc > snr_threshold)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mag = np.where(detected, df['zpdiff'].to_numpy(dtype=np.float64) - 2.5 * np.log10(flux), df['diffmaglim'].to_numpy(dtype=np.float64))
+                mag_unc = np.where(detected, 1.0857 * flux_unc / flux, np.inf)
+            keep = np.isfinite(mag) ## e.g. null rows of epochs IPAC could not process
+            return {'mjd':jd_to_mjd(df['jd'])[keep], 'filter':df['filter'].to_numpy(dtype=str)[keep], 'mag':mag[keep], 'mag_unc':mag_unc[keep]}
+        mag, mag_unc = apply_upper_limits(df.iloc[:, 2], df.iloc[:, 3], df.iloc[:, 5])
+        return {'mjd':jd_to_mjd(df.iloc[:, 1]), 'filter':df.iloc[:, 4].to_numpy(dtype=str), 'mag':mag, 'mag_unc':mag_unc}
+    num_skipped, names, sep = get_table_layout(lc_path)
+    reader = pd.read_csv(lc_path, sep=sep, skiprows=num_skipped, header=None, names=names, chunksize=chunksize, comment='#', na_values=['null'])
+    columns = concatenate_chunks(read_chunk(df) for df in reader)
+    return from_columns(columns['mjd'], columns['filter'], columns['mag'], columns['mag_unc'], content_hash)
+
+def sniff_alerce_fritz_csv(header):
+    columns = get_csv_header(header)
+    return 'mjd' in columns and (('fid' in columns and 'magpsf' in columns) or ('filter' in columns and 'mag' in columns))
+
+def read_alerce_fritz_records(df):
+    '''
+    converts ALeRCE (mjd, fid, magpsf, sigmapsf, diffmaglim) or Fritz (mjd, filter, mag, magerr, limiting_mag) photometry
+    records to columns, using the limiting magnitude with an infinite uncertainty for non-detections (missing mag)
+    '''
+    import pandas as pd
+
+    df.columns = [column.strip().lower() for column in df.columns]
+    if 'fid' in df.columns:
+        filter = df['fid'].map(ALERCE_FIDS).fillna(df['fid'].astype(str)).to_numpy(dtype=str)
+        mag, mag_unc, limit = df['magpsf'], df['sigmapsf'], df.get('diffmaglim', pd.Series(np.nan, index=df.index))
+    else:
+        filter = df['filter'].to_numpy(dtype=str)
+        mag, mag_unc, limit = df['mag'], df['magerr'], df.get('limiting_mag', pd.Series(np.nan, index=df.index))
+    mag = pd.to_numeric(mag, errors='coerce').to_numpy(dtype=np.float64)
+    mag_unc = pd.to_numeric(mag_unc, errors='coerce').to_numpy(dtype=np.float64)
+    limit = pd.to_numeric(limit, errors='coerce').to_numpy(dtype=np.float64)
+    detected = np.isfinite(mag)
+    keep = detected | np.isfinite(limit) ## rows with neither a magnitude nor a limit carry no information
+    return {'mjd':df['mjd'].to_numpy(dtype=np.float64)[keep], 'filter':filter[keep],
+            'mag':np.where(detected, mag, limit)[keep], 'mag_unc':np.where(detected, mag_unc, np.inf)[keep]}
+
+@register_reader('alerce_fritz_csv', sniff_alerce_fritz_csv)
+def read_alerce_fritz_csv(lc_path, content_hash, chunksize=100000):
+    '''
+    parses ALeRCE or Fritz (SkyPortal) photometry csv exports
+    '''
+    import pandas as pd
+
+    columns = concatenate_chunks(read_alerce_fritz_records(df) for df in pd.read_csv(lc_path, chunksize=chunksize, comment='#'))
+    return from_columns(columns['mjd'], columns['filter'], columns['mag'], columns['mag_unc'], content_hash)
+
+def sniff_json(header):
+    return header.lstrip()[:1] in ['{', '[']
+
+@register_reader('json', sniff_json)
+def read_json(lc_path, content_hash, chunksize=None):
+    '''
+    parses photometry json, either a list of records or the Fritz api response ({"data": [...]} or {"data": {"photometry": [...]}})
+    with ALeRCE or Fritz column names
+    '''
+    import pandas as pd
+
+    with open(lc_path, 'r') as f:
+        records = json.load(f)
+    while isinstance(records, dict):
+        records = records.get('data', records.get('photometry', records.get('detections')))
+    assert isinstance(records, list), 'No photometry records found in {}'.format(lc_path)
+    columns = read_alerce_fritz_records(pd.DataFrame.from_records(records))
+    return from_columns(columns['mjd'], columns['filter'], columns['mag'], columns['mag_unc'], content_hash)
+
+def detect_format(lc_path, num_bytes=4096):
+    '''
+    determines the format of a lightcurve file by sniffing its first few kB (after any leading # comment lines) with
+    each registered reader
+
+    Args:
+        lc_path (str): path to lightcurve file
+        num_bytes (int): number of bytes to sniff (default: 4096)
+
+    Returns:
+        format_name (str): name of the reader for the file
+
+    Raises:
+        ValueError: if no reader recognises the file
+    '''
+    with open(lc_path, 'r', errors='replace') as f:
+        line = f.readline()
+        while line.lstrip().startswith('#'): ## e.g. the request details heading IPAC forced photometry
+            line = f.readline()
+        header = line + f.read(num_bytes)
+    for format_name, (sniff, _) in READERS.items():
+        if sniff(header):
+            return format_name
+    raise ValueError('Unrecognised lightcurve format for {}'.format(lc_path))
+
+def load_lightcurve(lc_path):
+    '''
+    loads a lightcurve file in any registered format, parsing and time-converting it at most once per content hash (in
+    memory, and on disk if a cache directory has been set with set_lightcurve_cache_directory)
+
+    Args:
+        lc_path (str): path to lightcurve file
+
+    Returns:
+        lightcurve (LightCurve): columnar lightcurve
+    '''
+    content_hash = get_content_hash(lc_path)
+    if content_hash in _lightcurve_cache:
+        _lightcurve_cache.move_to_end(content_hash)
+        return _lightcurve_cache[content_hash]
+
+    sidecar_path = None if _cache_directory is None else os.path.join(_cache_directory, content_hash + '.npz')
+    if sidecar_path is not None and os.path.exists(sidecar_path):
+        with np.load(sidecar_path) as sidecar:
+            lightcurve = LightCurve(sidecar['t'], sidecar['mjd'], sidecar['filter'], sidecar['mag'], sidecar['mag_unc'], content_hash)
+    else:
+        _, read = READERS[detect_format(lc_path)]
+        lightcurve = read(lc_path, content_hash)
+        if sidecar_path is not None:
+            tmp_path = sidecar_path + '.{}.tmp.npz'.format(os.getpid())
+            np.savez(tmp_path, t=lightcurve.t, mjd=lightcurve.mjd, filter=lightcurve.filter, mag=lightcurve.mag, mag_unc=lightcurve.mag_unc)
+            os.replace(tmp_path, sidecar_path)
+
+    return cache_value(_lightcurve_cache, content_hash, lightcurve, MAX_CACHED_LIGHTCURVES)
+
+def convert_to_dat(lc_path, outdir):
+    '''
+    converts a lightcurve file in any registered format to a .dat file in the format desired by NMMA (.dat files are returned as is)
+
+    Args:
+        lc_path (str): path to lightcurve file
+        outdir (str): directory to write the converted file to
+
+    Returns:
+        dat_path (str): path to .dat file
+    '''
+    if detect_format(lc_path) == 'dat':
+        return lc_path
+    lightcurve = load_lightcurve(lc_path)
+    os.makedirs(outdir, exist_ok=True)
+    dat_path = os.path.join(outdir, os.path.basename(lc_path).split('.')[0] + '.dat')
+    write_dat(dat_path, lightcurve.t, lightcurve.filter, lightcurve.mag, lightcurve.mag_unc)
+    return dat_path
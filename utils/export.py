@@ -0,0 +1,187 @@
+'''
+export of post-processed fits: a columnar file per object (parquet or arrow ipc, pruned to the observed filters), an
+optional csv for humans, and a single appendable catalog with one row per fit across all objects
+'''
+import os
+import time
+import fcntl
+
+import numpy as np
+import pandas as pd
+
+from utils.tools import current_time
+from utils.files import get_settings, atomic_write, save_combined_dataframes
+
+try: ## optional, needed for the columnar formats (otherwise only the csv is written)
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+## column order and types of the per-object export, posterior band columns (mag_q<percentile>) are inserted after mag_unc
+## (stage is 'full', or 'triage' for the provisional result of a triage fit, see utils.triage, and null for the data)
+COMBINED_SCHEMA = {
+    'object':'string', 'model':'string', 'alias':'string', 'stage':'string', 'filter':'string',
+    't':'float64', 'mag':'float64', 'mag_unc':'float64',
+    'log_likelihood':'float64', 'log_evidence':'float64', 'log_evidence_err':'float64', 'log_bayes_factor':'float64',
+}
+CATALOG_COLUMNS = ['object', 'model', 'alias', 'stage', 'log_evidence', 'log_evidence_err', 'log_bayes_factor', 'log_likelihood',
+                   'num_detections', 'filters', 'combined_file', 'updated']
+EXPORT_FORMATS = {'parquet':'.parquet', 'feather':'.arrow'}
+
+
+def get_export_settings(settings):
+    '''
+    retrieve the export settings (settings['export']) with defaults filled in
+    '''
+    export_settings = {'format':'parquet', 'csv':True, 'catalog':'fit_catalog.csv'}
+    export_settings.update(settings.get('export', {}))
+    return export_settings
+
+def prune_to_observed_filters(combined_df):
+    '''
+    drops model rows in filters without detections in the data (and rows of models that were not fit)
+
+    Args:
+        combined_df (pandas dataframe): dataframe returned by plotting.combine_dataframes
+
+    Returns:
+        pruned_df (pandas dataframe): dataframe with only the data and the model curves in observed filters
+    '''
+    is_data = combined_df['model'] == 'data'
+    observed_filters = combined_df.loc[is_data & (combined_df['mag_unc'] != np.inf), 'filter'].unique()
+    return combined_df[is_data | combined_df['filter'].isin(observed_filters)].reset_index(drop=True)
+
+def apply_combined_schema(combined_df, object_name):
+    '''
+    orders and types the columns of a combined dataframe following COMBINED_SCHEMA, adding missing columns as nulls
+
+    Args:
+        combined_df (pandas dataframe): pruned combined dataframe
+        object_name (str): name of object
+
+    Returns:
+        export_df (pandas dataframe): dataframe with the export schema
+    '''
+    export_df = combined_df.assign(object=object_name)
+    band_columns = sorted([column for column in export_df.columns if column.startswith('mag_q')], key=lambda column: float(column[len('mag_q'):]))
+    columns = list(COMBINED_SCHEMA.keys())
+    columns = columns[:columns.index('mag_unc') + 1] + band_columns + columns[columns.index('mag_unc') + 1:]
+    for column in columns:
+        if column not in export_df.columns:
+            export_df[column] = np.nan
+    return export_df[columns].astype({column:COMBINED_SCHEMA.get(column, 'float64') for column in columns})
+
+def write_columnar(export_df, output_file, format='parquet'):
+    '''
+    atomically writes a dataframe as parquet or arrow ipc (feather)
+    '''
+    with atomic_write(output_file) as tmp_file:
+        if format == 'parquet':
+            export_df.to_parquet(tmp_file, index=False)
+        else:
+            export_df.to_feather(tmp_file)
+    return output_file
+
+def get_catalog_rows(export_df, combined_file):
+    '''
+    summarises each fit in an exported dataframe as a catalog row (evidences and the data it was fit to)
+
+    Args:
+        export_df (pandas dataframe): dataframe returned by apply_combined_schema
+        combined_file (str): path to the exported file of the object
+
+    Returns:
+        catalog_df (pandas dataframe): one row per model with columns CATALOG_COLUMNS
+    '''
+    data_df = export_df[export_df['model'] == 'data']
+    detections = data_df[data_df['mag_unc'] != np.inf]
+    catalog_df = export_df[export_df['model'] != 'data'].groupby('model', sort=False).first().reset_index()
+    catalog_df['num_detections'] = len(detections)
+    catalog_df['filters'] = ','.join(sorted(detections['filter'].unique()))
+    catalog_df['combined_file'] = combined_file
+    catalog_df['updated'] = time.time()
+    return catalog_df[CATALOG_COLUMNS]
+
+def append_to_catalog(catalog_file, catalog_df):
+    '''
+    appends rows to the catalog csv under an exclusive lock, writing the header if the catalog is new; refits of an
+    object are appended as well, so readers should keep the last row of each (object, model) (see read_catalog). A
+    catalog written with other columns (e.g. before fits had a stage) is rewritten with the columns of the new rows first.
+
+    Args:
+        catalog_file (str): path to catalog
+        catalog_df (pandas dataframe): rows returned by get_catalog_rows
+
+    Returns:
+        None
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(catalog_file)), exist_ok=True)
+    with open(catalog_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX) ## post-processing workers append concurrently
+        try:
+            f.seek(0)
+            header = f.readline().strip()
+            if header and header != ','.join(catalog_df.columns):
+                previous_df = pd.read_csv(catalog_file).reindex(columns=catalog_df.columns)
+                if 'stage' in previous_df.columns:
+                    previous_df['stage'] = previous_df['stage'].fillna('full')
+                f.truncate(0)
+                previous_df.to_csv(f, index=False)
+            f.seek(0, os.SEEK_END)
+            catalog_df.to_csv(f, header=f.tell() == 0, index=False)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def read_catalog(catalog_file):
+    '''
+    reads the catalog, keeping only the latest row of each fit
+
+    Args:
+        catalog_file (str): path to catalog
+
+    Returns:
+        catalog_df (pandas dataframe): catalog with columns CATALOG_COLUMNS
+    '''
+    if not os.path.exists(catalog_file):
+        return pd.DataFrame(columns=CATALOG_COLUMNS)
+    catalog_df = pd.read_csv(catalog_file)
+    return catalog_df.drop_duplicates(['object', 'model'], keep='last').reset_index(drop=True)
+
+def export_combined_fits(data_file, settings_file, combined_df=None, sample_times=np.linspace(0.01, 7, 100)):
+    '''
+    exports the combined data and best fit lightcurves of an object: <fit_directory>/<object>/combined_fits.<parquet|arrow>
+    (csv if pyarrow is not installed), an optional combined_fits.csv, and a row per model in the catalog
+
+    Args:
+        data_file (str): path to object lightcurve
+        settings_file (str): path to settings file
+        combined_df (pandas dataframe): already combined dataframe (default: None, combined here)
+        sample_times (array): array of times to sample the lightcurve at (default: np.linspace(0.01, 7, 100))
+
+    Returns:
+        output_files (list): paths to the exported files
+    '''
+    if combined_df is None:
+        from utils.plotting import combine_dataframes
+        combined_df = combine_dataframes(data_file, settings_file, sample_times=sample_times)
+    _, settings_dict = get_settings(settings_file)
+    export_settings = get_export_settings(settings_dict)
+    object_name = os.path.basename(data_file).split('.')[0]
+    export_df = apply_combined_schema(prune_to_observed_filters(combined_df), object_name)
+
+    output_files = []
+    format = export_settings['format']
+    if format in EXPORT_FORMATS and pyarrow is None:
+        print('[{}] pyarrow is not installed, exporting {} as csv only'.format(current_time(), object_name))
+    elif format in EXPORT_FORMATS:
+        output_file = os.path.join(settings_dict['fit_directory'], object_name, 'combined_fits' + EXPORT_FORMATS[format])
+        output_files.append(write_columnar(export_df, output_file, format=format))
+    if export_settings['csv'] or len(output_files) == 0:
+        output_files.append(save_combined_dataframes(data_file, settings_file, combined_df=export_df))
+
+    if export_settings['catalog']:
+        catalog_file = os.path.join(settings_dict['fit_directory'], export_settings['catalog'])
+        combined_file = os.path.relpath(output_files[0], settings_dict['fit_directory'])
+        append_to_catalog(catalog_file, get_catalog_rows(export_df, combined_file))
+    return output_files
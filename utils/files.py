@@ -4,16 +4,15 @@ checks for existence of files and retreiving files in various capacities
 import os
 import json
 import glob
+import hashlib
+import fcntl
+import time
+from contextlib import contextmanager
 
 import numpy as np
-import pandas as pd
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import cm
-from astropy.time import Time
 
 from utils.tools import current_time
-from utils.plotting import combine_dataframes
+from utils.conversion import load_lightcurve
 
 def get_settings(settings_path='./settings.json'):
     '''
@@ -34,67 +33,205 @@ def get_settings(settings_path='./settings.json'):
     
     return models, settings
 
-def scan_objects(lc_path, fits_path):
+def get_state_path(settings, name=None):
     '''
-    scans directory for lightcurves and compares against the list of directories in the fits folder
+    retrieve the path to the local state directory (scan index, locks, etc.), creating it if needed
+    
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        name (str): name of file within the state directory (default: None, returns the directory itself)
+    
+    Returns:
+        state_path (str): path to the state directory or to the named file within it
+    '''
+    state_directory = settings.get('state_directory', os.path.join(settings['repo_directory'], '.state'))
+    os.makedirs(state_directory, exist_ok=True)
+    return state_directory if name is None else os.path.join(state_directory, name)
+
+@contextmanager
+def scan_lock(settings):
+    '''
+    exclusive lock around scanning and job submission, shared by cron runs and the scanner daemon so objects are never submitted twice
+    
+    Args:
+        settings (dict): dictionary of settings from settings.json
+    
+    Yields:
+        None (lock is held for the duration of the with block)
+    '''
+    with open(get_state_path(settings, 'scan.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def hash_file(file_path, chunk_size=1<<20):
+    '''
+    computes the sha1 hash of a file's contents
+    
+    Args:
+        file_path (str): path to file
+        chunk_size (int): number of bytes to read at a time (default: 1 MiB)
+    
+    Returns:
+        hexdigest (str): sha1 hash of the file contents
+    '''
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def load_scan_index(index_path):
+    '''
+    loads the scan index, a JSON-lines manifest with one record per object (later records for the same object take precedence)
+    
+    Args:
+        index_path (str): path to scan index file
+    
+    Returns:
+        index (dict): dictionary of object name to record (keys: object, file, mtime, size, hash)
+    '''
+    index = {}
+    if not os.path.exists(index_path):
+        return index
+    with open(index_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError: ## partially written line from an interrupted scan
+                continue
+            index[record['object']] = record
+    return index
+
+def update_scan_index(index_path, index, new_records, compaction_ratio=2):
+    '''
+    appends new records to the scan index, rewriting it from scratch if it has grown too much larger than the number of objects
+    
+    Args:
+        index_path (str): path to scan index file
+        index (dict): current index (already updated with new_records)
+        new_records (list): list of records to append
+        compaction_ratio (int): rewrite the file once it holds this many lines per indexed object (default: 2)
+    
+    Returns:
+        None
+    '''
+    if len(new_records) == 0:
+        return
+    with open(index_path, 'a') as f:
+        f.write(''.join(json.dumps(record) + '\n' for record in new_records))
+    with open(index_path, 'r') as f:
+        num_lines = sum(1 for _ in f)
+    if num_lines > compaction_ratio * max(len(index), 1):
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in index.values()))
+        os.replace(tmp_path, index_path)
+
+def scan_objects(lc_path, fits_path, index_path=None, settle_time=0, pending=None):
+    '''
+    scans directory for new or updated lightcurves using a persistent scan index keyed by object name
+    
+    Each candidate file is stat'ed and compared against the mtime and size stored in the index; only new or changed
+    files are hashed. A changed file whose contents hash differs from the indexed one is re-queued for fitting. Objects
+    missing from the index (e.g. the first scan with an existing fits folder) are only queued if they have no folder in the
+    fits directory.
     
     Args:
         lc_path (str): path to lightcurve directory
         fits_path (str): path to fits directory
+        index_path (str): path to scan index file (default: None, uses .scan_index.jsonl in the fits directory's parent)
+        settle_time (float): skip files modified less than this many seconds ago, as they may still be being written (default: 0)
+        pending (dict): if given, the index records of the queued objects are put in this dictionary (keyed by file name)
+            to be committed with commit_scan_records once their fits have been submitted, so an object whose submission
+            fails (or is interrupted) is queued again by the next scan (default: None, written right away)
         
     Returns:
-        new_objects (list): list of new objects found in lightcurve directory that are not in fits directory
-        Note: this does not include the full path, just the object name
-    
-    To Do: May be better to rework so it uses gitpython to check for newly added objects rather than checking for folders
+        new_objects (list): list of new or updated objects found in lightcurve directory (False if none are found)
+        Note: this does not include the full path, just the file name (one file per object, .dat preferred)
     '''
-    objects = os.listdir(lc_path) ## list of objects in lightcurve directory
-    object_names = np.array([object.split('.')[0] for object in objects]) ## list of object names in lightcurve directory
-    object_names = np.unique(object_names) ## unique object names in lightcurve directory (accounts for file conversion)
+    if index_path is None:
+        index_path = os.path.join(os.path.dirname(os.path.abspath(fits_path)), '.scan_index.jsonl')
+    index = load_scan_index(index_path)
     
+    candidates = {} ## object name -> directory entry, one per object (accounts for file conversion)
+    for entry in os.scandir(lc_path):
+        if entry.name.startswith('.') or not entry.is_file():
+            continue
+        object_name = entry.name.split('.')[0]
+        if object_name not in candidates or entry.name.endswith('.dat'):
+            candidates[object_name] = entry
     
-    fits_objects = os.listdir(fits_path) ## list of objects in fits directory (will be folders)
+    fits_objects = None ## only listed if an object is missing from the index
+    new_objects, new_records = [], []
+    now = time.time()
+    for object_name, entry in sorted(candidates.items()):
+        stat = entry.stat()
+        if now - stat.st_mtime < settle_time:
+            continue ## possibly a partial write, picked up once the file has settled
+        record = index.get(object_name)
+        if record is not None and record['file'] == entry.name and record['mtime'] == stat.st_mtime and record['size'] == stat.st_size:
+            continue ## unchanged since last scan
+        file_hash = hash_file(entry.path)
+        if record is None:
+            if fits_objects is None:
+                fits_objects = set(os.listdir(fits_path)) if os.path.exists(fits_path) else set()
+            queue = object_name not in fits_objects
+        else:
+            queue = record['hash'] != file_hash
+        if queue:
+            new_objects.append(entry.name)
+        new_record = {'object':object_name, 'file':entry.name, 'mtime':stat.st_mtime, 'size':stat.st_size, 'hash':file_hash}
+        if queue and pending is not None: ## a record without a hash is written in its place, so the object is queued again until committed
+            pending[entry.name] = new_record
+            new_record = dict(new_record, mtime=None, size=None, hash=None)
+        index[object_name] = new_record
+        new_records.append(new_record)
+    update_scan_index(index_path, index, new_records)
     
-    new_objects_idx = [i for i, object in enumerate(object_names) if object not in fits_objects] ## indices of new objects
-    new_objects = [objects[i] for i in new_objects_idx] ## list of new objects (including the extension)
-    ## potential concern: could be a problem if there are multiple files for the same object (ie if the dat file has been made prior to this being run)
     if len(new_objects) > 0:
-        print('[{}] New objects found: {}'.format(new_objects,current_time()))
+        print('[{}] New objects found: {}'.format(current_time(), new_objects))
         return new_objects
     else:
         print('[{}] No new objects found'.format(current_time()))
         return False
     
-def check_correct_file_format(lc_path):
+def commit_scan_records(index_path, records):
+    '''
+    writes index records held back by scan_objects (see its pending argument) to the scan index
+    
+    Args:
+        index_path (str): path to scan index file
+        records (list): list of index records
+    
+    Returns:
+        None
+    '''
+    index = load_scan_index(index_path)
+    for record in records:
+        index[record['object']] = record
+    update_scan_index(index_path, index, records)
+    
+def check_correct_file_format(lc_path, models=None, settings=None):
     '''
     checks that the file is in the correct format. Anticipated format is a .dat file with the following columns: [t, filter, mag, mag_unc] where t is in isot format and filters are part of the standard filter set in nmma (u,g,r,i,z,y,J,H,K)
+    (or any other registered lightcurve format, see utils.validation.validate_lightcurve for the full set of checks)
     
     Args:
         lc_path (str): path to lightcurve file
+        models (dict): dictionary of models from settings.json, to check their tmin/tmax windows (default: None)
+        settings (dict): dictionary of settings from settings.json (default: None)
     
     Returns:
         True if file is in correct format, False otherwise
-    
-    To-Do:
-        - make sure it actually works
-        - implement into scanner
     '''
-    correct_columns = ['t', 'filter', 'mag', 'mag_unc']
-    correct_filters = ['u','g','r','i','z','y','J','H','K']
-    
-    df = pd.read_csv(lc_path, sep=' ', header=None, names=correct_columns)
-    detected_filters = np.unique(df['filter'])
-    try: ## tries to convert t to isot format. If broken, not in correct format
-        Time(pd.to_datetime(df['t']), format='isot')
-    except:
-        return False
-    if df.shape[1] != len(correct_columns): ## check for correct number of columns
-        return False
-    elif any(filter not in correct_filters for filter in detected_filters): ## check for correct filters
-        return False
-    else: ## if all checks pass, return True
-        return True
-
+    from utils.validation import validate_lightcurve ## imported here to avoid a circular import with utils.validation
+    return validate_lightcurve(lc_path, models=models, settings=settings)['valid']
     
 def get_lightcurve_data(data_file, tmax=False,remove_nondetections=False):
     '''
@@ -108,10 +245,12 @@ def get_lightcurve_data(data_file, tmax=False,remove_nondetections=False):
     Returns:
         df (pandas dataframe): dataframe containing lightcurve data (columns: t, filter, mag, mag_unc, model, alias)
     '''
-    df = pd.read_csv(data_file, sep=' ', header=None, names=['t', 'filter', 'mag', 'mag_unc'])
+    import pandas as pd
+    
+    lightcurve = load_lightcurve(data_file) ## parsed and converted to mjd once per file contents
     object_name = os.path.basename(data_file).split('.')[0]
     
-    df['t'] = Time(pd.to_datetime(df['t'])).mjd ## convert to mjd
+    df = pd.DataFrame({'t':lightcurve.mjd, 'filter':lightcurve.filter, 'mag':lightcurve.mag, 'mag_unc':lightcurve.mag_unc})
     ## would it break the nmma fit to include a column with the original mjd values?
     df['t'] = df['t'] - df['t'].min() ## set t=0 to first observation
     df['model'] = 'data'
@@ -121,49 +260,29 @@ def get_lightcurve_data(data_file, tmax=False,remove_nondetections=False):
     df = df[df['mag_unc'] != np.inf] if remove_nondetections else df
     return df
 
-def check_fit_completion(objects, models, settings, elapsed_time):
+@contextmanager
+def atomic_write(output_file):
     '''
-    Checks for completion status of fits by looking for results.json files in the directory of the object
+    context manager yielding a temporary path to write to, which is renamed to output_file once the block completes, so
+    readers (e.g. git) never see a partially written file
     
     Args:
-        objects (list): path to directories of objects
-        models (dict): dictionary of models and their settings
-        settings (dict): settings dictionary from settings.json
-        elapsed_time (float): time elapsed since start of fit in hours
-        
-    Returns:
-        boolean: True if all fits are complete or hit timeout, False otherwise
+        output_file (str): path to final file
     
-    To-Do:
-        - add an argument for the number of anticipated fits to account for any failures in job creation and/or submission (would be a try/except in the scanner.py file)
-    '''
-    timeout = settings['timeout'] ## timeout in hours (default of 8 hours)
-    object_completed_jobs = {object:[] for object in objects} ## dictionary of objects and their completed jobs
-    object_uncompleted_jobs = {object:[] for object in objects} ## dictionary of objects and their uncompleted jobs
-    for object in objects:
-        for model, model_settings in models.items():
-            object_directory = os.path.join(settings['fit_directory'], object, model)
-            results_file = os.path.join(object_directory, '*_result.json')
-            if os.path.exists(results_file):
-                object_completed_jobs[object].append(model)
-            elif not os.path.exists(results_file):
-                object_uncompleted_jobs[object].append(model)
-            else:
-                continue
-    num_completed = sum([len(object_completed_jobs[object]) for object in object_completed_jobs.keys()])
-    num_fits = len(models.keys()) * len(objects)
-    #print('[{}] {} of {} fits completed'.format(current_time(), num_completed, num_fits))
-    if num_completed == num_fits:
-        print('[{}] All fits completed'.format(current_time()))
-        return True
-    elif num_completed < num_fits:
-        print('[{}] {} of {} fits remaining ({:.2f} hours elapsed)'.format(current_time(), num_fits - num_completed, num_fits, elapsed_time))
-        return False
-    elif elapsed_time > timeout:
-        print('[{}] Timeout reached'.format(current_time()))
-        return True
-    
-def save_combined_dataframes(data_file, settings_file, sample_times=np.linspace(0.01, 7, 100)):
+    Yields:
+        tmp_file (str): path to write to (same directory and extension as output_file)
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    root, ext = os.path.splitext(output_file)
+    tmp_file = '{}.{}.tmp{}'.format(root, os.getpid(), ext)
+    try:
+        yield tmp_file
+        os.replace(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def save_combined_dataframes(data_file, settings_file, sample_times=np.linspace(0.01, 7, 100), combined_df=None):
     '''
     takes the combined lightcurve dataframe and saves it to a csv file located in the lightcurve fit directory
     
@@ -171,25 +290,38 @@ def save_combined_dataframes(data_file, settings_file, sample_times=np.linspace(
         data_file (str): path to dat file
         settings_file (str): path to settings file
         sample_times (array): array of times to sample the lightcurve at (default: np.linspace(0.01, 7, 100))
+        combined_df (pandas dataframe): already combined dataframe (default: None, combined here)
     
     Returns:
-        None
+        output_file (str): path to saved csv file
+    
+    See utils.export.export_combined_fits for the columnar export pruned to the observed filters, which calls this for the csv.
     
     To-Do:
         - add option to save to different directory/file
-        - add option to save to different file format
-        - Currently, I believe it will save all filters to the csv, could cut down on file size by only saving the filters that are observed in the data
     '''
-    combined_df = combine_dataframes(data_file, settings_file, sample_times=sample_times)
+    if combined_df is None:
+        from utils.plotting import combine_dataframes ## imported here to avoid a circular import with utils.plotting
+        combined_df = combine_dataframes(data_file, settings_file, sample_times=sample_times)
+    _, settings_dict = get_settings(settings_file)
     object_name = os.path.basename(data_file).split('.')[0]
-    output_file = os.path.join(settings_file['fit_directory'],object_name, 'combined_fits.csv')
-    os.makedirs(os.path.dirname(output_file), exist_ok=True) ## just to be safe
+    output_file = os.path.join(settings_dict['fit_directory'],object_name, 'combined_fits.csv')
     
-    combined_df.to_csv(output_file, index=False)
+    with atomic_write(output_file) as tmp_file:
+        combined_df.to_csv(tmp_file, index=False)
+    return output_file
+
+def get_result_stage(result_file):
+    '''
+    retrieve the fitting stage of a result file: 'triage' for the provisional result of a triage fit (kept in a triage
+    directory, see utils.triage), 'full' otherwise
+    '''
+    return 'triage' if os.path.basename(os.path.dirname(os.path.abspath(result_file))) == 'triage' else 'full'
 
 def get_results_json_path(settings, object, model):
     '''
-    retreive the path to the results.json file from a completed fit
+    retreive the path to the results.json file from a completed fit (the triage fit if the model has no full fit, see
+    get_result_stage to tell them apart)
     
     Args:
         settings (dict): dictionary of settings from settings.json
@@ -199,11 +331,11 @@ def get_results_json_path(settings, object, model):
     Returns:
         results_json_path (str): path to results.json file
     '''
-    results_json_path = os.path.join(settings['fit_directory'], object, model['model'], '*result.json')
+    results_json_path = os.path.join(settings['fit_directory'], object, model['name'], '*result.json')
     results_json_path_search = glob.glob(results_json_path)
-    if results_json_path_search == 1:
-        return results_json_path_search[0]
-    elif results_json_path_search == 0:
-        print('[{}] No results.json file found for {} {}'.format(current_time(), object, model['model']))
+    if len(results_json_path_search) == 0: ## fall back on the provisional result of a triage fit (see utils.triage)
+        results_json_path_search = glob.glob(os.path.join(settings['fit_directory'], object, model['name'], 'triage', '*result.json'))
+    if len(results_json_path_search) == 0:
+        print('[{}] No results.json file found for {} {}'.format(current_time(), object, model['name']))
         return None
-    return results_json_path
\ No newline at end of file
+    return sorted(results_json_path_search)[-1]
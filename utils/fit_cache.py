@@ -0,0 +1,156 @@
+'''
+content-addressed cache of completed fits, so an object whose lightcurve and model configuration have already been fit
+(e.g. the same data uploaded under a new name) reuses that fit instead of running nested sampling again
+
+Fits are keyed by a hash of the normalised lightcurve (sorted, with times and magnitudes rounded so the same data in
+another format gives the same key), the contents of the prior file, the model settings and the settings passed to the
+sampler. Entries are small json files in <state_directory>/fit_cache pointing at the result file of the fit.
+'''
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import numpy as np
+
+from utils.tools import current_time
+from utils.files import get_state_path
+from utils.conversion import load_lightcurve
+from utils.results import get_prior_volume_path
+
+## model keys that do not affect the fit (job resources and plotting)
+IGNORED_MODEL_KEYS = ['job', 'color']
+## settings passed to light_curve_analysis or used to build its arguments (the nlive chosen by the budget is in the model)
+FIT_SETTINGS = ['svd_path', 'error_budget', 'Ebv_max', 'fit_trigger_time', 'trigger_time_heuristic', 't0']
+
+
+def hash_lightcurve(lc_path):
+    '''
+    hashes the normalised contents of a lightcurve: points sorted by time and filter, times rounded to 1e-5 days
+    (about a second) and magnitudes to 1e-4, so the same photometry hashes the same whatever its file format or order
+
+    Args:
+        lc_path (str): path to object lightcurve
+
+    Returns:
+        hexdigest (str): sha1 hash of the normalised lightcurve
+    '''
+    lightcurve = load_lightcurve(lc_path)
+    mjd = np.round(lightcurve.mjd, 5)
+    order = np.lexsort((lightcurve.filter, mjd))
+    sha = hashlib.sha1()
+    sha.update(mjd[order].tobytes())
+    sha.update('\n'.join(lightcurve.filter[order]).encode())
+    sha.update(np.round(lightcurve.mag[order], 4).tobytes())
+    sha.update(np.round(lightcurve.mag_unc[order], 4).tobytes())
+    return sha.hexdigest()
+
+def get_fit_key(object, model, settings):
+    '''
+    retrieve the cache key of a fit of an object to a model
+
+    Args:
+        object (str): path to object lightcurve
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        fit_key (str): sha1 hash of the lightcurve, prior, model settings and sampler settings
+    '''
+    sha = hashlib.sha1()
+    sha.update(hash_lightcurve(object).encode())
+    with open(model['prior'], 'rb') as f:
+        sha.update(f.read())
+    sha.update(json.dumps({key:value for key, value in model.items() if key not in IGNORED_MODEL_KEYS}, sort_keys=True).encode())
+    sha.update(json.dumps({key:settings.get(key) for key in FIT_SETTINGS}, sort_keys=True).encode())
+    return sha.hexdigest()
+
+def get_cache_entry_path(settings, fit_key):
+    cache_directory = get_state_path(settings, 'fit_cache')
+    os.makedirs(cache_directory, exist_ok=True)
+    return os.path.join(cache_directory, fit_key + '.json')
+
+def lookup_fit(settings, fit_key):
+    '''
+    retrieve the result file of a cached fit
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        fit_key (str): key returned by get_fit_key
+
+    Returns:
+        result_file (str): path to result file (None if the fit is not cached or its result file no longer exists)
+    '''
+    entry_path = get_cache_entry_path(settings, fit_key)
+    if not os.path.exists(entry_path):
+        return None
+    with open(entry_path, 'r') as f:
+        result_file = json.load(f)['result_file']
+    return result_file if os.path.exists(result_file) else None
+
+def store_fit(settings, fit_key, object, model, result_file):
+    '''
+    adds a completed fit to the cache (called by the tracker when a fit finishes)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        fit_key (str): key returned by get_fit_key when the fit was submitted
+        object (str): name of object
+        model (str): name of model
+        result_file (str): path to result file
+
+    Returns:
+        None
+    '''
+    entry_path = get_cache_entry_path(settings, fit_key)
+    tmp_path = entry_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'object':object, 'model':model, 'result_file':os.path.abspath(result_file), 'created':time.time()}, f)
+    os.replace(tmp_path, entry_path)
+
+def snapshot_lightcurve(settings, lc_path):
+    '''
+    keeps a copy of a lightcurve as it was fit, in <state_directory>/snapshots keyed by its normalised hash, so a later
+    version of the object can be compared against it (see utils.refit)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        lc_path (str): path to object lightcurve
+
+    Returns:
+        data_hash (str): hash of the lightcurve (see hash_lightcurve)
+        snapshot_path (str): path to the snapshot
+    '''
+    data_hash = hash_lightcurve(lc_path)
+    snapshot_directory = get_state_path(settings, 'snapshots')
+    os.makedirs(snapshot_directory, exist_ok=True)
+    snapshot_path = os.path.join(snapshot_directory, data_hash + os.path.splitext(lc_path)[1])
+    if not os.path.exists(snapshot_path):
+        shutil.copyfile(lc_path, snapshot_path + '.tmp')
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+    return data_hash, snapshot_path
+
+def reuse_fit(result_file, new_result_file):
+    '''
+    copies the result file of a cached fit into the output directory of a new fit, where the tracker picks it up as a
+    completed fit (copied rather than linked so its modification time is after the submission), along with the prior
+    volume correction of a warm-start refit so the reused evidence matches the cached one
+
+    Args:
+        result_file (str): path to cached result file
+        new_result_file (str): path to result file of the new fit
+
+    Returns:
+        new_result_file (str): path to copied result file
+    '''
+    if os.path.abspath(new_result_file) != os.path.abspath(result_file):
+        if os.path.exists(get_prior_volume_path(result_file)):
+            shutil.copyfile(get_prior_volume_path(result_file), get_prior_volume_path(new_result_file))
+        elif os.path.exists(get_prior_volume_path(new_result_file)): ## left by an earlier warm-start fit in the same directory
+            os.remove(get_prior_volume_path(new_result_file))
+        shutil.copyfile(result_file, new_result_file)
+    else: ## refit of an unchanged object in place
+        os.utime(new_result_file)
+    print('[{}] Reused cached fit {}'.format(current_time(), result_file))
+    return new_result_file
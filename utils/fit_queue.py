@@ -0,0 +1,396 @@
+'''
+persistent priority queue of fits in front of the execution backend, so a fresh, fast-evolving transient is not stuck
+behind a batch of archival objects
+
+Fits are kept in a sqlite database in the state directory and submitted to the backend in order of priority, computed
+at each dispatch from the recency of the last detection, the peak brightness and rise rate of the lightcurve, and a
+priority assigned by the user (see fit_queue.py). Concurrent in-flight fits can be capped in total, per model and per
+user (the allocation a fit is charged to), and the fits of users with more fits in flight are ranked lower (fair share).
+With preemption enabled, a queued fit blocked by a cap can cancel a lower priority fit that is still pending in slurm,
+which goes back to the queue.
+'''
+import os
+import json
+import time
+import sqlite3
+import subprocess
+from contextlib import closing
+
+import numpy as np
+
+from utils.tools import current_time
+from utils.files import get_state_path
+from utils.conversion import load_lightcurve
+from utils.fitting import get_backend, get_fit_outdir, get_object_name, get_scheduler_command
+from utils.tracking import load_fit_states, save_fit_states, ingest_submissions, mark_queued, fit_key, PENDING, RUNNING, TERMINAL_STATES
+
+QUEUE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS queue (
+    object TEXT NOT NULL,
+    model TEXT NOT NULL,
+    data TEXT NOT NULL,
+    model_settings TEXT NOT NULL,
+    user TEXT NOT NULL,
+    user_priority REAL NOT NULL DEFAULT 0,
+    last_detection REAL,
+    peak_mag REAL,
+    rise_rate REAL,
+    state TEXT NOT NULL,
+    enqueued REAL,
+    submitted REAL,
+    PRIMARY KEY (object, model)
+);
+CREATE INDEX IF NOT EXISTS queue_state ON queue (state);
+'''
+## queue states: queued -> in-flight (submitted to the backend) -> done (fit reached a terminal state)
+QUEUED = 'queued'
+IN_FLIGHT = 'in-flight'
+DONE = 'done'
+
+MJD_UNIX_EPOCH = 40587.0
+
+
+def get_queue_settings(settings):
+    '''
+    retrieve the fit queue settings (settings['queue']) with defaults filled in
+
+    the caps (max_in_flight_per_model, max_in_flight_per_user) are either a number or a dictionary keyed by model or
+    user name with an optional 'default' entry; None means no cap
+    '''
+    queue_settings = {'enabled':False, 'max_in_flight':None, 'max_in_flight_per_model':None, 'max_in_flight_per_user':None,
+                      'default_user':'default', 'recency_timescale':2.0, 'brightness_reference':20.0, 'rise_window':3.0,
+                      'weights':{'recency':2.0, 'brightness':0.5, 'rise':1.0, 'user':1.0}, 'fair_share':0.5,
+                      'preempt':False, 'preempt_running':False, 'preempt_margin':1.0}
+    user_settings = dict(settings.get('queue', {}))
+    queue_settings['weights'] = dict(queue_settings['weights'], **user_settings.pop('weights', {}))
+    queue_settings.update(user_settings)
+    return queue_settings
+
+def get_cap(caps, name):
+    if caps is None:
+        return np.inf
+    if isinstance(caps, dict):
+        cap = caps.get(name, caps.get('default'))
+        return np.inf if cap is None else cap
+    return caps
+
+def get_queue_path(settings):
+    '''
+    retrieve the path to the queue database (settings['queue']['file'], default: fit_queue.sqlite in the state directory)
+    '''
+    return settings.get('queue', {}).get('file') or get_state_path(settings, 'fit_queue.sqlite')
+
+def connect_queue(settings):
+    '''
+    opens the queue database, creating the table if needed (rows can be accessed by column name)
+    '''
+    queue_path = get_queue_path(settings)
+    os.makedirs(os.path.dirname(os.path.abspath(queue_path)), exist_ok=True)
+    conn = sqlite3.connect(queue_path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(QUEUE_SCHEMA)
+    return conn
+
+def get_urgency_features(object, settings):
+    '''
+    summarises how urgent the fit of a lightcurve is: time of the last detection, peak (brightest) magnitude, and the
+    fastest brightening rate in any filter over the last rise_window days of detections
+
+    Args:
+        object (str): path to object lightcurve
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        features (dict): dictionary with keys last_detection (mjd), peak_mag and rise_rate (mag/day, positive when
+            brightening), None where there are too few detections
+    '''
+    lightcurve = load_lightcurve(object)
+    detected = lightcurve.detected
+    if not detected.any():
+        return {'last_detection':None, 'peak_mag':None, 'rise_rate':None}
+    mjd, mag, filter = lightcurve.mjd[detected], lightcurve.mag[detected], lightcurve.filter[detected]
+    recent = mjd >= mjd.max() - get_queue_settings(settings)['rise_window']
+    rise_rates = []
+    for name in np.unique(filter[recent]):
+        in_filter = recent & (filter == name)
+        if len(np.unique(mjd[in_filter])) > 1:
+            rise_rates.append(-np.polyfit(mjd[in_filter], mag[in_filter], 1)[0])
+    return {'last_detection':float(mjd.max()), 'peak_mag':float(mag.min()), 'rise_rate':float(max(rise_rates)) if len(rise_rates) > 0 else None}
+
+def get_priority(row, settings, now=None):
+    '''
+    computes the priority of a queued fit (higher is submitted first)
+
+    priority = w_recency * exp(-days since last detection / recency_timescale)
+             + w_brightness * magnitudes brighter than brightness_reference
+             + w_rise * brightening rate (mag/day) + w_user * user priority
+
+    Args:
+        row (dict or sqlite3.Row): queue row
+        settings (dict): dictionary of settings from settings.json
+        now (float): current time as mjd (default: None, now)
+
+    Returns:
+        priority (float): priority of the fit
+    '''
+    queue_settings = get_queue_settings(settings)
+    weights = queue_settings['weights']
+    now = time.time() / 86400 + MJD_UNIX_EPOCH if now is None else now
+    priority = weights['user'] * row['user_priority']
+    if row['last_detection'] is not None:
+        priority += weights['recency'] * np.exp(-max(now - row['last_detection'], 0) / queue_settings['recency_timescale'])
+    if row['peak_mag'] is not None:
+        priority += weights['brightness'] * max(queue_settings['brightness_reference'] - row['peak_mag'], 0)
+    if row['rise_rate'] is not None:
+        priority += weights['rise'] * max(row['rise_rate'], 0)
+    return float(priority)
+
+def enqueue_fits(settings, objects, model, user=None, user_priority=None):
+    '''
+    adds fits of several objects to one model to the queue (a fit already in the queue is queued again, keeping its
+    user and user priority unless new ones are given)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        objects (list): paths to object lightcurves
+        model (dict): dictionary of model from settings.json (as passed to the backend, e.g. a triage model)
+        user (str): user or allocation the fits are charged to (default: None, settings['queue']['default_user'])
+        user_priority (float): priority assigned by the user (default: None, 0)
+
+    Returns:
+        None
+    '''
+    rows = []
+    for object in objects:
+        row = {'object':get_object_name(object), 'model':model['name'], 'data':object, 'model_settings':json.dumps(model),
+               'user':user, 'default_user':get_queue_settings(settings)['default_user'], 'user_priority':user_priority,
+               'state':QUEUED, 'enqueued':time.time(), 'submitted':None}
+        row.update(get_urgency_features(object, settings))
+        rows.append(row)
+    with closing(connect_queue(settings)) as conn, conn:
+        conn.executemany('''INSERT INTO queue (object, model, data, model_settings, user, user_priority, last_detection, peak_mag, rise_rate, state, enqueued, submitted)
+                            VALUES (:object, :model, :data, :model_settings, coalesce(:user, :default_user), coalesce(:user_priority, 0), :last_detection, :peak_mag, :rise_rate, :state, :enqueued, :submitted)
+                            ON CONFLICT (object, model) DO UPDATE SET data=excluded.data, model_settings=excluded.model_settings,
+                            user=coalesce(:user, user), user_priority=coalesce(:user_priority, user_priority), last_detection=excluded.last_detection,
+                            peak_mag=excluded.peak_mag, rise_rate=excluded.rise_rate, state=excluded.state, enqueued=excluded.enqueued, submitted=NULL''', rows)
+    mark_queued(settings, [{'object':row['object'], 'model':row['model'], 'data':row['data'],
+                            'outdir':get_fit_outdir(row['data'], model, settings)} for row in rows])
+
+def refresh_queue(conn, settings):
+    '''
+    moves in-flight fits that have reached a terminal state to done, and fits whose submission failed back to queued
+
+    Args:
+        conn (sqlite3.Connection): connection to the queue
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        tracker (dict): tracker with the latest submissions ingested
+    '''
+    tracker = load_fit_states(settings)
+    ingest_submissions(settings, tracker)
+    save_fit_states(settings, tracker)
+    updates = []
+    for row in conn.execute('SELECT object, model, submitted FROM queue WHERE state = ?', (IN_FLIGHT,)):
+        record = tracker['fits'].get(fit_key(row['object'], row['model']))
+        if record is None or record['submitted'] < row['submitted']: ## never recorded as submitted, e.g. sbatch failed
+            updates.append((QUEUED, row['object'], row['model']))
+        elif record['state'] in TERMINAL_STATES:
+            updates.append((DONE, row['object'], row['model']))
+    conn.executemany('UPDATE queue SET state = ? WHERE object = ? AND model = ?', updates)
+    return tracker
+
+def within_caps(row, counts, settings):
+    '''
+    checks whether one more fit of a row's model and user stays within the in-flight caps
+    '''
+    queue_settings = get_queue_settings(settings)
+    return (counts['total'] < get_cap(queue_settings['max_in_flight'], None)
+            and counts['model'].get(row['model'], 0) < get_cap(queue_settings['max_in_flight_per_model'], row['model'])
+            and counts['user'].get(row['user'], 0) < get_cap(queue_settings['max_in_flight_per_user'], row['user']))
+
+def count_in_flight(rows):
+    counts = {'total':len(rows), 'model':{}, 'user':{}}
+    for row in rows:
+        counts['model'][row['model']] = counts['model'].get(row['model'], 0) + 1
+        counts['user'][row['user']] = counts['user'].get(row['user'], 0) + 1
+    return counts
+
+def preempt_fit(settings, row, tracker):
+    '''
+    cancels an in-flight fit and moves it back to the queue
+
+    Returns:
+        boolean: True if the fit was cancelled, False otherwise (fits run by the local backend cannot be preempted)
+    '''
+    record = tracker['fits'].get(fit_key(row['object'], row['model']))
+    if record is None or record.get('job_id') is None or str(record['job_id']).startswith(('local-', 'cached-')):
+        return False
+    result = subprocess.run([get_scheduler_command(settings, 'scancel'), str(record['job_id'])], capture_output=True, text=True)
+    if result.returncode != 0:
+        print('[{}] Could not cancel job {}: {}'.format(current_time(), record['job_id'], result.stderr.strip()))
+        return False
+    mark_queued(settings, [{'object':record['object'], 'model':record['model'], 'data':record['data'], 'outdir':record['outdir']}])
+    print('[{}] Preempted {} {} (job {})'.format(current_time(), row['object'], row['model'], record['job_id']))
+    return True
+
+def select_fits(queued, in_flight, settings, tracker=None):
+    '''
+    picks the queued fits to submit: repeatedly the highest priority fit within the caps, after lowering the priority of
+    each user's fits by fair_share for every fit of theirs in flight. With preemption enabled, a fit blocked by the caps
+    preempts the lowest priority in-flight fit that is at least preempt_margin lower and whose removal unblocks it.
+
+    Args:
+        queued (list): queued rows as dictionaries, with their priority
+        in_flight (list): in-flight rows as dictionaries, with their priority
+        settings (dict): dictionary of settings from settings.json
+        tracker (dict): tracker returned by refresh_queue, needed for preemption (default: None, no preemption)
+
+    Returns:
+        selected (list): rows to submit, in order
+        preempted (list): in-flight rows that were cancelled and go back to the queue
+    '''
+    queue_settings = get_queue_settings(settings)
+    preemptible_states = [PENDING, RUNNING] if queue_settings['preempt_running'] else [PENDING]
+    in_flight = list(in_flight)
+    counts = count_in_flight(in_flight)
+    effective_priority = lambda row: row['priority'] - queue_settings['fair_share'] * counts['user'].get(row['user'], 0)
+    remaining, selected, preempted = list(queued), [], []
+    while len(remaining) > 0:
+        best = max(remaining, key=effective_priority)
+        if not within_caps(best, counts, settings):
+            victim = None
+            if queue_settings['preempt'] and tracker is not None:
+                for row in sorted(in_flight, key=lambda row: row['priority']):
+                    record = tracker['fits'].get(fit_key(row['object'], row['model']), {})
+                    if (row['priority'] + queue_settings['preempt_margin'] <= best['priority'] and record.get('state') in preemptible_states
+                            and within_caps(best, count_in_flight([other for other in in_flight if other is not row]), settings)):
+                        victim = row
+                        break
+            if victim is None or not preempt_fit(settings, victim, tracker):
+                remaining.remove(best) ## stays queued until a slot frees up
+                continue
+            in_flight.remove(victim)
+            preempted.append(victim)
+            counts = count_in_flight(in_flight)
+        remaining.remove(best)
+        selected.append(best)
+        in_flight.append(best)
+        counts = count_in_flight(in_flight)
+    return selected, preempted
+
+def dispatch_queue(settings, backend):
+    '''
+    submits the highest priority queued fits that fit within the caps to the backend (called whenever fits are queued
+    and on every tracker tick, under the scan lock)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        backend (SlurmBackend or LocalBackend): execution backend
+
+    Returns:
+        num_submitted (int): number of fits submitted
+    '''
+    with closing(connect_queue(settings)) as conn, conn:
+        tracker = refresh_queue(conn, settings)
+        now = time.time() / 86400 + MJD_UNIX_EPOCH
+        rows = [dict(row, priority=get_priority(row, settings, now=now)) for row in conn.execute('SELECT * FROM queue WHERE state IN (?, ?)', (QUEUED, IN_FLIGHT))]
+        selected, preempted = select_fits([row for row in rows if row['state'] == QUEUED], [row for row in rows if row['state'] == IN_FLIGHT], settings, tracker=tracker)
+        conn.executemany('UPDATE queue SET state = ?, submitted = NULL WHERE object = ? AND model = ?', [(QUEUED, row['object'], row['model']) for row in preempted])
+        submitted = time.time()
+        conn.executemany('UPDATE queue SET state = ?, submitted = ? WHERE object = ? AND model = ?', [(IN_FLIGHT, submitted, row['object'], row['model']) for row in selected])
+
+    groups = {} ## fits of the same model are submitted together, e.g. as one array job, in order of their best priority
+    for row in selected:
+        groups.setdefault(row['model_settings'], []).append(row['data'])
+    for model_settings, objects in groups.items():
+        backend.submit(objects, json.loads(model_settings))
+    if len(selected) > 0:
+        print('[{}] Dispatched {} of {} queued fits'.format(current_time(), len(selected), len([row for row in rows if row['state'] == QUEUED])))
+    return len(selected)
+
+def list_queue(settings, states=(QUEUED, IN_FLIGHT)):
+    '''
+    retrieve the rows of the queue in the given states with their current priority, highest first
+
+    Returns:
+        rows (list): list of dictionaries with the queue columns and priority
+    '''
+    with closing(connect_queue(settings)) as conn:
+        rows = [dict(row, priority=get_priority(row, settings)) for row in conn.execute(
+            'SELECT * FROM queue WHERE state IN ({})'.format(', '.join('?' * len(states))), tuple(states))]
+    return sorted(rows, key=lambda row: (row['state'] != IN_FLIGHT, -row['priority'], row['enqueued']))
+
+def update_queued_fits(settings, object, model=None, **columns):
+    '''
+    sets columns (e.g. user_priority or user) of the queued fits of an object (of all its models if model is None)
+
+    Returns:
+        num_updated (int): number of fits updated
+    '''
+    query = 'UPDATE queue SET {} WHERE object = ?'.format(', '.join('{} = ?'.format(column) for column in columns))
+    parameters = list(columns.values()) + [object]
+    if model is not None:
+        query += ' AND model = ?'
+        parameters.append(model)
+    with closing(connect_queue(settings)) as conn, conn:
+        return conn.execute(query, parameters).rowcount
+
+def requeue_fits(settings, object, model=None):
+    '''
+    preempts the in-flight fits of an object (of all its models if model is None), moving them back to the queue
+
+    Returns:
+        num_requeued (int): number of fits cancelled and queued again
+    '''
+    with closing(connect_queue(settings)) as conn, conn:
+        tracker = refresh_queue(conn, settings)
+        rows = [row for row in conn.execute('SELECT * FROM queue WHERE state = ? AND object = ?', (IN_FLIGHT, object)) if model is None or row['model'] == model]
+        requeued = [row for row in rows if preempt_fit(settings, row, tracker)]
+        conn.executemany('UPDATE queue SET state = ?, submitted = NULL WHERE object = ? AND model = ?', [(QUEUED, row['object'], row['model']) for row in requeued])
+    return len(requeued)
+
+
+class FitQueue:
+    '''
+    execution backend wrapper queueing fits and submitting them to the wrapped backend in order of priority
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        backend (SlurmBackend or LocalBackend): execution backend (default: None, the backend named in settings.json)
+    '''
+    def __init__(self, settings, backend=None):
+        self.settings = settings
+        self.backend = get_backend(settings) if backend is None else backend
+        self.name = self.backend.name
+
+    def submit(self, objects, model):
+        '''
+        queues fits of several objects to one model and dispatches the queue
+
+        Returns:
+            job_ids (list): empty list, fits are submitted by dispatch
+        '''
+        if len(objects) > 0:
+            enqueue_fits(self.settings, objects, model)
+        self.dispatch()
+        return []
+
+    def dispatch(self):
+        dispatched = dispatch_queue(self.settings, self.backend)
+        self.backend.dispatch() ## e.g. local fits waiting for cpus
+        return dispatched
+
+    def wait(self):
+        self.backend.wait()
+
+    def shutdown(self):
+        self.backend.shutdown()
+
+def get_queued_backend(settings):
+    '''
+    retrieve the execution backend named in settings.json, behind the fit queue if it is enabled
+    '''
+    backend = get_backend(settings)
+    return FitQueue(settings, backend) if get_queue_settings(settings)['enabled'] else backend
@@ -3,12 +3,17 @@ Contains all functions used for fitting lightcurves.
 '''
 import subprocess
 import os
+import json
+import time
+import fcntl
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait as wait_futures
 
-import numpy as np
-import pandas as pd
-from astropy.time import Time
- 
 from utils.tools import current_time, get_filters
+from utils.conversion import load_lightcurve
+from utils.files import get_state_path
+from utils.fit_cache import get_fit_key, lookup_fit, reuse_fit, snapshot_lightcurve
+from utils.budget import get_budgeted_model, write_budget_file, merge_jobs
 
 
 def make_object_directory(object):
@@ -30,27 +35,112 @@ def trigger_time(object, settings):
     t0 = settings['t0']
     
     # Set the trigger time
-    # data = parse_csv(object) ## this may be a point of failure if the file is not formatted correctly
-    ## alternate option is to use pandas to read the file, but trigger time will need to be reworked in that case
-    data = pd.read_csv(object, sep=' ', header=None, names=['time','filter','mag','mag_err'])
-    data = data[data['mag_err'] != np.inf].sort_values(by=['time'])
+    lightcurve = load_lightcurve(object) ## parsed and converted to mjd once per file contents, shared with get_filters
+    detected = lightcurve.detected
     if fit_trigger_time:
         # Set to earliest detection in preparation for fit
         # Need to search the whole file since they are not always ordered.
-        trigger_time = Time(data['time'].iloc[0], format='isot').mjd
+        trigger_time = lightcurve.mjd[detected].min()
 
     elif trigger_time_heuristic:
         # One day before the first non-zero point
-        trigger_time = Time(data[data['mag'] != 0]['time'].iloc[0], format='isot').mjd - 1
+        trigger_time = lightcurve.mjd[detected & (lightcurve.mag != 0)].min() - 1
     else:
         # Set the trigger time manually in settings (in this case, 1)
         trigger_time = t0
     return trigger_time
 
+def get_object_name(object):
+    '''
+    retrieve the object name (file name without extension) from the path to an object lightcurve
+    '''
+    return os.path.basename(object).split('.')[0]
+
+def get_fit_outdir(object, model, settings):
+    '''
+    retrieve (and create) the output directory for the fit of an object to a model
+    
+    Args:
+        object (str): path to object lightcurve
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+    
+    Returns:
+        outdir (str): path to fit output directory
+    '''
+    outdir = os.path.join(settings['fit_directory'], get_object_name(object), model['name'])
+    if 'stage' in model: ## e.g. triage fits (see utils.triage), kept apart from the full fit of the model
+        outdir = os.path.join(outdir, model['stage'])
+    make_object_directory(outdir)
+    return outdir
+
+def get_fit_command(object, model, settings, outdir):
+    '''
+    builds the light_curve_analysis command used to fit an object to a model
+    
+    Args:
+        object (str): path to object lightcurve
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+        outdir (str): path to fit output directory
+    
+    Returns:
+        command_string (str): command to be run in the job script
+    '''
+    object_name = get_object_name(object)
+    command_string = [#'mpiexec -np',str(args.cpus),
+            'light_curve_analysis',
+            '--data', object,
+            '--model', model['name'],
+            '--label', object_name+'_'+model['alias'].replace(' ', '_'), ## aliases such as 'Shock Cooling' contain spaces
+            '--prior', model['prior'],
+            '--svd-path', settings['svd_path'],
+            '--filters', ','.join(get_filters(object)),
+            '--tmin', str(model['tmin']),
+            '--tmax', str(model['tmax']),
+            '--dt', str(model['dt']),
+            '--trigger-time', str(model['trigger_time'] if 'trigger_time' in model else trigger_time(object, settings)), ## warm-start refits reuse the previous trigger time
+            '--error-budget', str(settings['error_budget']),
+            '--nlive', str(model['nlive']),
+            '--Ebv-max', str(settings['Ebv_max']),
+            '--outdir', outdir,
+            # '--plot', 
+            '--verbose',
+            '--detection-limit \"{\'r\':21.5, \'g\':21.5, \'i\':21.5}\"'
+            ]
+    return ' '.join(command_string)
+
+def write_job_header(f, job_name, job, output, error, array=None):
+    '''
+    writes the #SBATCH directives of a job script, skipping any resources not set for the model
+    
+    Args:
+        f (file): open job script
+        job_name (str): name of the job
+        job (dict): job settings of the model from settings.json
+        output (str): path to stdout file
+        error (str): path to stderr file
+        array (str): slurm array specification, e.g. '0-9' (default: None, not an array job)
+    
+    Returns:
+        None
+    '''
+    f.write('#!/bin/bash\n')
+    f.write('#SBATCH --job-name={}\n'.format(job_name))
+    for key in ['time', 'nodes', 'ntasks', 'cpus-per-task', 'mem']:
+        if key in job:
+            f.write('#SBATCH --{}={}\n'.format(key, job[key]))
+    if array is not None:
+        f.write('#SBATCH --array={}\n'.format(array))
+    f.write('#SBATCH --output={}\n'.format(output))
+    f.write('#SBATCH --error={}\n'.format(error))
+
 def generate_job(object, model, settings):
     '''
     intakes general settings and model settings to create a bash script to be submitted to the cluster
     
+    nlive and the job resources are chosen for the object by the sampler budget (see utils/budget.py)
+    
     Args:
         object (str): path to object lightcurve
         model (dict): dictionary of model, including job settings from settings.json (the value corresponding to the model key from the models dictionary in settings.json)
@@ -59,62 +149,435 @@ def generate_job(object, model, settings):
     Returns:
     Path to generated bash script
     '''
-    object_name = object.split('/')[-1].split('.')[0]
-    job = model['job']
-    outdir = os.path.join(settings['fit_directory'], object, model['name'])
-    make_object_directory(outdir)
+    object_name = get_object_name(object)
+    outdir = get_fit_outdir(object, model, settings)
+    model, budget = get_budgeted_model(object, model, settings)
+    write_budget_file(outdir, model['name'], budget)
     
     job_file = os.path.join(outdir, model['name'] + '.sh')
     with open(job_file, 'w') as f:
-        f.write('#!/bin/bash\n')
-        f.write('#SBATCH --name={}\n'.format(object+'_'+model['name']))
-        f.write('#SBATCH --time={}\n'.format(job['time']))
-        f.write('#SBATCH --nodes={}\n'.format(job['nodes']))
-        f.write('#SBATCH --ntasks={}\n'.format(job['ntasks']))
-        f.write('#SBATCH --cpus-per-task={}\n'.format(job['cpus-per-task']))
-        f.write('#SBATCH --mem{}\n'.format(job['mem']))
-        f.write('#SBATCH --output={}\n'.format(os.path.join(outdir, model['name'] + '.out')))
-        f.write('#SBATCH --error={}\n'.format(os.path.join(outdir, model['name'] + '.err')))
-        
+        write_job_header(f, object_name+'_'+model['name'], model['job'],
+                         os.path.join(outdir, model['name'] + '.out'),
+                         os.path.join(outdir, model['name'] + '.err'))
         f.write('source {} {}\n'.format(settings['env']['path'], settings['env']['name']))
-        command_string = cmd_str = [#'mpiexec -np',str(args.cpus),
-                'light_curve_analysis',
-                '--data', object,
-                '--model', model['name'],
-                '--label', object_name+'_'+model['alias'],
-                '--prior', model['prior'],
-                '--svd-path', settings['svd_path'],
-                '--filters', ','.join(get_filters(object)),
-                '--tmin', str(model['tmin']),
-                '--tmax', str(model['tmax']),
-                '--dt', str(model['dt']),
-                '--trigger-time', str(trigger_time(object, settings)),
-                '--error-budget', settings['error_budget'],
-                '--nlive', str(model['nlive']),
-                '--Ebv-max', str(settings['Ebv_max']),
-                '--outdir', outdir,
-                # '--plot', 
-                '--verbose',
-                '--detection-limit \"{\'r\':21.5, \'g\':21.5, \'i\':21.5}\"'
-                ]
-        command_string = ' '.join(command_string)
-        f.write(command_string)
+        f.write(get_fit_command(object, model, settings, outdir))
         
         print('[{}] Generated {}'.format(current_time(), job_file))
 
     return job_file
 
+def generate_job_array(objects, model, settings):
+    '''
+    creates a single slurm array job fitting several objects to one model, along with a per-task manifest
+    
+    Each array task reads its command from commands.txt (line number = task id + 1) and writes its output to the same
+    .out/.err files in the object's fit directory that a single job would. Each task gets the nlive chosen by the sampler
+    budget for its object, while the array requests the largest resources of any task.
+    
+    Args:
+        objects (list): paths to object lightcurves
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+    
+    Returns:
+        job_file (str): path to generated array job script
+        manifest (list): list of task dictionaries (keys: task_id, object, model, outdir)
+    '''
+    wave = '{}_{}_{}'.format(model['name'], time.strftime('%Y%m%d-%H%M%S', time.localtime()), os.getpid())
+    array_directory = get_state_path(settings, os.path.join('arrays', wave))
+    os.makedirs(array_directory, exist_ok=True)
+    
+    manifest, commands, budgets = [], [], []
+    for task_id, object in enumerate(objects):
+        outdir = get_fit_outdir(object, model, settings)
+        output = os.path.join(outdir, model['name'])
+        budgeted_model, budget = get_budgeted_model(object, model, settings)
+        budgets.append((outdir, budget))
+        commands.append('{} > {}.out 2> {}.err'.format(get_fit_command(object, budgeted_model, settings, outdir), output, output))
+        manifest.append({'task_id':task_id, 'object':get_object_name(object), 'model':model['name'], 'outdir':outdir})
+    
+    with open(os.path.join(array_directory, 'commands.txt'), 'w') as f:
+        f.write('\n'.join(commands) + '\n')
+    job = merge_jobs([budget['job'] for _, budget in budgets])
+    for outdir, budget in budgets:
+        write_budget_file(outdir, model['name'], dict(budget, job=job)) ## with the resources every task actually gets, for the cost model
+    
+    job_file = os.path.join(array_directory, wave + '.sh')
+    with open(job_file, 'w') as f:
+        write_job_header(f, wave, job,
+                         os.path.join(array_directory, '%A_%a.out'),
+                         os.path.join(array_directory, '%A_%a.err'),
+                         array='0-{}'.format(len(objects) - 1))
+        f.write('source {} {}\n'.format(settings['env']['path'], settings['env']['name']))
+        f.write('eval "$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {})"\n'.format(os.path.join(array_directory, 'commands.txt')))
+    print('[{}] Generated {} ({} tasks)'.format(current_time(), job_file, len(objects)))
+    
+    return job_file, manifest
+
+def get_scheduler_command(settings, command):
+    '''
+    retrieve the executable used for a scheduler command, so that e.g. a fake sbatch can be swapped in through settings.json
+    
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        command (str): name of scheduler command (sbatch, squeue, sacct, scancel)
+    
+    Returns:
+        executable (str): executable to run for the command
+    '''
+    return settings.get('scheduler', {}).get(command, command)
 
-def submit_job(job_file):
+def submit_job(job_file, sbatch='sbatch'):
     '''
     submits a job to the cluster
     
     Args:
         job_file (str): path to bash script to be submitted
+        sbatch (str): sbatch executable (default: 'sbatch')
         
+    Returns:
+        job_id (str): slurm job id of the submitted job (None if submission failed)
+    '''
+    result = subprocess.run([sbatch, '--parsable', job_file], capture_output=True, text=True)
+    if result.returncode != 0:
+        print('[{}] Failed to submit {}: {}'.format(current_time(), job_file, result.stderr.strip()))
+        return None
+    job_id = result.stdout.strip().split(';')[0] ## --parsable prints "jobid[;cluster]"
+    print('[{}] Submitted {} (job {})'.format(current_time(), job_file, job_id))
+    return job_id
+
+def record_submission(settings, object, model, job_id, outdir, data, fit_key=None, stage=None, warm_start=None):
+    '''
+    appends a submitted fit to the submissions log in the state directory
+    
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        object (str): name of object
+        model (str): name of model
+        job_id (str): slurm job id (array tasks are recorded as <array job id>_<task id>)
+        outdir (str): path to fit output directory
+        data (str): path to object lightcurve
+        fit_key (str): fit cache key, so the result is cached once the fit completes (default: None, not cached)
+        stage (str): fitting stage, e.g. 'triage' (default: None, full fit)
+        warm_start (dict): warm start details of a refit (default: None, fit from scratch, see utils.refit)
+    
     Returns:
         None
     '''
-    subprocess.run(' '.join(['sbatch', job_file]), shell=True)
-    print('[{}] Submitted {}'.format(current_time(), job_file))
-    
\ No newline at end of file
+    record = {'object':object, 'model':model, 'job_id':job_id, 'outdir':outdir, 'data':data, 'submitted':time.time()}
+    if fit_key is not None:
+        record['fit_key'] = fit_key
+    if stage is not None:
+        record['stage'] = stage
+    if warm_start is not None:
+        record['warm_start'] = warm_start
+    if settings.get('refit', {}).get('enabled', False): ## snapshot of the data, so the next version of the object can be refit from this fit
+        record['data_hash'], record['snapshot'] = snapshot_lightcurve(settings, data)
+        record['trigger_time'] = float(warm_start['trigger_time'] if warm_start is not None else trigger_time(data, settings))
+    with open(get_state_path(settings, 'submissions.jsonl'), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def submit_job_array(objects, model, settings, fit_keys=None):
+    '''
+    fits several objects to one model with a single array job submitted through one sbatch call
+    
+    Args:
+        objects (list): paths to object lightcurves
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+        fit_keys (dict): dictionary of object path to fit cache key (default: None, not cached)
+    
+    Returns:
+        manifest (list): list of task dictionaries (keys: task_id, object, model, outdir, job_id)
+    '''
+    fit_keys = fit_keys or {}
+    job_file, manifest = generate_job_array(objects, model, settings)
+    array_job_id = submit_job(job_file, sbatch=get_scheduler_command(settings, 'sbatch'))
+    for object, task in zip(objects, manifest):
+        task['job_id'] = None if array_job_id is None else '{}_{}'.format(array_job_id, task['task_id'])
+        if task['job_id'] is not None:
+            record_submission(settings, task['object'], task['model'], task['job_id'], task['outdir'], object, fit_key=fit_keys.get(object), stage=model.get('stage'), warm_start=model.get('warm_start'))
+    with open(os.path.join(os.path.dirname(job_file), 'manifest.json'), 'w') as f:
+        json.dump({'array_job_id':array_job_id, 'tasks':manifest}, f, indent=4)
+    return manifest
+
+def reuse_cached_fits(objects, model, settings):
+    '''
+    completes the fits found in the fit cache (see utils.fit_cache) right away, recording them as submissions with a
+    cached-<key> job id so they are tracked and published like any other fit
+    
+    Args:
+        objects (list): paths to object lightcurves
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+    
+    Returns:
+        objects_to_fit (list): paths to object lightcurves that still have to be fit
+        fit_keys (dict): dictionary of object path to fit cache key for the objects to fit
+        cached_job_ids (list): job ids of the reused fits
+    '''
+    if not settings.get('fit_cache', False):
+        return objects, {}, []
+    objects_to_fit, fit_keys, cached_job_ids = [], {}, []
+    for object in objects:
+        try:
+            fit_key = get_fit_key(object, get_budgeted_model(object, model, settings)[0], settings) ## keyed on the nlive the fit runs with
+        except (OSError, ValueError) as e: ## e.g. missing prior file, fit without caching
+            print('[{}] Could not compute the fit cache key of {} {}: {}'.format(current_time(), get_object_name(object), model['name'], e))
+            objects_to_fit.append(object)
+            continue
+        result_file = lookup_fit(settings, fit_key)
+        if result_file is None:
+            objects_to_fit.append(object)
+            fit_keys[object] = fit_key
+            continue
+        outdir = get_fit_outdir(object, model, settings)
+        job_id = 'cached-' + fit_key[:12]
+        record_submission(settings, get_object_name(object), model['name'], job_id, outdir, object, stage=model.get('stage'), warm_start=model.get('warm_start'))
+        reuse_fit(result_file, os.path.join(outdir, '{}_{}_result.json'.format(get_object_name(object), model['alias'].replace(' ', '_'))))
+        cached_job_ids.append(job_id)
+    return objects_to_fit, fit_keys, cached_job_ids
+
+
+def run_fit_command(command, output, cpus):
+    '''
+    runs a light_curve_analysis command in a local worker process, writing its output next to the fit as a slurm job would
+
+    A <model>.status file in the fit directory holds 'running' while the command runs and its exit code afterwards.
+
+    Args:
+        command (str): command built by get_fit_command
+        output (str): path to the fit output files without extension (i.e. <outdir>/<model name>)
+        cpus (int): number of cpus allotted to the fit (used to limit threads of numerical libraries)
+
+    Returns:
+        returncode (int): exit code of the command
+    '''
+    env = dict(os.environ, OMP_NUM_THREADS=str(cpus), OPENBLAS_NUM_THREADS=str(cpus), MKL_NUM_THREADS=str(cpus))
+    with open(output + '.status', 'w') as f:
+        f.write('running')
+    with open(output + '.out', 'w') as out, open(output + '.err', 'w') as err:
+        returncode = subprocess.run(command, shell=True, stdout=out, stderr=err, env=env).returncode
+    with open(output + '.status', 'w') as f:
+        f.write(str(returncode))
+    return returncode
+
+
+def get_owner_lock_path(settings, owner):
+    return os.path.join(get_state_path(settings, 'local_backends'), owner + '.lock')
+
+def is_owner_alive(settings, owner):
+    '''
+    checks whether the local backend that submitted a fit is still running, from the lock it holds for its lifetime (a
+    bare pid could have been reused by another process since)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        owner (str): owner of the local job id (local-<owner>-<n>)
+
+    Returns:
+        boolean: True if the backend still holds its lock, False otherwise
+    '''
+    lock_path = get_owner_lock_path(settings, owner)
+    if not os.path.exists(lock_path): ## released, or a job id from before owner locks
+        return False
+    with open(lock_path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    os.remove(lock_path)
+    return False
+
+
+class SlurmBackend:
+    '''
+    execution backend submitting fits to a slurm cluster, either as one array job per model or as one job per fit
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+    '''
+    name = 'slurm'
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def submit(self, objects, model):
+        '''
+        submits fits of several objects to one model
+
+        Args:
+            objects (list): paths to object lightcurves
+            model (dict): dictionary of model from settings.json
+
+        Returns:
+            job_ids (list): job id of each fit (None where submission failed), reused cached fits first
+        '''
+        objects, fit_keys, job_ids = reuse_cached_fits(objects, model, self.settings)
+        if len(objects) == 0:
+            return job_ids
+        if self.settings.get('batch_submission', False):
+            return job_ids + [task['job_id'] for task in submit_job_array(objects, model, self.settings, fit_keys=fit_keys)]
+        for object in objects:
+            job_file = generate_job(object, model, self.settings)
+            job_id = submit_job(job_file, sbatch=get_scheduler_command(self.settings, 'sbatch'))
+            if job_id is not None:
+                record_submission(self.settings, get_object_name(object), model['name'], job_id, get_fit_outdir(object, model, self.settings), object, fit_key=fit_keys.get(object), stage=model.get('stage'), warm_start=model.get('warm_start'))
+            job_ids.append(job_id)
+        return job_ids
+
+    def dispatch(self):
+        pass ## jobs are queued by slurm
+
+    def wait(self):
+        pass ## jobs run on the cluster independently of the scanner
+
+    def shutdown(self):
+        pass
+
+
+class LocalBackend:
+    '''
+    execution backend running fits on the local node in a process pool, for development, CI and clusters without slurm
+
+    Fits are started only while the sum of their cpus-per-task fits within the cpu budget, so the node is not oversubscribed.
+    A fit asking for more cpus than the budget is run on its own with the whole budget. Queued fits are started by
+    dispatch, called on submission, while waiting and on every scanner tick. Each fit's command is written next to it
+    (<model>.local.json), so fits left queued by a scanner that has since exited (whose lock in the state directory is no
+    longer held) are queued again by the next backend.
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        max_cpus (int): cpu budget (default: None, uses settings['local_cpus'] or all cpus of the node)
+    '''
+    name = 'local'
+
+    def __init__(self, settings, max_cpus=None):
+        self.settings = settings
+        self.max_cpus = max_cpus or settings.get('local_cpus') or os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.max_cpus)
+        self.lock = threading.Lock()
+        self.queue = [] ## (command, output, cpus) of fits waiting for cpus
+        self.futures = []
+        self.cpus_in_use = 0
+        self.num_submitted = 0
+        self.owner = '{}.{}'.format(os.getpid(), time.time_ns()) ## unique even if the pid is reused later
+        os.makedirs(get_state_path(settings, 'local_backends'), exist_ok=True)
+        self.owner_lock = open(get_owner_lock_path(settings, self.owner), 'w') ## held until this process exits
+        fcntl.flock(self.owner_lock, fcntl.LOCK_EX)
+        self.requeue_orphans()
+
+    def submit(self, objects, model):
+        '''
+        queues fits of several objects to one model to be run locally
+
+        Args:
+            objects (list): paths to object lightcurves
+            model (dict): dictionary of model from settings.json
+
+        Returns:
+            job_ids (list): local job id of each fit, reused cached fits first
+        '''
+        objects, fit_keys, job_ids = reuse_cached_fits(objects, model, self.settings)
+        for object in objects:
+            outdir = get_fit_outdir(object, model, self.settings)
+            budgeted_model, budget = get_budgeted_model(object, model, self.settings)
+            cpus = budget['job']['cpus-per-task'] = min(int(budgeted_model['job'].get('cpus-per-task', 1)), self.max_cpus)
+            write_budget_file(outdir, model['name'], budget) ## with the cpus the fit actually gets, for the cost model
+            command = get_fit_command(object, budgeted_model, self.settings, outdir)
+            self.num_submitted += 1
+            job_id = 'local-{}-{}'.format(self.owner, self.num_submitted)
+            with open(os.path.join(outdir, model['name'] + '.local.json'), 'w') as f:
+                json.dump({'job_id':job_id, 'command':command, 'cpus':cpus}, f)
+            record_submission(self.settings, get_object_name(object), model['name'], job_id, outdir, object, fit_key=fit_keys.get(object), stage=model.get('stage'), warm_start=model.get('warm_start'))
+            with self.lock:
+                self.queue.append((command, os.path.join(outdir, model['name']), cpus))
+            print('[{}] Queued {} {} locally ({} cpus, job {})'.format(current_time(), get_object_name(object), model['name'], cpus, job_id))
+            job_ids.append(job_id)
+        self.dispatch()
+        return job_ids
+
+    def requeue_orphans(self):
+        '''
+        takes over the local fits of scanner processes that have exited: fits that never started are queued again (as new
+        submissions) and fits that were interrupted while running are marked as failed through their status file
+        '''
+        from utils.tracking import load_fit_states, ingest_submissions, TERMINAL_STATES ## imported here to avoid a circular import with utils.tracking
+        tracker = load_fit_states(self.settings)
+        ingest_submissions(self.settings, tracker)
+        for record in tracker['fits'].values():
+            job_id = str(record.get('job_id'))
+            if not job_id.startswith('local-') or record['state'] in TERMINAL_STATES or is_owner_alive(self.settings, job_id.split('-')[1]):
+                continue
+            output = os.path.join(record['outdir'], record['model'])
+            if os.path.exists(output + '.status') and os.path.getmtime(output + '.status') >= record['submitted']:
+                with open(output + '.status', 'w') as f:
+                    f.write('orphaned') ## any status other than running or 0 is a failed fit
+                print('[{}] {} {} was interrupted (job {})'.format(current_time(), record['object'], record['model'], job_id))
+                continue
+            try:
+                with open(output + '.local.json', 'r') as f:
+                    job = json.load(f)
+            except (OSError, ValueError):
+                job = {}
+            if job.get('job_id') != job_id: ## written by an older version, or overwritten by a later submission
+                continue
+            self.num_submitted += 1
+            job.update(job_id='local-{}-{}'.format(self.owner, self.num_submitted), cpus=min(int(job['cpus']), self.max_cpus)) ## the budget of this backend may be smaller
+            with open(output + '.local.json', 'w') as f:
+                json.dump(job, f)
+            submission = {key:value for key, value in record.items() if key not in ['state', 'updated', 'published']}
+            with open(get_state_path(self.settings, 'submissions.jsonl'), 'a') as f:
+                f.write(json.dumps(dict(submission, job_id=job['job_id'], submitted=time.time())) + '\n')
+            with self.lock:
+                self.queue.append((job['command'], output, job['cpus']))
+            print('[{}] Queued {} {} locally again after a scanner restart (job {})'.format(current_time(), record['object'], record['model'], job['job_id']))
+
+    def dispatch(self):
+        '''
+        starts queued fits, in submission order, while there are enough cpus left in the budget (called from the main
+        thread, not from the callbacks of finished fits)
+        '''
+        with self.lock:
+            while len(self.queue) > 0 and self.cpus_in_use + self.queue[0][2] <= self.max_cpus:
+                command, output, cpus = self.queue.pop(0)
+                self.cpus_in_use += cpus
+                future = self.executor.submit(run_fit_command, command, output, cpus)
+                future.add_done_callback(lambda future, cpus=cpus: self.release(cpus))
+                self.futures.append(future)
+
+    def release(self, cpus):
+        with self.lock:
+            self.cpus_in_use -= cpus
+
+    def wait(self):
+        '''
+        blocks until all queued and running fits have finished
+        '''
+        while True:
+            self.dispatch()
+            with self.lock:
+                running = [future for future in self.futures if not future.done()]
+                if len(running) == 0 and len(self.queue) == 0:
+                    break
+            wait_futures(running, timeout=1, return_when=FIRST_COMPLETED) if len(running) > 0 else time.sleep(0.1) ## cpus are released by the callback after waiters wake up
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+BACKENDS = {'slurm':SlurmBackend, 'local':LocalBackend}
+
+def get_backend(settings):
+    '''
+    retrieve the execution backend named by settings['backend'] (default: slurm)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        backend (SlurmBackend or LocalBackend): execution backend
+    '''
+    backend_name = settings.get('backend', 'slurm')
+    assert backend_name in BACKENDS, 'Unknown backend {}, must be one of {}'.format(backend_name, list(BACKENDS.keys()))
+    return BACKENDS[backend_name](settings)
@@ -1,79 +1,274 @@
 '''
 includes git functions for pulling and pushing to github
+
+Results are published through a queue: objects are added to a pending list in the state directory, and a publish
+stages only their summaries and plots (see PUBLISH_PATTERNS) plus the catalog, commits them together and pushes. A
+failed push leaves the commit to be pushed by the next attempt rather than blocking the scanner, and PublishQueue
+runs these attempts in a background thread, coalescing several scan cycles into one commit.
 '''
-from git import Repo
+import os
+import json
+import glob
+import fcntl
+import threading
+from contextlib import contextmanager
+
+from utils.files import current_time, get_settings, get_state_path
+
+## files published for each object, relative to the fit directory ({object} is replaced by the object name)
+PUBLISH_PATTERNS = ['{object}/combined_fits.parquet', '{object}/combined_fits.arrow', '{object}/combined_fits.csv',
+                    '{object}/{object}_lightcurve.png', '{object}/{object}_lightcurve.pdf']
+## files published with every commit, relative to the fit directory
+PUBLISH_SHARED = ['fit_catalog.csv']
 
-from utils.files import current_time, get_settings
+_repos = {} ## repo directory -> git.Repo, opened once per process
 
 
-def get_repo():
+def get_publish_settings(settings):
     '''
-    get the repo object from the settings.json file
-    
+    retrieve the publishing settings (settings['publish']) with defaults filled in
+    '''
+    publish_settings = {'remote':'origin', 'branch':'main', 'patterns':PUBLISH_PATTERNS, 'shared':PUBLISH_SHARED,
+                        'batch_interval':60, 'max_backoff':900}
+    publish_settings.update(settings.get('publish', {}))
+    return publish_settings
+
+def get_repo(settings=None):
+    '''
+    get the repo object of the repo_directory in settings.json, reusing the handle opened by earlier calls
+
     Args:
-        None (uses settings.json)
-    
+        settings (dict): dictionary of settings from settings.json (default: None, read from ./settings.json)
+
     Returns:
         repo (git.Repo): git repository object
     '''
-    _, settings_dict = get_settings()
-    repo_path = settings_dict['repo_directory']
-    repo = Repo(repo_path)
-    return repo
+    from git import Repo ## GitPython is only imported once something is pulled or published
+
+    if settings is None:
+        _, settings = get_settings()
+    repo_path = os.path.abspath(settings['repo_directory'])
+    if repo_path not in _repos:
+        _repos[repo_path] = Repo(repo_path)
+    return _repos[repo_path]
 
-def git_pull():
+@contextmanager
+def publish_lock(settings):
     '''
-    pulls from github repo
-    
+    exclusive lock on the repository working tree and the pending list, held by git operations of the scanner (in
+    any thread or process) so they never run concurrently
+    '''
+    lock_path = get_state_path(settings, 'publish.lock')
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def load_pending(settings):
+    '''
+    loads the publishing queue from the state directory
+
+    Returns:
+        pending (dict): dictionary with the objects waiting to be committed ('objects') and whether there are commits waiting to be pushed ('unpushed')
+    '''
+    pending_path = get_state_path(settings, 'publish_pending.json')
+    if not os.path.exists(pending_path):
+        return {'objects':[], 'unpushed':False}
+    with open(pending_path, 'r') as f:
+        return json.load(f)
+
+def save_pending(settings, pending):
+    pending_path = get_state_path(settings, 'publish_pending.json')
+    tmp_path = pending_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(pending, f, indent=1)
+    os.replace(tmp_path, pending_path)
+
+def enqueue_objects(settings, objects):
+    '''
+    adds objects to the publishing queue, to be committed and pushed by the next publish_pending
+
     Args:
-        None (uses settings.json)
-    
+        settings (dict): dictionary of settings from settings.json
+        objects (list): names of objects whose results have been saved and plotted
+
     Returns:
         None
     '''
-    repo = get_repo()
-    repo.remotes.origin.pull()
-    
-def git_add():
+    with publish_lock(settings):
+        pending = load_pending(settings)
+        pending['objects'] += [object for object in objects if object not in pending['objects']]
+        save_pending(settings, pending)
+
+def get_publish_files(settings, objects):
     '''
-    adds all files from the fit_directory to the github repo. Adds a commit message of the current time and new folders in the fit_directory
-    
+    retrieve the files to publish for a set of objects, following the patterns in the publishing settings
+
     Args:
-        None (uses settings.json)
-        
+        settings (dict): dictionary of settings from settings.json
+        objects (list): names of objects
+
     Returns:
-        None
+        publish_files (list): paths to existing files to stage
     '''
-    repo = get_repo()
-    _, settings_dict = get_settings()
-    fit_directory = settings_dict['fit_directory']
-    repo.git.add(fit_directory)
-    
-    
-def git_push(commit_message=None):
+    publish_settings = get_publish_settings(settings)
+    fit_directory = settings['fit_directory']
+    patterns = [pattern.format(object=glob.escape(object)) for object in objects for pattern in publish_settings['patterns']] + publish_settings['shared']
+    return sorted({path for pattern in patterns for path in glob.glob(os.path.join(fit_directory, pattern))})
+
+def git_pull(settings=None):
     '''
-    pushes to github repo
-    
+    pulls from github repo
+
     Args:
-        commit_message (str): commit message to add to the push
-    
+        settings (dict): dictionary of settings from settings.json (default: None, read from ./settings.json)
+
     Returns:
-        None
-        
-    To-Do:
-        - add commit message with what objects were added automatically
-    '''
-    repo = get_repo()
-    git_add()
-    if commit_message is not None:
-        timed_commit_message = '[{}] {}'.format(current_time(), commit_message)
-        print(timed_commit_message)
-        repo.git.commit('-m', timed_commit_message)
-    try:
-        repo.remotes.origin.push()
-    except:
-        print('[{}] push has failed, attempting automatic merge'.format(current_time()))
+        boolean: True if the pull succeeded, False otherwise (e.g. the remote is unreachable, retried by the next scan)
+    '''
+    from git import GitCommandError
+
+    if settings is None:
+        _, settings = get_settings()
+    publish_settings = get_publish_settings(settings)
+    with publish_lock(settings):
         try:
-            repo.git.push('--set-upstream', 'origin', 'main')
-        except:
-            print('[{}] automatic merge has failed, please resolve manually'.format(current_time()))
\ No newline at end of file
+            get_repo(settings).git.pull(publish_settings['remote'], publish_settings['branch'])
+        except GitCommandError as e:
+            print('[{}] pull has failed: {}'.format(current_time(), e.stderr.strip()))
+            return False
+    return True
+
+def git_add(settings, objects):
+    '''
+    stages the published files (summaries, plots and catalog) of a set of objects, leaving result files and sampler output unstaged
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        objects (list): names of objects
+
+    Returns:
+        num_files (int): number of files staged
+    '''
+    repo = get_repo(settings)
+    publish_files = get_publish_files(settings, objects)
+    for i in range(0, len(publish_files), 500): ## chunked to stay within the argument length limit
+        repo.git.add('--', *publish_files[i:i+500])
+    return len(publish_files)
+
+def publish_pending(settings):
+    '''
+    commits the objects in the publishing queue in a single commit and pushes any unpushed commits; on failure the queue
+    is kept for the next attempt
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        boolean: True if everything queued has been pushed (or nothing was queued), False if the push failed
+    '''
+    from git import GitCommandError
+
+    publish_settings = get_publish_settings(settings)
+    with publish_lock(settings):
+        pending = load_pending(settings)
+        if len(pending['objects']) == 0 and not pending['unpushed']:
+            return True
+        repo = get_repo(settings)
+        if len(pending['objects']) > 0:
+            git_add(settings, pending['objects'])
+            if repo.is_dirty(index=True, working_tree=False, untracked_files=False):
+                commit_message = '[{}] Added fits for objects: {}'.format(current_time(), ', '.join(pending['objects']))
+                print(commit_message)
+                repo.git.commit('-m', commit_message)
+                pending['unpushed'] = True
+            pending['objects'] = []
+            save_pending(settings, pending)
+        try:
+            repo.git.push(publish_settings['remote'], 'HEAD:{}'.format(publish_settings['branch']))
+        except GitCommandError as e:
+            print('[{}] push has failed, will retry: {}'.format(current_time(), e.stderr.strip()))
+            if 'rejected' not in e.stderr: ## e.g. the remote is unreachable
+                return False
+            try: ## rejected because the remote has new commits, rebased so the next attempt can fast-forward
+                repo.git.pull('--rebase', publish_settings['remote'], publish_settings['branch'])
+            except GitCommandError:
+                print('[{}] automatic rebase has failed, please resolve manually'.format(current_time()))
+                if 'rebase in progress' in repo.git.status():
+                    repo.git.rebase('--abort')
+            return False
+        pending['unpushed'] = False
+        save_pending(settings, pending)
+        print('[{}] Pushed fits to {}'.format(current_time(), publish_settings['remote']))
+    return True
+
+def git_push(settings=None, objects=None):
+    '''
+    commits and pushes results right away (see publish_pending), with a commit message listing the published objects
+
+    Args:
+        settings (dict): dictionary of settings from settings.json (default: None, read from ./settings.json)
+        objects (list): names of objects to publish in addition to any already queued (default: None)
+
+    Returns:
+        boolean: True if the push succeeded
+    '''
+    if settings is None:
+        _, settings = get_settings()
+    enqueue_objects(settings, objects or [])
+    return publish_pending(settings)
+
+
+class PublishQueue:
+    '''
+    publishes queued objects from a background thread every batch_interval seconds, so several scan cycles are coalesced
+    into one commit; after a failed push the interval doubles up to max_backoff and resets once a push succeeds
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        batch_interval (float): seconds between publishes (default: publish settings, 60)
+        max_backoff (float): longest interval between retries after failed pushes in seconds (default: publish settings, 900)
+    '''
+    def __init__(self, settings, batch_interval=None, max_backoff=None):
+        publish_settings = get_publish_settings(settings)
+        self.settings = settings
+        self.batch_interval = publish_settings['batch_interval'] if batch_interval is None else batch_interval
+        self.max_backoff = publish_settings['max_backoff'] if max_backoff is None else max_backoff
+        self.delay = self.batch_interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='publish-queue', daemon=True)
+        self.thread.start()
+
+    def submit(self, objects):
+        '''
+        queues objects to be published with the next commit
+        '''
+        if len(objects) > 0:
+            enqueue_objects(self.settings, objects)
+
+    def publish(self):
+        '''
+        single publishing attempt, adjusting the interval until the next one
+        '''
+        try:
+            succeeded = publish_pending(self.settings)
+        except Exception as e: ## anything else (e.g. a corrupted index) is reported and retried rather than killing the thread
+            print('[{}] publishing has failed: {}'.format(current_time(), e))
+            succeeded = False
+        self.delay = self.batch_interval if succeeded else min(self.delay * 2, self.max_backoff)
+        return succeeded
+
+    def run(self):
+        while not self.stopped.wait(self.delay):
+            self.publish()
+
+    def shutdown(self, flush=True):
+        '''
+        stops the background thread, publishing anything still queued first (unless flush is False)
+        '''
+        self.stopped.set()
+        self.thread.join()
+        if flush:
+            self.publish()
@@ -1,24 +1,24 @@
 '''
 functions related to generating lightcurves
+
+pandas is imported by the functions building dataframes, so importing this module does not pull it in
 '''
-import bilby
-import nmma
+import os
+import gc
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait as wait_futures
 
 import numpy as np
-import pandas as pd
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import cm
-from astropy.time import Time
-import seaborn as sns
-
-from nmma.em.model import *
 
-from utils.tools import read_results_json, get_lightcurve_model, get_absolute_magnitude
+from utils.tools import current_time, get_lightcurve_model, get_absolute_magnitude
+from utils.results import read_result_summary, get_top_samples, read_posterior
+from utils.files import get_result_stage
 
 def get_best_params(json_path):
     '''
-    retrieves the best fit parameters from a results.json file
+    retrieves the best fit (maximum likelihood) parameters from a results.json file
     
     Args:
         json_path (str): path to results.json file from nmma fitting
@@ -27,21 +27,247 @@ def get_best_params(json_path):
         best_params (dict): dictionary of best fit parameters
         likelihood_dict (dict): dictionary of likelihood values
     '''
-    results = read_results_json(json_path)
-    posterior = results['posterior']
-    posterior_keys = list(posterior.keys())
-    
-    best_log_likelihood_idx = np.argmin(np.abs(posterior['log_likelihood']))
-    best_log_likelihood = posterior['log_likelihood'][best_log_likelihood_idx]
-    log_evidence = results['log_evidence']
-    log_evidence_err = results['log_evidence_err']
-    log_bayes_factor = results['log_bayes_factor']
+    summary = read_result_summary(json_path) ## converted from the json once (in a single streaming pass), then read from the compact store
+    best_parameters_dict = get_top_samples(json_path, top_k=1)[0]
     
-    likelihood_dict = {'log_evidence':log_evidence, 'log_evidence_err':log_evidence_err, 'log_bayes_factor':log_bayes_factor, 'log_likelihood':best_log_likelihood}
-    best_parameters_dict = dict(zip(posterior_keys, [posterior[key][best_log_likelihood_idx] for key in posterior_keys]))
+    likelihood_dict = {'log_evidence':summary['log_evidence'], 'log_evidence_err':summary['log_evidence_err'], 'log_bayes_factor':summary['log_bayes_factor'], 'log_likelihood':best_parameters_dict['log_likelihood']}
     return best_parameters_dict, likelihood_dict
 
-def generate_best_fit_lightcurve(json_path, model, sample_times=np.linspace(0.01, 7, 100), **kwargs):
+_model_cache = OrderedDict() ## (model class, model name, sample grid, model settings) -> constructed nmma lightcurve model, least recently used first
+
+def get_model_kwargs(model, settings=None):
+    '''
+    retrieve the keyword arguments used to construct an nmma lightcurve model from settings.json
+    
+    Args:
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json (default: None, uses the nmma defaults)
+    
+    Returns:
+        model_kwargs (dict): keyword arguments for the lightcurve model class
+    '''
+    if settings is None:
+        return {}
+    if model['model'] == 'SVDLightCurveModel':
+        return {'svd_path':settings['svd_path'], 'mag_ncoeff':settings['svd_mag_ncoeff'], 'lbol_ncoeff':settings['svd_lbol_ncoeff']}
+    elif model['model'] == 'GRBLightCurveModel':
+        return {'resolution':settings['grb_resolution'], 'jetType':settings['jet_type']}
+    return {}
+
+def get_rss_gb():
+    '''
+    returns the current resident memory of this process in GB (0 if it cannot be determined)
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1e9
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+def get_cached_lightcurve_model(model, sample_times, settings=None):
+    '''
+    retrieve a constructed nmma lightcurve model, building it only if an identical one is not already cached
+    
+    The cache is shared by the whole process and bounded by settings['model_cache']: at most max_models models are kept,
+    and least recently used models are evicted while the resident memory of the process exceeds max_rss_gb (the most
+    recently used model is always kept). This way surrogate models such as the SVD/GP interpolators are loaded from
+    svd_path once rather than once per object.
+    
+    Args:
+        model (dict): dictionary of model from settings.json
+        sample_times (np.array): array of times the model is sampled at
+        settings (dict): dictionary of settings from settings.json (default: None)
+    
+    Returns:
+        lightcurve_model (nmma lightcurve model): constructed lightcurve model
+    '''
+    model_kwargs = get_model_kwargs(model, settings)
+    sample_times = np.asarray(sample_times, dtype=np.float64)
+    key = (model['model'], model['name'], sample_times.tobytes(), tuple(sorted(model_kwargs.items())))
+    if key in _model_cache:
+        _model_cache.move_to_end(key)
+        return _model_cache[key]
+    
+    lightcurve_model = get_lightcurve_model(model)(sample_times=sample_times, model=model['name'], **model_kwargs) ## assumes the initialization of sample times is done twice in nmma (see related issue/pr in nmma)
+    _model_cache[key] = lightcurve_model
+    
+    cache_settings = {} if settings is None else settings.get('model_cache', {})
+    max_models = cache_settings.get('max_models', 4)
+    max_rss_gb = cache_settings.get('max_rss_gb', None)
+    while len(_model_cache) > max_models or (max_rss_gb is not None and len(_model_cache) > 1 and get_rss_gb() > max_rss_gb):
+        _model_cache.popitem(last=False)
+        gc.collect() ## release the evicted interpolators before measuring memory again
+    return lightcurve_model
+
+def clear_model_cache():
+    '''
+    removes all cached lightcurve models
+    '''
+    _model_cache.clear()
+    gc.collect()
+
+def evaluate_lightcurves(model, parameter_sets, sample_times, filters=None, settings=None):
+    '''
+    evaluates one model for a batch of parameter sets (e.g. the best fits of many objects, or many posterior draws of one
+    object) on a shared sample time grid
+    
+    Args:
+        model (dict): dictionary of model from settings.json
+        parameter_sets (list): list of parameter dictionaries (each including luminosity_distance)
+        sample_times (np.array): array of times to sample the lightcurves at
+        filters (list): filters to evaluate (default: None, all filters produced by the model). Required for models that only produce a single band
+        settings (dict): dictionary of settings from settings.json, used to construct (and cache) the model (default: None)
+    
+    Returns:
+        mags (np.ndarray): magnitudes with shape (n_sets, n_filters, n_times), nan where the model does not produce a filter
+        filters (list): filter of each row along the second axis
+    '''
+    sample_times = np.asarray(sample_times, dtype=np.float64)
+    lightcurve_model = get_cached_lightcurve_model(model, sample_times, settings=settings)
+    mags = None
+    for i, parameters in enumerate(parameter_sets):
+        _, apparent_magnitude = lightcurve_model.generate_lightcurve(sample_times, parameters=parameters)
+        absolute_magnitude = get_absolute_magnitude(parameters['luminosity_distance'], apparent_magnitude)
+        if type(absolute_magnitude) != dict: ## single band models, no way to tell the filter from the output
+            assert filters is not None and len(filters) == 1, 'Need to specify filter when passing only one band'
+            absolute_magnitude = {filters[0]:absolute_magnitude}
+        if mags is None: ## preallocated once the filters are known
+            filters = list(absolute_magnitude.keys()) if filters is None else list(filters)
+            mags = np.full((len(parameter_sets), len(filters), len(sample_times)), np.nan)
+        for j, filter in enumerate(filters):
+            if filter in absolute_magnitude:
+                mags[i, j, :] = absolute_magnitude[filter]
+    if mags is None:
+        filters = [] if filters is None else list(filters)
+        mags = np.full((0, len(filters), len(sample_times)), np.nan)
+    return mags, filters
+
+def lightcurves_to_dataframe(mags, filters, sample_times, set_columns=None):
+    '''
+    converts an array of evaluated lightcurves to a long-form dataframe (one row per set, filter and time)
+    
+    Args:
+        mags (np.ndarray): magnitudes with shape (n_sets, n_filters, n_times), as returned by evaluate_lightcurves
+        filters (list): filter of each row along the second axis
+        sample_times (np.array): array of times the lightcurves were sampled at
+        set_columns (list): list of dictionaries of constant columns for each set, e.g. model, alias and evidences (default: None)
+    
+    Returns:
+        lightcurve_df (pandas dataframe): dataframe with columns t, filter, mag and any set columns
+    '''
+    import pandas as pd
+
+    n_sets, n_filters, n_times = mags.shape
+    lightcurve_df = pd.DataFrame({'t':np.tile(np.asarray(sample_times), n_sets * n_filters),
+                                  'filter':np.tile(np.repeat(np.asarray(filters, dtype=object), n_times), n_sets),
+                                  'mag':mags.reshape(-1)})
+    if set_columns is not None and n_sets > 0:
+        for key in set_columns[0].keys():
+            lightcurve_df[key] = np.repeat(np.asarray([columns[key] for columns in set_columns]), n_filters * n_times)
+    return lightcurve_df
+
+def draw_posterior_samples(json_path, n_samples, seed=None):
+    '''
+    draws posterior samples (without replacement) from a result, reading only the drawn rows from the result store
+    
+    Args:
+        json_path (str): path to results.json file
+        n_samples (int): number of samples to draw (all samples are used if the posterior has fewer)
+        seed (int): seed of the random number generator (default: None)
+    
+    Returns:
+        samples (list): list of parameter dictionaries, in posterior order
+    '''
+    posterior = read_posterior(json_path)
+    num_samples = len(posterior['log_likelihood'])
+    idx = np.sort(np.random.default_rng(seed).choice(num_samples, size=min(n_samples, num_samples), replace=False))
+    rows = {name:np.asarray(column[idx]) for name, column in posterior.items()}
+    return [{name:float(values[i]) for name, values in rows.items()} for i in range(len(idx))]
+
+BAND_BATCH_SIZE = 16 ## posterior draws evaluated per batched call, the time budget is checked between batches
+_band_executor = None ## pool for posterior bands, created once per process rather than per (object, model)
+
+def evaluate_lightcurves_chunk(model, parameter_sets, sample_times, filters, settings, deadline=None):
+    '''
+    worker function evaluating a chunk of parameter sets (each worker process keeps its own model cache) in batches of
+    BAND_BATCH_SIZE, so that once the deadline (a time.time() timestamp) has passed it returns the sets evaluated so far
+    '''
+    mags = []
+    for start in range(0, len(parameter_sets), BAND_BATCH_SIZE):
+        if deadline is not None and time.time() > deadline:
+            break
+        mags.append(evaluate_lightcurves(model, parameter_sets[start:start + BAND_BATCH_SIZE], sample_times, filters=filters, settings=settings)[0])
+    return np.concatenate(mags, axis=0) if len(mags) > 0 else np.full((0, len(filters), len(sample_times)), np.nan)
+
+def get_band_executor(workers):
+    '''
+    retrieve the process pool used for posterior bands, kept for the lifetime of this process (replaced if the number
+    of workers changes)
+    '''
+    global _band_executor
+    if _band_executor is None or _band_executor._max_workers != workers:
+        if _band_executor is not None:
+            _band_executor.shutdown(wait=True)
+        _band_executor = ProcessPoolExecutor(max_workers=workers)
+    return _band_executor
+
+def get_posterior_bands(json_path, model, sample_times, filters, settings=None, n_samples=200, quantiles=(5, 50, 95), workers=1, max_time=None, seed=None):
+    '''
+    computes posterior predictive credible bands by evaluating posterior draws in batches, across a pool of worker
+    processes if workers > 1
+    
+    The draws are fixed by the seed before any work is distributed, and chunks are combined in draw order, so results
+    are reproducible as long as the time budget is not hit. Every chunk checks the budget between batches, so once
+    max_time has elapsed running chunks return the draws evaluated so far, chunks that have not started are cancelled
+    and the bands are computed from the draws evaluated by then. Inside a worker process (e.g. post-processing, see
+    utils.postprocess, which already runs objects in parallel) the draws are evaluated in that process, so pools are
+    never nested.
+    
+    Args:
+        json_path (str): path to results.json file
+        model (dict): dictionary of model from settings.json
+        sample_times (np.array): array of times to sample the lightcurves at
+        filters (list): filters to evaluate
+        settings (dict): dictionary of settings from settings.json (default: None)
+        n_samples (int): number of posterior draws (default: 200)
+        quantiles (tuple): percentiles of the bands (default: (5, 50, 95))
+        workers (int): number of worker processes, 1 evaluates in this process (default: 1)
+        max_time (float): wall time budget in seconds (default: None, no limit)
+        seed (int): seed used to draw the posterior samples (default: None)
+    
+    Returns:
+        bands (np.ndarray): magnitudes with shape (n_quantiles, n_filters, n_times)
+        n_evaluated (int): number of draws the bands are computed from
+    '''
+    deadline = None if max_time is None else time.time() + max_time
+    workers = 1 if multiprocessing.parent_process() is not None else workers
+    draws = draw_posterior_samples(json_path, n_samples, seed=seed)
+    chunks = [chunk for chunk in np.array_split(np.arange(len(draws)), max(1, min(len(draws), 4 * workers))) if len(chunk) > 0]
+    results = {}
+    if workers > 1:
+        executor = get_band_executor(workers)
+        futures = {executor.submit(evaluate_lightcurves_chunk, model, [draws[i] for i in chunk], sample_times, filters, settings, deadline):n for n, chunk in enumerate(chunks)}
+        wait_futures(futures, timeout=None if deadline is None else max(0, deadline - time.time()))
+        for future in futures: ## chunks not started are cancelled, running chunks stop at the deadline
+            future.cancel()
+        wait_futures(futures)
+        for future, n in futures.items():
+            if not future.cancelled():
+                results[n] = future.result()
+    else:
+        for n, chunk in enumerate(chunks):
+            if deadline is not None and time.time() > deadline:
+                break
+            results[n] = evaluate_lightcurves_chunk(model, [draws[i] for i in chunk], sample_times, filters, settings, deadline)
+    mags = np.concatenate([results[n] for n in sorted(results.keys())], axis=0) if len(results) > 0 else np.full((0, len(filters), len(sample_times)), np.nan)
+    if mags.shape[0] < len(draws):
+        print('[{}] Time budget reached, bands for {} computed from {} draws of {}'.format(current_time(), model['name'], mags.shape[0], len(draws)))
+    if mags.shape[0] == 0:
+        return np.full((len(quantiles), len(filters), len(sample_times)), np.nan), 0
+    return np.nanpercentile(mags, quantiles, axis=0), mags.shape[0]
+
+def generate_best_fit_lightcurve(json_path, model, sample_times=np.linspace(0.01, 7, 100), settings=None, **kwargs):
     '''
     Generate the best fit lightcurve from a given nmma results.json file
     
@@ -49,15 +275,19 @@ def generate_best_fit_lightcurve(json_path, model, sample_times=np.linspace(0.01
         json_path (str): path to results.json file
         model (dict): dictionary of model, including job settings from settings.json (see fitting.generate_job for better idea of intended structure)
         sample_times (np.array): array of times to sample the lightcurve at (default is 100 samples from 0.01 to 7 days)
+        settings (dict): dictionary of settings from settings.json, used to construct (and cache) the model (default: None)
+        filter (str): filter of the lightcurve for models that only produce a single band (keyword only)
         
     Returns:
         lightcurve_df (pandas dataframe): dataframe containing best fit lightcurve data
     
+    If settings['posterior_bands'] sets n_samples, posterior predictive bands are added as mag_q<percentile> columns
+    (e.g. mag_q5, mag_q50, mag_q95) and mag_unc is set to half the width of the outermost band (0 otherwise).
+    
     Todo:
-        - have some consistent method for generating uncertainties on best fit lightcurves
         - check about lightcurve filters, as I think it might be generating them all
-        - similarly, the case where there's no filter (ie the absolute magnitude is not a dictionary), there's no way to tell what the filter is. Maybe have a kwarg for filter?
     '''
+    import pandas as pd
     
     if json_path == None: ## double check this won't break when plotting (specifically thinking about the columns)
         return pd.DataFrame({'t':sample_times,
@@ -68,39 +298,26 @@ def generate_best_fit_lightcurve(json_path, model, sample_times=np.linspace(0.01
                              'alias':np.full_like(sample_times, model['alias']),})
     
     best_parameters_dict, likelihood_dict = get_best_params(json_path)
-    luminosity_distance = best_parameters_dict['luminosity_distance']
-
-    lightcurve_model = get_lightcurve_model(model)(sample_times=sample_times, model=model['name']) ## assumes the initialization of sample times is done twice in nmma (see related issue/pr in nmma)
-    
-    _, apparent_magnitude = lightcurve_model.generate_lightcurve(sample_times, parameters=best_parameters_dict)
-    absolute_magnitude = get_absolute_magnitude(luminosity_distance, apparent_magnitude)
-    
-    lightcurve_df = pd.DataFrame(columns=['t', 'filter', 'mag', 'mag_unc', 'model', 'alias'])
-    
-    if type(absolute_magnitude) == dict: ## will be a dictionary if there are multiple filters
-        filters = list(absolute_magnitude.keys())
-        for filter in filters:
-            filter_df = pd.DataFrame({'t':sample_times, 
-                                      'filter':filter, 'mag':absolute_magnitude[filter], 
-                                      'mag_unc':0.0, 
-                                      'model':model['name'], 
-                                      'alias':model['alias'], 
-                                      'log_likelihood':likelihood_dict['log_likelihood'], 
-                                      'log_evidence':likelihood_dict['log_evidence'], 
-                                      'log_evidence_err':likelihood_dict['log_evidence_err'], 
-                                      'log_bayes_factor':likelihood_dict['log_bayes_factor']})
-            lightcurve_df = pd.concat([lightcurve_df, filter_df], axis=0, ignore_index=True)
-    else:
-        assert kwargs['filter'] != None, 'Need to specify filter when passing only one band'
-        lightcurve_df = pd.DataFrame({'t':sample_times, 
-                                      'filter':kwargs['filter'], 
-                                      'mag':absolute_magnitude, 
-                                      'mag_unc':0.0, 
-                                      'model':model['name'], 
-                                      'alias':model['alias'], 
-                                      'log_likelihood':likelihood_dict['log_likelihood'], 
-                                      'log_evidence':likelihood_dict['log_evidence'], 
-                                      'log_evidence_err':likelihood_dict['log_evidence_err'], 
-                                      'log_bayes_factor':likelihood_dict['log_bayes_factor']})
-    
-    return lightcurve_df
\ No newline at end of file
+    filters = [kwargs['filter']] if kwargs.get('filter') is not None else None
+    mags, filters = evaluate_lightcurves(model, [best_parameters_dict], sample_times, filters=filters, settings=settings)
+    
+    set_columns = [{'mag_unc':0.0, 
+                    'model':model['name'], 
+                    'alias':model['alias'], 
+                    'stage':get_result_stage(json_path), ## provisional if only the triage fit has finished
+                    'log_likelihood':likelihood_dict['log_likelihood'], 
+                    'log_evidence':likelihood_dict['log_evidence'], 
+                    'log_evidence_err':likelihood_dict['log_evidence_err'], 
+                    'log_bayes_factor':likelihood_dict['log_bayes_factor']}]
+    lightcurve_df = lightcurves_to_dataframe(mags, filters, sample_times, set_columns=set_columns)
+    
+    band_settings = {} if settings is None else settings.get('posterior_bands', {})
+    if band_settings.get('n_samples', 0) > 0: ## posterior predictive bands, with mag_unc as the half width of the outer band
+        quantiles = band_settings.get('quantiles', [5, 50, 95])
+        bands, _ = get_posterior_bands(json_path, model, sample_times, filters, settings=settings, n_samples=band_settings['n_samples'],
+                                       quantiles=quantiles, workers=band_settings.get('workers', 1), max_time=band_settings.get('max_time'), seed=settings.get('seed'))
+        for quantile, band in zip(quantiles, bands):
+            lightcurve_df['mag_q{:g}'.format(quantile)] = band.reshape(-1)
+        lightcurve_df['mag_unc'] = (bands[-1] - bands[0]).reshape(-1) / 2
+    
+    return lightcurve_df
@@ -1,20 +1,14 @@
 '''
 contains functions related to plotting completed fits
 '''
-import sys
 import os
-import glob
 
 import numpy as np
 import pandas as pd
-import matplotlib
 import matplotlib.pyplot as plt
-from matplotlib.pyplot import cm
-from astropy.time import Time
-import seaborn as sns
 
 from utils.tools import current_time
-from utils.files import get_settings, get_results_json_path, get_lightcurve_data
+from utils.files import get_settings, get_results_json_path, get_lightcurve_data, atomic_write
 from utils.lightcurves import generate_best_fit_lightcurve
 
 
@@ -38,8 +32,8 @@ def combine_dataframes(data_file, settings_file, sample_times=np.linspace(0.01,
     data_df = get_lightcurve_data(data_file, remove_nondetections=settings_dict['remove_nondetections'])
     object_name = os.path.basename(data_file).split('.')[0] ## assumes that the output folder is not altered
     
-    model_result_paths = [get_results_json_path(settings_dict, object_name, model_dict) for model_dict in models_dicts]
-    model_lightcurves = [generate_best_fit_lightcurve(model_result_path, model_dict, sample_times=sample_times) for model_result_path, model_dict in zip(model_result_paths, models_dicts)]
+    model_result_paths = [get_results_json_path(settings_dict, object_name, model_dict) for model_dict in models_dicts.values()]
+    model_lightcurves = [generate_best_fit_lightcurve(model_result_path, model_dict, sample_times=sample_times, settings=settings_dict) for model_result_path, model_dict in zip(model_result_paths, models_dicts.values())]
     
     all_lightcurves = [data_df] + model_lightcurves
     combined_df = pd.concat(all_lightcurves, axis=0, ignore_index=True)
@@ -47,14 +41,65 @@ def combine_dataframes(data_file, settings_file, sample_times=np.linspace(0.01,
     return combined_df
     
 
-def plot_lightcurves(data_file, settings_file, sample_times=np.linspace(0.01,7,100)):
+_figure_templates = {} ## tuple of filters -> figure, axes and artists reused for every object observed in those filters
+
+def get_figure_template(filters):
+    '''
+    retrieve the figure template for a filter layout (one row per filter), creating it the first time the layout is used
+    
+    Args:
+        filters (list): filters of the rows of the figure
+    
+    Returns:
+        template (dict): dictionary with the figure ('fig'), axes ('axs', keyed by filter) and the artists updated for each
+            object ('detections' and 'limits' keyed by filter, 'lines' and 'bands' keyed by (filter, model))
+    '''
+    key = tuple(filters)
+    if key not in _figure_templates:
+        fig, axs = plt.subplots(len(filters), 1, figsize=(8, len(filters)*4), sharex=True, squeeze=False, facecolor='w', edgecolor='k')
+        axs = axs[:, 0]
+        template = {'fig':fig, 'axs':dict(zip(filters, axs)), 'detections':{}, 'limits':{}, 'lines':{}, 'bands':{}}
+        for filter, ax in template['axs'].items():
+            template['detections'][filter] = ax.scatter([], [], c='k', marker='o', label='data', zorder=101)
+            template['limits'][filter] = ax.scatter([], [], c='k', marker='v', label=None, zorder=100)
+            ax.set_ylim(22,12)
+            ax.grid()
+            ax.set_ylabel(f'{filter}',rotation=0, labelpad=12, fontsize=16)
+        axs[-1].set_xlabel('Time (days)', fontsize=16)
+        axs[0].set_title(' ', fontsize=16) ## reserves space for the object name when laying out the template
+        fig.tight_layout()
+        _figure_templates[key] = template
+    return _figure_templates[key]
+
+def clear_figure_templates():
+    '''
+    closes and removes all cached figure templates
+    '''
+    for template in _figure_templates.values():
+        plt.close(template['fig'])
+    _figure_templates.clear()
+
+def get_plot_formats(settings):
+    '''
+    retrieve the file formats plots are saved in: settings['plot_formats'] (default: png and pdf), or only png if settings['fast_plots'] is set
+    '''
+    if settings.get('fast_plots', False):
+        return ['png']
+    return settings.get('plot_formats', ['png', 'pdf'])
+
+def plot_lightcurves(data_file, settings_file, sample_times=np.linspace(0.01,7,100), lightcurve_df=None):
     '''
     Retrieve the best fit lightcurves from all models and plot them together with the data
     
+    The data is grouped by filter and model once, and drawn by updating the artists of a figure template that is reused
+    for every object with the same observed filters. The figure is owned by the template cache, so it should not be
+    closed by the caller (use clear_figure_templates instead).
+    
     Args:
         data_file (str): path to dat file containing lightcurve data
         settings_file (str): path to settings file
         sample_times (np.array): array of times to sample the lightcurve at (default is 100 samples from 0.01 to 7 days)
+        lightcurve_df (pandas dataframe): already combined dataframe (default: None, combined here)
         
     Returns:
         fig, axs (matplotlib figure and axis objects): figure and axis objects for the plot
@@ -62,54 +107,76 @@ def plot_lightcurves(data_file, settings_file, sample_times=np.linspace(0.01,7,1
     To-Do:
         - add an option to calculate and plot residuals (may need to be a seperate function since the models are not sampled at the same times as the data)
     '''
-    settings_dict, models_dicts = get_settings(settings_file)
+    models_dicts, settings_dict = get_settings(settings_file)
     object_name = os.path.basename(data_file).split('.')[0]
-    lightcurve_df = combine_dataframes(data_file, settings_file, sample_times=sample_times)
-    observed_filters = lightcurve_df[(lightcurve_df['mag_err'] != np.inf) & (lightcurve_df['model'] == 'data')]['filter'].unique() ## finds the filters in the real data that have observations, used to filter the models
+    lightcurve_df = combine_dataframes(data_file, settings_file, sample_times=sample_times) if lightcurve_df is None else lightcurve_df
+    data_df = lightcurve_df[lightcurve_df['model'] == 'data'] ## only data lightcurve
+    observed_filters = sorted(data_df[data_df['mag_unc'] != np.inf]['filter'].unique()) ## finds the filters in the real data that have observations, used to filter the models
     if len(observed_filters) == 0:
         print("[{}] No observations in the data file, cannot plot lightcurves".format(current_time()))
         return None, None
     
-    unfit_models = lightcurve_df[lightcurve_df['filter'].all() == np.nan]['model'].unique().tolist() ## list of models that have not been fit to the data
-    unfit_models_and_data = unfit_models + ['data']
-    fit_models = lightcurve_df['model'].unique().tolist() ## list of models (includes data and any that weren't fit to the data)
-    fit_models = [model for model in fit_models if model not in unfit_models_and_data] ## list of models that were fit to the data
+    models_df = lightcurve_df[(lightcurve_df['model'] != 'data') & lightcurve_df['filter'].isin(observed_filters) & lightcurve_df['mag'].notna()] ## only successfully fit model lightcurves
+    fit_models = models_df['model'].unique().tolist() ## list of models that were fit to the data
     if len(fit_models) == 0:
         print("[{}] No models were fit to the data, cannot plot lightcurves".format(current_time()))
         return None, None
-    data_df = lightcurve_df[lightcurve_df['model'] == 'data'] ## only data lightcurve
-    models_df = lightcurve_df[lightcurve_df['model'].isin(fit_models)] ## only successfully fit model lightcurves
-    ## probably a more elegant way to do the above
     
+    data_groups = dict(tuple(data_df.groupby('filter'))) ## grouped once rather than masked per filter
+    model_groups = dict(tuple(models_df.groupby(['filter', 'model'])))
+    band_columns = sorted([column for column in models_df.columns if column.startswith('mag_q') and models_df[column].notna().any()], key=lambda column: float(column[len('mag_q'):]))
     
-    fig, axs = plt.subplots(1,len(observed_filters), figsize=(len(8, observed_filters)*4), sharex=True, facecolor='w', edgecolor='k')
-    for filter, ax in zip(observed_filters, axs):
-        filtered_data_df = data_df[data_df['filter'] == filter]
-        filtered_data_detections_df = filtered_data_df[filtered_data_df['mag_err'] != np.inf]
-        filtered_data_df_non_detections_df = filtered_data_df[filtered_data_df['mag_err'] == np.inf]
-        filtered_models_df = models_df[models_df['filter'] == filter]
-
-        ax.scatter(filtered_data_detections_df['time'], filtered_data_detections_df['mag'], c='k', marker='o', label='data', zorder=101)
-        ax.scatter(filtered_data_df_non_detections_df['time'], filtered_data_df_non_detections_df['mag'], c='k', marker='v', label=None, zorder=100)
+    template = get_figure_template(observed_filters)
+    fig, axs = template['fig'], template['axs']
+    for line in list(template['lines'].values()) + list(template['bands'].values()): ## hide artists of models from the previous object
+        line.set_visible(False)
+        line.set_label('_nolegend_')
+    
+    t_min, t_max = np.inf, -np.inf
+    for filter, ax in axs.items():
+        filtered_data_df = data_groups.get(filter, data_df.iloc[:0])
+        detected = (filtered_data_df['mag_unc'] != np.inf).to_numpy()
+        points = filtered_data_df[['t', 'mag']].to_numpy(dtype=np.float64)
+        template['detections'][filter].set_offsets(points[detected].reshape(-1, 2))
+        template['limits'][filter].set_offsets(points[~detected].reshape(-1, 2))
+        if len(points) > 0:
+            t_min, t_max = min(t_min, points[:, 0].min()), max(t_max, points[:, 0].max())
         
-        for model in filtered_models_df['model'].unique():
-            filtered_model_df = filtered_models_df[filtered_models_df['model'] == model]
-            model_label = model + ' ({})'.format(filtered_model_df['alias'].unique()[0])
+        for model in fit_models:
+            if (filter, model) not in model_groups:
+                continue
+            filtered_model_df = model_groups[(filter, model)]
+            model_t = filtered_model_df['t'].to_numpy(dtype=np.float64)
             model_color = models_dicts[model]['color']
-            ax.plot(filtered_model_df['time'], filtered_model_df['mag'], label=model_label,c=model_color)
-        
-        ax.set_ylim(22,12)
-        ax.grid()
-        ax.set_ylabel(f'{filter}',rotation=0, labelpad=12, fontsize=16)
-        ax.legend() if ax == axs[0] else None
-        ax.set_xlabel('Time (days)', fontsize=16) if ax == axs[-1] else None
-        ax.set_title(f'{object_name}', fontsize=16)
-     
-    fig.tight_layout()
-    for ext in ['png', 'pdf']:
-        fig_save_path = os.path.join(settings_dict['output_folder'], 'lightcurve_plots', f'{object_name}_lightcurve.{ext}')
-        os.makedirs(os.path.dirname(fig_save_path), exist_ok=True)
-        fig.savefig(fig_save_path)
+            if (filter, model) not in template['lines']:
+                template['lines'][(filter, model)] = ax.plot([], [], c=model_color)[0]
+            line = template['lines'][(filter, model)]
+            provisional = 'stage' in filtered_model_df.columns and bool((filtered_model_df['stage'] == 'triage').any()) ## only the triage fit has finished
+            line.set_data(model_t, filtered_model_df['mag'].to_numpy(dtype=np.float64))
+            line.set_label(model + ' ({}{})'.format(filtered_model_df['alias'].iloc[0], ', provisional' if provisional else ''))
+            line.set_linestyle('--' if provisional else '-')
+            line.set_visible(True)
+            t_min, t_max = min(t_min, model_t.min()), max(t_max, model_t.max())
+            
+            if len(band_columns) >= 2: ## posterior predictive band (outermost percentiles)
+                lower = filtered_model_df[band_columns[0]].to_numpy(dtype=np.float64)
+                upper = filtered_model_df[band_columns[-1]].to_numpy(dtype=np.float64)
+                vertices = np.column_stack([np.concatenate([model_t, model_t[::-1]]), np.concatenate([lower, upper[::-1]])])
+                if (filter, model) not in template['bands']:
+                    template['bands'][(filter, model)] = ax.fill_between(model_t, lower, upper, color=model_color, alpha=0.2, linewidth=0)
+                band = template['bands'][(filter, model)]
+                band.set_verts([vertices])
+                band.set_visible(True)
+    
+    first_ax = axs[observed_filters[0]]
+    first_ax.set_xlim(t_min, t_max)
+    first_ax.set_title(f'{object_name}', fontsize=16)
+    first_ax.legend()
+    
+    output_folder = settings_dict.get('output_folder', os.path.join(settings_dict['fit_directory'], object_name))
+    for ext in get_plot_formats(settings_dict):
+        fig_save_path = os.path.join(output_folder, f'{object_name}_lightcurve.{ext}')
+        with atomic_write(fig_save_path) as tmp_path: ## written to a temporary file and renamed, so no partial plots are published
+            fig.savefig(tmp_path, format=ext)
         
-    return fig, axs
-    
\ No newline at end of file
+    return fig, list(axs.values())
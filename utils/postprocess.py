@@ -0,0 +1,115 @@
+'''
+post-processing of completed fits (combined dataframes and plots), run per object in a pool of worker processes
+'''
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.tools import current_time
+
+
+def use_agg_backend():
+    '''
+    switches matplotlib to the non-interactive Agg backend (used as the initializer of post-processing workers)
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+def postprocess_object(data_file, settings_file):
+    '''
+    combines the data and best fit lightcurves of an object once, then exports the combined dataframe and plots it
+
+    Args:
+        data_file (str): path to object lightcurve
+        settings_file (str): path to settings file
+
+    Returns:
+        object_name (str): name of the post-processed object
+    '''
+    use_agg_backend()
+    from utils.export import export_combined_fits
+    from utils.plotting import combine_dataframes, plot_lightcurves
+
+    combined_df = combine_dataframes(data_file, settings_file)
+    export_combined_fits(data_file, settings_file, combined_df=combined_df)
+    plot_lightcurves(data_file, settings_file, lightcurve_df=combined_df) ## the figure is a template reused by the next object in this worker
+    return os.path.basename(data_file).split('.')[0]
+
+
+class PostProcessor:
+    '''
+    pool of worker processes post-processing objects as soon as their fits complete
+
+    Args:
+        settings_file (str): path to settings file
+        workers (int): number of worker processes (default: 1)
+    '''
+    def __init__(self, settings_file, workers=1):
+        self.settings_file = settings_file
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=use_agg_backend)
+        self.futures = {}
+        self.failed_objects = []
+
+    def submit(self, finished_objects):
+        '''
+        queues objects for post-processing
+
+        Args:
+            finished_objects (dict): dictionary of object name to path to object lightcurve
+
+        Returns:
+            None
+        '''
+        for object, data_file in finished_objects.items():
+            self.futures[object] = self.executor.submit(postprocess_object, data_file, self.settings_file)
+
+    def collect(self, wait=False):
+        '''
+        retrieve the objects whose post-processing has finished since the last call
+
+        Args:
+            wait (bool): whether to wait for all queued objects first (default: False)
+
+        Returns:
+            completed_objects (list): names of objects that were post-processed successfully
+        '''
+        completed_objects = []
+        for object, future in list(self.futures.items()):
+            if not wait and not future.done():
+                continue
+            del self.futures[object]
+            try:
+                future.result()
+                completed_objects.append(object)
+            except Exception as e: ## a failed plot should not stop the other objects from being published
+                print('[{}] Post-processing of {} failed: {}'.format(current_time(), object, e))
+                self.failed_objects.append(object)
+        return completed_objects
+
+    def pop_failed(self):
+        '''
+        retrieve (and forget) the objects whose post-processing failed in calls to collect since the last call
+        '''
+        failed_objects, self.failed_objects = self.failed_objects, []
+        return failed_objects
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+def postprocess_objects(finished_objects, settings_file, workers=1):
+    '''
+    post-processes several objects in parallel and waits for all of them
+
+    Args:
+        finished_objects (dict): dictionary of object name to path to object lightcurve
+        settings_file (str): path to settings file
+        workers (int): number of worker processes (default: 1)
+
+    Returns:
+        completed_objects (list): names of objects that were post-processed successfully
+    '''
+    postprocessor = PostProcessor(settings_file, workers=min(workers, max(1, len(finished_objects))))
+    try:
+        postprocessor.submit(finished_objects)
+        return postprocessor.collect(wait=True)
+    finally:
+        postprocessor.shutdown()
@@ -0,0 +1,286 @@
+'''
+warm-start refits of objects that received new photometry after they were fit
+
+Every completed fit is kept as a version in a versions directory inside its fit directory, keyed by the hash of the
+lightcurve snapshot it was fit to, together with the trigger time it used. When an updated lightcurve contains every
+point of the latest version's snapshot plus new epochs, all of them later than the snapshot's last epoch, the object
+is refit from that version rather than from scratch: the Uniform priors are narrowed to the range of the previous
+posterior (its quantiles, padded on both sides), the previous trigger time is reused, and the fit runs with fewer live
+points. Otherwise (e.g. revised photometry, or precovery points before the previous trigger time) the object is refit
+from scratch.
+
+Narrowing a Uniform prior changes the prior volume, so the evidence of a warm-start fit is for the narrowed prior. As
+long as the new posterior is (almost) entirely inside the narrowed bounds, the evidence for the original prior is that
+evidence plus the log of the fraction of the prior volume kept. This is written next to the result file
+(<label>_result_prior.json) and applied when its result store is built (see utils.results), so warm-start evidences
+can be compared with those of other fits. When a warm-start fit finishes, its posterior is checked against the narrowed
+bounds: if more than max_edge_mass of the samples are within edge_width (a fraction of the narrowed range) of a
+narrowed bound, the new data pulls the posterior out of the narrowed prior, so the fit is rejected (not corrected,
+cataloged, cached or kept as a version) and the object is refit to the model from scratch.
+'''
+import os
+import re
+import glob
+import json
+import time
+import shutil
+
+import numpy as np
+
+from utils.tools import current_time
+from utils.conversion import load_lightcurve
+from utils.fit_cache import hash_lightcurve
+from utils.results import read_result_summary, read_posterior, get_posterior_quantiles, get_prior_volume_path
+from utils.fitting import get_fit_outdir
+
+UNIFORM_PRIOR = re.compile(r'^\s*(\w+)\s*=\s*Uniform\(')
+PRIOR_BOUND = r'({}\s*=\s*)([-+0-9.eE]+)'
+
+
+def get_refit_settings(settings):
+    '''
+    retrieve the refit settings (settings['refit']) with defaults filled in
+    '''
+    refit_settings = {'enabled':False, 'nlive':256, 'quantiles':[0.005, 0.995], 'padding':1.0, 'edge_width':0.05, 'max_edge_mass':0.02}
+    refit_settings.update(settings.get('refit', {}))
+    return refit_settings
+
+def get_latest_version(outdir):
+    '''
+    retrieve the metadata of the latest completed fit in a fit directory (None if it has no versions)
+    '''
+    versions = []
+    for metadata_path in glob.glob(os.path.join(outdir, 'versions', '*.version.json')):
+        with open(metadata_path, 'r') as f:
+            versions.append(json.load(f))
+    return max(versions, key=lambda version: version['created']) if len(versions) > 0 else None
+
+def store_result_version(record, result_file):
+    '''
+    keeps a completed fit as a version of its fit directory (called by the tracker when a fit finishes): the result
+    file (and its prior volume correction) is copied to versions/<data hash>_<result file name> with a metadata file
+    versions/<data hash>.version.json
+
+    Args:
+        record (dict): tracked fit record, with the data_hash, snapshot and trigger_time recorded at submission
+        result_file (str): path to result file
+
+    Returns:
+        metadata (dict): metadata of the version
+    '''
+    version_directory = os.path.join(record['outdir'], 'versions')
+    os.makedirs(version_directory, exist_ok=True)
+    version_id = record['data_hash'][:12]
+    version_file = os.path.join(version_directory, '{}_{}'.format(version_id, os.path.basename(result_file)))
+    shutil.copyfile(result_file, version_file)
+    if os.path.exists(get_prior_volume_path(result_file)):
+        shutil.copyfile(get_prior_volume_path(result_file), get_prior_volume_path(version_file))
+    metadata = {'data_hash':record['data_hash'], 'snapshot':record['snapshot'], 'trigger_time':record['trigger_time'],
+                'result_file':version_file, 'warm_start':record.get('warm_start'), 'job_id':record.get('job_id'), 'created':time.time()}
+    with open(os.path.join(version_directory, version_id + '.version.json'), 'w') as f:
+        json.dump(metadata, f, indent=1)
+    return metadata
+
+def write_prior_volume(record, result_file):
+    '''
+    writes the prior volume correction of a finished warm-start fit next to its result file, or removes a stale one
+    left by an earlier warm-start fit in the same directory (or by a warm-start fit that was rejected)
+    '''
+    prior_volume_path = get_prior_volume_path(result_file)
+    if record.get('warm_start') is not None and not record.get('warm_start_rejected', False):
+        with open(prior_volume_path, 'w') as f:
+            json.dump({'log_prior_volume':record['warm_start']['log_prior_volume'], 'prior':record['warm_start']['prior']}, f)
+    elif os.path.exists(prior_volume_path):
+        os.remove(prior_volume_path)
+
+def get_point_keys(lc_path):
+    '''
+    retrieve the points of a lightcurve as strings of rounded time, filter, magnitude and uncertainty (as in hash_lightcurve)
+    '''
+    lightcurve = load_lightcurve(lc_path)
+    return np.char.add(np.char.add(np.round(lightcurve.mjd, 5).astype(str), lightcurve.filter.astype(str)),
+                       np.char.add(np.round(lightcurve.mag, 4).astype(str), np.round(lightcurve.mag_unc, 4).astype(str)))
+
+def has_appended_epochs(snapshot_path, lc_path):
+    '''
+    checks whether a lightcurve holds every point of an earlier snapshot plus new ones, none of them before the
+    snapshot's last epoch (earlier points, e.g. precovery, could fall before the trigger time a refit reuses)
+    '''
+    previous_points, points = get_point_keys(snapshot_path), get_point_keys(lc_path)
+    if not (len(points) > len(previous_points) and np.isin(previous_points, points).all()):
+        return False
+    new_points = ~np.isin(points, previous_points)
+    return bool(load_lightcurve(lc_path).mjd[new_points].min() >= load_lightcurve(snapshot_path).mjd.max())
+
+def get_uniform_bounds(prior_file):
+    '''
+    retrieve the bounds of the Uniform priors of a prior file given by keyword (minimum=, maximum=)
+
+    Returns:
+        bounds (dict): dictionary of parameter name to (minimum, maximum)
+    '''
+    with open(prior_file, 'r') as f:
+        lines = f.read().splitlines()
+    bounds = {}
+    for line in lines:
+        match = UNIFORM_PRIOR.match(line)
+        values = [re.search(PRIOR_BOUND.format(bound), line) for bound in ['minimum', 'maximum']] if match else [None]
+        if None not in values:
+            bounds[match.group(1)] = (float(values[0].group(2)), float(values[1].group(2)))
+    return bounds
+
+def is_posterior_at_bounds(warm_start, result_file, settings):
+    '''
+    checks whether the posterior of a finished warm-start fit piles up against the bounds of its narrowed prior (only
+    bounds that were narrowed, a posterior against an original bound is not affected by the warm start)
+
+    Args:
+        warm_start (dict): warm start details of the fit (see get_refit_model)
+        result_file (str): path to result file of the warm-start fit
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        boolean: True if more than max_edge_mass of the samples are within edge_width of a narrowed bound of any parameter
+    '''
+    if warm_start.get('original_prior') is None or not os.path.exists(warm_start['original_prior']):
+        return False ## recorded before the check existed
+    refit_settings = get_refit_settings(settings)
+    original_bounds, narrowed_bounds = get_uniform_bounds(warm_start['original_prior']), get_uniform_bounds(warm_start['prior'])
+    columns = read_result_summary(result_file)['columns']
+    names = [name for name in narrowed_bounds if name in columns and name in original_bounds and narrowed_bounds[name] != original_bounds[name]]
+    posterior = read_posterior(result_file, columns=names)
+    for name in names:
+        samples = np.asarray(posterior[name])
+        (minimum, maximum), (original_minimum, original_maximum) = narrowed_bounds[name], original_bounds[name]
+        edge = refit_settings['edge_width'] * (maximum - minimum)
+        for narrowed, at_edge in [(minimum > original_minimum, samples <= minimum + edge), (maximum < original_maximum, samples >= maximum - edge)]:
+            if narrowed and len(samples) > 0 and at_edge.mean() > refit_settings['max_edge_mass']:
+                print('[{}] Posterior of {} piles up against its narrowed bounds [{:g}, {:g}] ({:.1%} of samples at the edge)'.format(current_time(), name, minimum, maximum, at_edge.mean()))
+                return True
+    return False
+
+def narrow_prior(prior_file, result_file, settings):
+    '''
+    narrows the Uniform priors of a prior file to the range of a previous posterior: the quantiles in settings['refit']
+    padded by padding times their spread on both sides, within the original bounds (other priors are left unchanged)
+
+    Args:
+        prior_file (str): path to bilby prior file
+        result_file (str): path to result file of the previous fit
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        prior_text (str): contents of the narrowed prior file
+        log_prior_volume (float): log of the fraction of the original prior volume kept
+    '''
+    refit_settings = get_refit_settings(settings)
+    with open(prior_file, 'r') as f:
+        lines = f.read().splitlines()
+    names = [UNIFORM_PRIOR.match(line).group(1) for line in lines if UNIFORM_PRIOR.match(line)]
+    columns = read_result_summary(result_file)['columns']
+    quantiles = get_posterior_quantiles(result_file, quantiles=refit_settings['quantiles'], columns=[name for name in names if name in columns])
+    log_prior_volume = 0.0
+    for i, line in enumerate(lines):
+        match = UNIFORM_PRIOR.match(line)
+        if match is None or match.group(1) not in quantiles:
+            continue
+        bounds = [re.search(PRIOR_BOUND.format(bound), line) for bound in ['minimum', 'maximum']]
+        if None in bounds: ## bounds given positionally
+            continue
+        minimum, maximum = float(bounds[0].group(2)), float(bounds[1].group(2))
+        lower, upper = quantiles[match.group(1)]
+        padding = refit_settings['padding'] * (upper - lower)
+        new_minimum, new_maximum = max(minimum, lower - padding), min(maximum, upper + padding)
+        if not new_minimum < new_maximum: ## e.g. a posterior collapsed onto a single value
+            continue
+        line = re.sub(PRIOR_BOUND.format('minimum'), lambda m: m.group(1) + repr(float(new_minimum)), line, count=1)
+        lines[i] = re.sub(PRIOR_BOUND.format('maximum'), lambda m: m.group(1) + repr(float(new_maximum)), line, count=1)
+        log_prior_volume += np.log((new_maximum - new_minimum) / (maximum - minimum))
+    return '\n'.join(lines) + '\n', float(log_prior_volume)
+
+def get_refit_model(object, model, settings):
+    '''
+    retrieve the warm-start version of a model for an updated object, if refits are enabled and the object's latest
+    fit to the model was to an earlier snapshot of the same lightcurve with fewer epochs
+
+    Args:
+        object (str): path to object lightcurve
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        refit_model (dict): dictionary of model with the narrowed prior, reduced nlive, previous trigger time and
+            warm_start details (None if the object should be fit from scratch)
+    '''
+    refit_settings = get_refit_settings(settings)
+    if not refit_settings['enabled']:
+        return None
+    outdir = get_fit_outdir(object, model, settings)
+    previous = get_latest_version(outdir)
+    if previous is None or previous['data_hash'] == hash_lightcurve(object) or not os.path.exists(previous['snapshot']):
+        return None
+    if not has_appended_epochs(previous['snapshot'], object):
+        print('[{}] {} changed other than by later epochs, refitting {} from scratch'.format(current_time(), os.path.basename(object), model['name']))
+        return None
+    prior_text, log_prior_volume = narrow_prior(model['prior'], previous['result_file'], settings)
+    prior_path = os.path.join(outdir, model['name'] + '.warm.prior')
+    with open(prior_path, 'w') as f:
+        f.write(prior_text)
+    warm_start = {'previous':previous['data_hash'], 'previous_result_file':previous['result_file'], 'prior':prior_path,
+                  'original_prior':model['prior'], 'log_prior_volume':log_prior_volume, 'trigger_time':previous['trigger_time']}
+    print('[{}] Warm-start refit of {} {} from {} (prior volume reduced by {:.1f} in log)'.format(current_time(), os.path.basename(object), model['name'], previous['data_hash'][:12], -log_prior_volume))
+    return dict(model, prior=prior_path, nlive=min(refit_settings['nlive'], model['nlive']), trigger_time=previous['trigger_time'], warm_start=warm_start)
+
+def split_refits(objects, model, settings):
+    '''
+    separates the updated objects that can be refit from an earlier fit to a model from those fit from scratch
+
+    Args:
+        objects (list): paths to object lightcurves
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        new_objects (list): paths to object lightcurves to fit from scratch
+        refits (list): list of (path to object lightcurve, warm-start model) pairs
+    '''
+    new_objects, refits = [], []
+    for object in objects:
+        refit_model = get_refit_model(object, model, settings)
+        if refit_model is None:
+            new_objects.append(object)
+        else:
+            refits.append((object, refit_model))
+    return new_objects, refits
+
+def restart_rejected_refits(settings, models, backend):
+    '''
+    refits from scratch the objects whose warm-start fit was rejected by is_posterior_at_bounds, marking the rejected
+    fits as restarted so this is done once (the tracker is reloaded after submitting, as the backend records the new fits)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        models (dict): dictionary of models from settings.json
+        backend (SlurmBackend, LocalBackend or FitQueue): execution backend
+
+    Returns:
+        num_restarted (int): number of fits submitted from scratch
+    '''
+    from utils.tracking import load_fit_states, save_fit_states, ingest_submissions, fit_key ## imported here to avoid a circular import with utils.tracking
+    rejected = [record for record in load_fit_states(settings)['fits'].values() if record.get('warm_start_rejected', False) and not record.get('restarted', False)]
+    if len(rejected) == 0:
+        return 0
+    num_restarted = 0
+    for record in rejected:
+        if record['model'] in models:
+            print('[{}] Refitting {} {} from scratch after its warm start was rejected'.format(current_time(), record['object'], record['model']))
+            backend.submit([record['data']], models[record['model']]) ## the model from settings.json, without the narrowed prior
+            num_restarted += 1
+    tracker = load_fit_states(settings)
+    ingest_submissions(settings, tracker)
+    for record in rejected: ## rejected fits not replaced by their resubmission
+        tracked = tracker['fits'].get(fit_key(record['object'], record['model']))
+        if tracked is not None and tracked.get('job_id') == record.get('job_id'):
+            tracked['restarted'] = True
+    save_fit_states(settings, tracker)
+    return num_restarted
@@ -0,0 +1,266 @@
+'''
+compact, memory-mappable store for the parts of bilby result files used by the pipeline (posterior and evidences)
+
+Each <label>_result.json is converted once (streamed with ijson when it is installed) into a <label>_result_store directory
+next to it, holding one .npy file per posterior column and a small summary.json header with the evidence values and the
+size, mtime and hash of the source file. The evidences of warm-start refits are corrected for their narrowed prior (see
+utils.refit) using the <label>_result_prior.json written next to the result file.
+'''
+import os
+import json
+import array
+import hashlib
+
+import numpy as np
+
+try: ## optional, lets result files be converted in a single streaming pass without decoding the whole json
+    import ijson
+except ImportError:
+    ijson = None
+
+SUMMARY_FIELDS = ['log_evidence', 'log_evidence_err', 'log_bayes_factor', 'log_noise_evidence']
+
+
+def get_store_path(json_path):
+    '''
+    retrieve the path to the store directory of a result file
+    '''
+    return os.path.splitext(json_path)[0] + '_store'
+
+def get_prior_volume_path(json_path):
+    '''
+    retrieve the path to the prior volume correction of a warm-start refit's result file (see utils.refit)
+    '''
+    return os.path.splitext(json_path)[0] + '_prior.json'
+
+def read_prior_volume(json_path):
+    '''
+    retrieve the log prior volume correction of a result file (None if it is not a warm-start refit)
+    '''
+    prior_volume_path = get_prior_volume_path(json_path)
+    if not os.path.exists(prior_volume_path):
+        return None
+    with open(prior_volume_path, 'r') as f:
+        return json.load(f)['log_prior_volume']
+
+def hash_json(json_path):
+    sha = hashlib.sha1()
+    with open(json_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def get_posterior_columns(posterior):
+    '''
+    retrieve the posterior columns from a decoded result, whether stored by bilby as an encoded dataframe
+    ({'__dataframe__': True, 'content': {...}}) or as a plain dictionary of lists
+
+    Args:
+        posterior (dict): posterior entry of the result file
+
+    Returns:
+        columns (dict): dictionary of column name to list of samples
+    '''
+    if isinstance(posterior, dict) and posterior.get('__dataframe__', False):
+        return posterior['content']
+    return posterior
+
+def read_summary(store_path):
+    with open(os.path.join(store_path, 'summary.json'), 'r') as f:
+        return json.load(f)
+
+def is_store_valid(json_path, store_path):
+    '''
+    checks whether a store is up to date with its source result file (same size and mtime, or same contents hash if only
+    the mtime changed) and with its prior volume correction
+
+    Args:
+        json_path (str): path to result file
+        store_path (str): path to store directory
+
+    Returns:
+        boolean: True if the store can be used, False if it needs to be (re)built
+    '''
+    if not os.path.exists(os.path.join(store_path, 'summary.json')):
+        return False
+    summary = read_summary(store_path)
+    if summary.get('log_prior_volume') != read_prior_volume(json_path):
+        return False
+    source = summary['source']
+    stat = os.stat(json_path)
+    if source['size'] != stat.st_size:
+        return False
+    return source['mtime'] == stat.st_mtime or source['sha1'] == hash_json(json_path)
+
+def stream_result_file(json_path):
+    '''
+    reads the top-level scalar fields and numeric posterior columns of a result file in a single pass with an incremental
+    json parser, holding each column as a compact array of doubles rather than a list of python objects
+
+    Args:
+        json_path (str): path to result file
+
+    Returns:
+        fields (dict): top-level scalar fields (e.g. label, log_evidence)
+        columns (dict): dictionary of posterior column name to np.ndarray
+    '''
+    fields, columns, skipped = {}, {}, set()
+    with open(json_path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix.startswith('posterior.'):
+                if not prefix.endswith('.item'):
+                    continue
+                name = prefix[len('posterior.'):-len('.item')]
+                name = name[len('content.'):] if name.startswith('content.') else name ## bilby encoded dataframe
+                if event == 'number' and name not in skipped:
+                    columns.setdefault(name, array.array('d')).append(value)
+                elif event != 'number':
+                    skipped.add(name) ## non-numeric column
+            elif '.' not in prefix and event in ['number', 'string', 'boolean', 'null']:
+                fields[prefix] = value
+    return fields, {name:np.frombuffer(values, dtype=np.float64) for name, values in columns.items() if name not in skipped}
+
+def load_result_file(json_path):
+    '''
+    reads the top-level fields and numeric posterior columns of a result file, streaming it if ijson is installed and
+    falling back to decoding the whole file otherwise
+
+    Args:
+        json_path (str): path to result file
+
+    Returns:
+        fields (dict): top-level fields
+        columns (dict): dictionary of posterior column name to np.ndarray
+    '''
+    if ijson is not None:
+        try:
+            return stream_result_file(json_path)
+        except ijson.common.IncompleteJSONError: ## e.g. NaN/Infinity values not accepted by the ijson backend
+            pass
+    with open(json_path, 'r') as f:
+        results = json.load(f)
+    columns = {}
+    for name, values in get_posterior_columns(results.pop('posterior', {})).items():
+        try:
+            columns[name] = np.asarray(values, dtype=np.float64)
+        except (TypeError, ValueError): ## non-numeric columns are not needed for the lightcurves
+            continue
+    return results, columns
+
+def build_result_store(json_path):
+    '''
+    converts a bilby result file into a store of one .npy file per numeric posterior column plus a summary header
+
+    Args:
+        json_path (str): path to result file
+
+    Returns:
+        summary (dict): summary header of the store (evidences, number of samples, columns and source file details)
+    '''
+    store_path = get_store_path(json_path)
+    stat = os.stat(json_path)
+    fields, columns = load_result_file(json_path)
+
+    tmp_path = '{}.{}.tmp'.format(store_path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), values)
+
+    summary = {field:fields.get(field) for field in SUMMARY_FIELDS}
+    summary['log_prior_volume'] = read_prior_volume(json_path)
+    if summary['log_prior_volume'] is not None: ## evidence for the original prior rather than the narrowed one
+        for field in ['log_evidence', 'log_bayes_factor']:
+            if summary[field] is not None:
+                summary[field] += summary['log_prior_volume']
+    summary.update(label=fields.get('label'), num_samples=len(next(iter(columns.values()), [])), columns=list(columns.keys()),
+                   source={'path':os.path.abspath(json_path), 'size':stat.st_size, 'mtime':stat.st_mtime, 'sha1':hash_json(json_path)})
+    with open(os.path.join(tmp_path, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+
+    if os.path.exists(store_path): ## replace an outdated store
+        old_path = '{}.{}.old'.format(store_path, os.getpid())
+        os.rename(store_path, old_path)
+        os.rename(tmp_path, store_path)
+        for name in os.listdir(old_path):
+            os.remove(os.path.join(old_path, name))
+        os.rmdir(old_path)
+    else:
+        os.rename(tmp_path, store_path)
+    return summary
+
+def ensure_result_store(json_path):
+    '''
+    retrieve the path to an up-to-date store for a result file, building it if it is missing or outdated
+
+    Args:
+        json_path (str): path to result file
+
+    Returns:
+        store_path (str): path to store directory
+    '''
+    store_path = get_store_path(json_path)
+    if not is_store_valid(json_path, store_path):
+        build_result_store(json_path)
+    return store_path
+
+def read_result_summary(json_path):
+    '''
+    retrieve the evidences and store details of a result without loading the posterior
+
+    Args:
+        json_path (str): path to result file
+
+    Returns:
+        summary (dict): summary header (keys include log_evidence, log_evidence_err, log_bayes_factor, num_samples, columns)
+    '''
+    return read_summary(ensure_result_store(json_path))
+
+def read_posterior(json_path, columns=None):
+    '''
+    retrieve posterior columns of a result as memory-mapped arrays, so only the columns (and pages) used are read from disk
+
+    Args:
+        json_path (str): path to result file
+        columns (list): names of columns to read (default: None, all numeric columns)
+
+    Returns:
+        posterior (dict): dictionary of column name to memory-mapped np.ndarray
+    '''
+    store_path = ensure_result_store(json_path)
+    columns = read_summary(store_path)['columns'] if columns is None else columns
+    return {name:np.load(os.path.join(store_path, name + '.npy'), mmap_mode='r') for name in columns}
+
+def get_top_samples(json_path, top_k=1):
+    '''
+    retrieve the top_k posterior samples with the highest log likelihood, reading only the selected rows of each column
+
+    Args:
+        json_path (str): path to result file
+        top_k (int): number of samples (default: 1, the maximum likelihood sample)
+
+    Returns:
+        samples (list): list of dictionaries of parameter values, ordered by decreasing log likelihood
+    '''
+    posterior = read_posterior(json_path)
+    log_likelihood = np.asarray(posterior['log_likelihood'])
+    top_k = min(top_k, len(log_likelihood))
+    idx = np.argpartition(-log_likelihood, top_k - 1)[:top_k] ## O(n) selection rather than a full sort
+    idx = idx[np.argsort(-log_likelihood[idx])]
+    rows = {name:np.asarray(column[np.sort(idx)]) for name, column in posterior.items()}
+    order = np.searchsorted(np.sort(idx), idx)
+    return [{name:float(values[i]) for name, values in rows.items()} for i in order]
+
+def get_posterior_quantiles(json_path, quantiles=(0.05, 0.5, 0.95), columns=None):
+    '''
+    retrieve posterior quantiles of each parameter, e.g. for uncertainty bands
+
+    Args:
+        json_path (str): path to result file
+        quantiles (tuple): quantiles to compute (default: (0.05, 0.5, 0.95))
+        columns (list): names of columns (default: None, all numeric columns)
+
+    Returns:
+        quantiles_dict (dict): dictionary of column name to np.ndarray of quantile values
+    '''
+    posterior = read_posterior(json_path, columns=columns)
+    return {name:np.quantile(column, quantiles) for name, column in posterior.items()}
@@ -1,17 +1,15 @@
 '''
 Contains all miscellaneous functions that are used for the project.
+
+bilby and nmma are imported by the functions that use them, so scanning and job submission do not load them.
 '''
 import os
 import json
 import time
 
 import numpy as np
-import pandas as pd
-import bilby
-
-from astropy.time import Time
 
-from nmma.em.model import *
+from utils.conversion import load_lightcurve, jd_to_isot, apply_upper_limits, write_dat
 
 
 def current_time():
@@ -31,29 +29,21 @@ def parse_csv(infile, outdir=False):
     Returns:
         out_data (list): list of lists containing data in the format desired by NMMA
     '''
-    in_data = np.genfromtxt(infile, dtype=None, delimiter=',', skip_header = 1, encoding = None)
+    in_data = np.atleast_1d(np.genfromtxt(infile, dtype=None, delimiter=',', skip_header = 1, encoding = None))
     # Candidates are given keys that address a 2D array with
     # photometry data
-    out_data = []
-    for line in np.atleast_1d(in_data):
-        #extract time and put in isot format
-        time = Time(line[1], format='jd').isot
-        filter = line[4]
-        magnitude = line[2]
-        error = line[3]
-        if 99.0 == magnitude:
-            magnitude = line[5]
-            error = np.inf
-        out_data.append([str(time), filter, str(magnitude), str(error)])
+    columns = [in_data[name] for name in in_data.dtype.names]
+    #extract time and put in isot format (converted for all rows at once)
+    times = jd_to_isot(columns[1])
+    filters = columns[4].astype(str)
+    magnitudes, errors = apply_upper_limits(columns[2], columns[3], columns[5]) ## non-detections (mag of 99.0) become upper limits
+    out_data = np.column_stack([times, filters, magnitudes.astype(str), errors.astype(str)]).tolist()
     if outdir:
         os.makedirs(outdir, exist_ok = True)
         # output the data
         # in the format desired by NMMA
         candname = infile.split('/')[-1].split('.')[0]
-        out_file = open(outdir + candname + ".dat", 'w')
-        for line in out_data:
-            out_file.write(line[0] + " " + line[1] + " " + line[2] + " " + line[3] + "\n")
-        out_file.close()
+        write_dat(os.path.join(outdir, candname + ".dat"), times, filters, magnitudes, errors)
 
     return out_data
 
@@ -67,9 +57,9 @@ def get_filters(object):
     Returns:
         filters (list): list of filters detected for object
     '''
-    data = pd.read_csv(object, sep=' ', header=None, names=['time','filter','mag','mag_err'])
-    filters = data['filter'].unique()
-    return filters
+    filters = load_lightcurve(object).filter
+    _, first_index = np.unique(filters, return_index=True)
+    return filters[np.sort(first_index)] ## in order of first appearance
 
 
 def read_results_json(jsonPath):
@@ -82,6 +72,7 @@ def read_results_json(jsonPath):
     Returns:
         results (dict): dictionary of results
     '''
+    import bilby
     
     with open(jsonPath) as f:
         results = json.load(f, object_hook=bilby.core.utils.decode_bilby_json)
@@ -98,8 +89,10 @@ def get_lightcurve_model(model):
     Returns:
         lightcurve_model (class): lightcurve model from nmma
     '''
+    import nmma.em.model
+    
     model_function_name = model['model']
-    model_function = eval(model_function_name)
+    model_function = getattr(nmma.em.model, model_function_name)
     return model_function
 
 
@@ -0,0 +1,372 @@
+'''
+tracks the state of submitted fits through the scheduler and the result files they produce
+'''
+import os
+import glob
+import json
+import time
+import subprocess
+
+from utils.tools import current_time
+from utils.files import get_state_path
+from utils.fitting import get_scheduler_command
+from utils.results import ensure_result_store
+from utils.catalog import catalog_fits
+from utils.fit_cache import store_fit
+from utils.budget import record_runtimes, parse_slurm_time, parse_memory
+from utils.refit import write_prior_volume, store_result_version, is_posterior_at_bounds
+
+## fit states, each (object, model) pair moves from pending -> running -> done/failed/timed-out
+## (fits held in the fit queue, see utils.fit_queue, are queued until they are submitted)
+QUEUED = 'queued'
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+TIMED_OUT = 'timed-out'
+TERMINAL_STATES = [DONE, FAILED, TIMED_OUT]
+
+## mapping of slurm job states (squeue %T / sacct State) to fit states
+SLURM_STATES = {
+    'PENDING':PENDING, 'CONFIGURING':PENDING, 'REQUEUED':PENDING, 'SUSPENDED':PENDING,
+    'RUNNING':RUNNING, 'COMPLETING':RUNNING, 'STAGE_OUT':RUNNING,
+    'COMPLETED':FAILED, ## a completed job without a result file has failed
+    'FAILED':FAILED, 'CANCELLED':FAILED, 'OUT_OF_MEMORY':FAILED, 'NODE_FAIL':FAILED, 'BOOT_FAIL':FAILED, 'PREEMPTED':FAILED,
+    'TIMEOUT':TIMED_OUT, 'DEADLINE':TIMED_OUT,
+}
+
+
+def fit_key(object, model):
+    return '{}/{}'.format(object, model)
+
+def load_fit_states(settings):
+    '''
+    loads the tracked fit states from the state directory
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        tracker (dict): dictionary with the submissions log offset ('offset') and a dictionary of fit records keyed by 'object/model' ('fits')
+    '''
+    states_path = get_state_path(settings, 'fit_states.json')
+    if not os.path.exists(states_path):
+        return {'offset':0, 'fits':{}}
+    with open(states_path, 'r') as f:
+        return json.load(f)
+
+def save_fit_states(settings, tracker):
+    '''
+    atomically writes the tracked fit states to the state directory
+    '''
+    states_path = get_state_path(settings, 'fit_states.json')
+    tmp_path = states_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(tracker, f, indent=1)
+    os.replace(tmp_path, states_path)
+
+def ingest_submissions(settings, tracker):
+    '''
+    adds fits recorded in submissions.jsonl since the last tick to the tracker as pending (a resubmission resets the state)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        tracker (dict): tracker loaded with load_fit_states (modified in place)
+
+    Returns:
+        num_new (int): number of submissions ingested
+    '''
+    submissions_path = get_state_path(settings, 'submissions.jsonl')
+    if not os.path.exists(submissions_path):
+        return 0
+    num_new = 0
+    with open(submissions_path, 'r') as f:
+        f.seek(tracker['offset'])
+        for line in iter(f.readline, ''):
+            if not line.endswith('\n'): ## partially written record, read again next tick
+                break
+            record = json.loads(line)
+            record.update(state=PENDING, updated=time.time(), published=False)
+            tracker['fits'][fit_key(record['object'], record['model'])] = record
+            tracker['offset'] = f.tell()
+            num_new += 1
+    return num_new
+
+def mark_queued(settings, records):
+    '''
+    adds fits waiting in the fit queue to the tracker (or moves preempted fits back to it), so their objects are not
+    considered finished before they have been submitted
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        records (list): list of dictionaries with keys object, model, outdir and data
+
+    Returns:
+        None
+    '''
+    tracker = load_fit_states(settings)
+    ingest_submissions(settings, tracker) ## earlier submissions of these fits are superseded
+    for record in records:
+        tracker['fits'][fit_key(record['object'], record['model'])] = dict(record, job_id=None, state=QUEUED, submitted=time.time(), updated=time.time(), published=False)
+    save_fit_states(settings, tracker)
+
+def find_result_file(outdir, since=0):
+    '''
+    retrieve the bilby result file of a fit if it exists
+
+    Args:
+        outdir (str): path to fit output directory
+        since (float): ignore result files last modified before this time, e.g. from a previous fit of the object (default: 0)
+
+    Returns:
+        result_file (str): path to result file (None if the fit has not produced one)
+    '''
+    result_files = [result_file for result_file in glob.glob(os.path.join(outdir, '*_result.json')) if os.path.getmtime(result_file) >= since]
+    return sorted(result_files)[-1] if len(result_files) > 0 else None
+
+def query_scheduler(settings, job_ids):
+    '''
+    retrieves the states of a set of jobs with one squeue call, falling back to one sacct call for jobs that have left the queue
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        job_ids (list): list of slurm job ids (array tasks as <array job id>_<task id>)
+
+    Returns:
+        job_states (dict): dictionary of job id to slurm job state (jobs unknown to the scheduler are omitted)
+    '''
+    job_states = {}
+    queries = [
+        [get_scheduler_command(settings, 'squeue'), '--noheader', '--array', '--format=%i|%T'],
+        [get_scheduler_command(settings, 'sacct'), '--noheader', '--parsable2', '--allocations', '--format=JobID,State'],
+    ]
+    for query in queries:
+        missing = [job_id for job_id in job_ids if job_id not in job_states]
+        if len(missing) == 0:
+            break
+        query = query + ['--jobs=' + ','.join(missing)]
+        try:
+            result = subprocess.run(query, capture_output=True, text=True)
+        except OSError as e: ## scheduler command not available
+            print('[{}] Could not query scheduler with {}: {}'.format(current_time(), query[0], e))
+            continue
+        for line in result.stdout.splitlines():
+            if '|' not in line:
+                continue
+            job_id, state = line.strip().split('|')[:2]
+            job_states.setdefault(job_id, state.split()[0]) ## sacct reports e.g. 'CANCELLED by 1234'
+    return job_states
+
+def query_accounting(settings, job_ids):
+    '''
+    retrieves the elapsed time and peak memory of finished jobs with one sacct call, for the cost model of the sampler budget
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        job_ids (list): list of slurm job ids (array tasks as <array job id>_<task id>)
+
+    Returns:
+        accounting (dict): dictionary of job id to {'elapsed' (seconds), 'max_rss' (bytes)} (jobs unknown to sacct are omitted)
+    '''
+    if len(job_ids) == 0:
+        return {}
+    query = [get_scheduler_command(settings, 'sacct'), '--noheader', '--parsable2', '--format=JobID,Elapsed,MaxRSS', '--jobs=' + ','.join(job_ids)]
+    try:
+        result = subprocess.run(query, capture_output=True, text=True)
+    except OSError as e:
+        print('[{}] Could not query accounting with {}: {}'.format(current_time(), query[0], e))
+        return {}
+    accounting = {}
+    for line in result.stdout.splitlines():
+        if line.count('|') < 2:
+            continue
+        step_id, elapsed, max_rss = line.strip().split('|')[:3]
+        job_id = step_id.split('.')[0] ## the allocation reports the elapsed time, its steps (e.g. <job id>.batch) the memory
+        job_accounting = accounting.setdefault(job_id, {'elapsed':None, 'max_rss':None})
+        if step_id == job_id and elapsed:
+            job_accounting['elapsed'] = parse_slurm_time(elapsed)
+        if parse_memory(max_rss) is not None:
+            job_accounting['max_rss'] = max(job_accounting['max_rss'] or 0, parse_memory(max_rss))
+    return accounting
+
+def query_local_jobs(records):
+    '''
+    retrieves the states of fits run by the local backend from the <model>.status files it writes
+
+    Args:
+        records (list): list of tracked fit records with local job ids
+
+    Returns:
+        job_states (dict): dictionary of job id to slurm-style job state (fits that have not started are omitted)
+    '''
+    job_states = {}
+    for record in records:
+        status_file = os.path.join(record['outdir'], record['model'] + '.status')
+        if not os.path.exists(status_file) or os.path.getmtime(status_file) < record['submitted']:
+            continue
+        with open(status_file, 'r') as f:
+            status = f.read().strip()
+        job_states[record['job_id']] = 'RUNNING' if status == 'running' else 'COMPLETED' if status == '0' else 'FAILED'
+    return job_states
+
+def update_fit_states(settings, models=None):
+    '''
+    advances the state machine of every tracked fit: result files mark fits as done, otherwise the state is taken from a
+    single batched scheduler query (or the status files of the local backend), and fits exceeding the timeout in
+    settings.json are marked as timed-out. Fits are added to the catalog (see utils.catalog) as they finish, and their
+    runtimes are recorded for the sampler budget (see utils.budget).
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        models (dict): dictionary of models from settings.json, used for the model aliases in the catalog (default: None)
+
+    Returns:
+        tracker (dict): updated tracker (also saved to the state directory)
+    '''
+    tracker = load_fit_states(settings)
+    ingest_submissions(settings, tracker)
+    active = [record for record in tracker['fits'].values() if record['state'] not in TERMINAL_STATES]
+
+    ## the scheduler is queried before the result files are globbed, so a job completing in between is not taken for a
+    ## completed job without a result file (and marked as failed) while its result file is written
+    local = [record for record in active if str(record.get('job_id')).startswith('local-')]
+    job_states = query_local_jobs(local)
+    job_states.update(query_scheduler(settings, [record['job_id'] for record in active if record.get('job_id') and record not in local]))
+
+    unfinished, finished = [], []
+    for record in active:
+        result_file = find_result_file(record['outdir'], since=record['submitted'])
+        if result_file is not None:
+            try:
+                write_prior_volume(record, result_file) ## before the store is built, as it corrects the evidence of warm-start refits
+                ensure_result_store(result_file) ## converted once, as soon as the fit finishes
+                if record.get('warm_start') is not None and is_posterior_at_bounds(record['warm_start'], result_file, settings):
+                    print('[{}] Rejecting warm start of {} {}, it is refit from scratch'.format(current_time(), record['object'], record['model']))
+                    record['warm_start_rejected'] = True ## resubmitted by utils.refit.restart_rejected_refits
+                    write_prior_volume(record, result_file) ## the correction does not hold, so the store is rebuilt without it
+                    ensure_result_store(result_file)
+            except ValueError: ## result file still being written, checked again next tick
+                unfinished.append(record)
+                continue
+            record.update(state=DONE, result_file=result_file, updated=time.time())
+            if record.get('warm_start_rejected', False):
+                continue ## not cached, versioned or cataloged
+            if record.get('fit_key') is not None: ## cached so identical fits submitted later reuse it
+                store_fit(settings, record['fit_key'], record['object'], record['model'], result_file)
+            if record.get('data_hash') is not None: ## kept per data snapshot, so a later version of the object can be refit from it
+                store_result_version(record, result_file)
+            finished.append(record)
+        else:
+            unfinished.append(record)
+
+    timeout = settings['timeout'] * 60 * 60 ## timeout in seconds (default of 8 hours)
+    for record in unfinished:
+        state = SLURM_STATES.get(job_states.get(record.get('job_id')), record['state'])
+        if state not in TERMINAL_STATES + [QUEUED] and time.time() - record['submitted'] > timeout:
+            state = TIMED_OUT
+        if state != record['state']:
+            print('[{}] {} {} is {}'.format(current_time(), record['object'], record['model'], state))
+            record.update(state=state, updated=time.time())
+
+    save_fit_states(settings, tracker)
+    if settings.get('catalog', True) and len(finished) > 0:
+        catalog_fits(settings, finished, models=models)
+    submitted = [record for record in finished if not str(record.get('job_id')).startswith('cached-')]
+    if len(submitted) > 0:
+        record_runtimes(settings, submitted, accounting=query_accounting(settings, [record['job_id'] for record in submitted
+                                                                                   if record.get('job_id') and not record['job_id'].startswith('local-')]))
+    return tracker
+
+def get_finished_objects(tracker):
+    '''
+    retrieve the objects whose fits have all reached a terminal state but have not yet been published
+
+    Args:
+        tracker (dict): tracker returned by update_fit_states
+
+    Returns:
+        finished_objects (dict): dictionary of object name to path to object lightcurve
+    '''
+    object_states = {}
+    for record in tracker['fits'].values():
+        object_states.setdefault(record['object'], []).append(record)
+    return {object:records[0]['data'] for object, records in sorted(object_states.items())
+            if all(record['state'] in TERMINAL_STATES for record in records)
+            and not all(record['published'] for record in records)}
+
+def get_submitted_models(settings, since):
+    '''
+    retrieve the models each object has had a fit recorded for (submitted, reused from the fit cache or queued) since a given time
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        since (float): time after which fits count
+
+    Returns:
+        submitted_models (dict): dictionary of object name to set of model names
+    '''
+    tracker = load_fit_states(settings)
+    ingest_submissions(settings, tracker) ## not saved, the fits are ingested by the next update_fit_states
+    submitted_models = {}
+    for record in tracker['fits'].values():
+        if record['submitted'] >= since:
+            submitted_models.setdefault(record['object'], set()).add(record['model'])
+    return submitted_models
+
+def is_finished(tracker, objects):
+    '''
+    checks whether all tracked fits of the given objects have reached a terminal state
+
+    Args:
+        tracker (dict): tracker returned by update_fit_states
+        objects (list): list of object names
+
+    Returns:
+        boolean: True if no fit of these objects is pending or running, False otherwise
+    '''
+    return all(record['state'] in TERMINAL_STATES for record in tracker['fits'].values() if record['object'] in objects)
+
+def mark_published(settings, objects):
+    '''
+    marks all tracked fits of the given objects as published so they are not post-processed again
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        objects (list): list of object names
+
+    Returns:
+        None
+    '''
+    tracker = load_fit_states(settings)
+    for record in tracker['fits'].values():
+        if record['object'] in objects and record['state'] in TERMINAL_STATES:
+            record['published'] = True
+    save_fit_states(settings, tracker)
+
+def release_failed_objects(settings, objects):
+    '''
+    marks the fits of objects whose post-processing failed as unpublished again, so they are post-processed by the next
+    tick (at most settings['postprocess_retries'] times, default 3, after which they are left as published)
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        objects (list): list of object names
+
+    Returns:
+        None
+    '''
+    if len(objects) == 0:
+        return
+    max_retries = settings.get('postprocess_retries', 3)
+    tracker = load_fit_states(settings)
+    for record in tracker['fits'].values():
+        if record['object'] in objects and record['state'] in TERMINAL_STATES:
+            record['postprocess_failures'] = record.get('postprocess_failures', 0) + 1
+            record['published'] = record['postprocess_failures'] > max_retries
+    save_fit_states(settings, tracker)
+    for object in objects:
+        failures = max([record.get('postprocess_failures', 0) for record in tracker['fits'].values() if record['object'] == object] + [0])
+        if failures > max_retries:
+            print('[{}] Post-processing of {} failed {} times, giving up'.format(current_time(), object, failures))
+        else:
+            print('[{}] Post-processing of {} will be retried next tick'.format(current_time(), object))
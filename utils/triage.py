@@ -0,0 +1,117 @@
+'''
+two-stage fitting: every model is first fit cheaply (low nlive, coarse dt, short walltime) so provisional evidences and
+best fit lightcurves are published within minutes, then only the models still competitive by Bayes factor are fit in full
+
+Triage fits are written to a triage directory inside the model's fit directory and tracked with stage 'triage'. Once
+all triage fits of an object have finished (and the object has been post-processed and published with them), the
+models whose log evidence is within max_log_bayes_factor of the best one are submitted for a full fit, which replaces
+the triage result in the outputs of the object as it finishes. Models whose triage fit failed or timed out are also
+fit in full. Triage fits have their own fit cache keys, so they are reused like full fits.
+'''
+from utils.tools import current_time
+from utils.results import read_result_summary
+from utils.tracking import load_fit_states, save_fit_states, ingest_submissions, fit_key, DONE, TERMINAL_STATES
+
+TRIAGE = 'triage'
+
+
+def get_triage_settings(settings):
+    '''
+    retrieve the triage settings (settings['triage']) with defaults filled in
+    '''
+    triage_settings = {'enabled':False, 'nlive':128, 'dt':0.5, 'time':'00:29:59', 'max_log_bayes_factor':5}
+    triage_settings.update(settings.get('triage', {}))
+    return triage_settings
+
+def get_stage_model(model, settings):
+    '''
+    retrieve the model to submit for a new object: its triage version if triage is enabled in settings.json, otherwise the model itself
+
+    Args:
+        model (dict): dictionary of model from settings.json
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        model (dict): dictionary of model to submit
+    '''
+    triage_settings = get_triage_settings(settings)
+    if not triage_settings['enabled']:
+        return model
+    return dict(model, stage=TRIAGE, nlive=min(triage_settings['nlive'], model['nlive']), dt=max(triage_settings['dt'], model['dt']),
+                job=dict(model['job'], time=triage_settings['time']))
+
+def get_competitive_models(records, settings):
+    '''
+    selects the models to fit in full from the finished triage fits of an object
+
+    Args:
+        records (list): tracked triage fit records of one object
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        competitive_models (list): names of models within max_log_bayes_factor of the best log evidence, or whose triage fit did not complete
+        log_evidences (dict): dictionary of model name to triage log evidence (completed fits only)
+    '''
+    log_evidences = {}
+    for record in records:
+        if record['state'] != DONE:
+            continue
+        try:
+            log_evidences[record['model']] = read_result_summary(record['result_file'])['log_evidence']
+        except (OSError, ValueError, KeyError) as e:
+            print('[{}] Could not read the triage evidence of {} {}: {}'.format(current_time(), record['object'], record['model'], e))
+    best_log_evidence = max(log_evidences.values()) if len(log_evidences) > 0 else None
+    max_log_bayes_factor = get_triage_settings(settings)['max_log_bayes_factor']
+    competitive_models = [record['model'] for record in records if record['model'] not in log_evidences
+                          or best_log_evidence - log_evidences[record['model']] <= max_log_bayes_factor]
+    return competitive_models, log_evidences
+
+def promote_triaged_objects(settings, models, backend):
+    '''
+    submits the full fits of the competitive models of every object whose triage fits have all finished, marking its
+    triage fits as promoted so this is done once
+
+    The tracker is reloaded after submitting, as the backend records the new fits itself (e.g. as queued by the fit
+    queue, see utils.fit_queue), and only the promoted flags are written to it.
+
+    Args:
+        settings (dict): dictionary of settings from settings.json
+        models (dict): dictionary of models from settings.json
+        backend (SlurmBackend, LocalBackend or FitQueue): execution backend
+
+    Returns:
+        tracker (dict): updated tracker, including the new submissions
+    '''
+    tracker = load_fit_states(settings)
+    object_records = {}
+    for record in tracker['fits'].values():
+        object_records.setdefault(record['object'], []).append(record)
+
+    promoted, num_promoted = {}, 0 ## fit key -> job id of the promoted triage fits
+    for object, records in sorted(object_records.items()):
+        triage_records = [record for record in records if record.get('stage') == TRIAGE and not record.get('promoted', False)]
+        if len(triage_records) == 0 or not all(record['state'] in TERMINAL_STATES for record in records):
+            continue
+        competitive_models, log_evidences = get_competitive_models(triage_records, settings)
+        print('[{}] Triage of {}: log evidences {}, fitting {} in full'.format(current_time(), object,
+              ', '.join('{} {:.2f}'.format(model, log_evidence) for model, log_evidence in sorted(log_evidences.items())),
+              ', '.join(competitive_models) if len(competitive_models) > 0 else 'no models'))
+        for record in triage_records:
+            promoted[fit_key(record['object'], record['model'])] = record.get('job_id')
+        for model in competitive_models:
+            if model in models:
+                backend.submit([records[0]['data']], models[model])
+                num_promoted += 1
+    if len(promoted) == 0:
+        return tracker
+
+    tracker = load_fit_states(settings)
+    ingest_submissions(settings, tracker)
+    for key, job_id in promoted.items(): ## triage fits not replaced by their full fit
+        record = tracker['fits'].get(key)
+        if record is not None and record.get('stage') == TRIAGE and record.get('job_id') == job_id:
+            record['promoted'] = True
+    save_fit_states(settings, tracker)
+    if num_promoted > 0:
+        print('[{}] Submitted {} full fits after triage'.format(current_time(), num_promoted))
+    return tracker
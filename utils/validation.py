@@ -0,0 +1,175 @@
+'''
+pre-fit validation of candidate lightcurves, so malformed files are caught by the scanner rather than by a fit that
+fails hours into its allocation
+
+Each lightcurve is parsed once and checked on its column arrays: schema (parsable, finite times and magnitudes,
+non-negative uncertainties), filter set, time ordering and duplicates, detections per filter, and whether the tmin/tmax
+window of each model contains enough detections. Files that fail are copied to a quarantine directory together with a
+json report of the failed checks.
+'''
+import os
+import json
+import time
+import shutil
+
+import numpy as np
+
+from utils.tools import current_time
+from utils.files import get_state_path
+from utils.conversion import load_lightcurve, detect_format
+
+NMMA_FILTERS = ['u', 'g', 'r', 'i', 'z', 'y', 'J', 'H', 'K']
+
+
+def get_validation_settings(settings):
+    '''
+    retrieve the validation settings (settings['validation']) with defaults filled in
+    '''
+    validation_settings = {'filters':NMMA_FILTERS, 'min_detections':2, 'min_detections_per_filter':1, 'quarantine_directory':None}
+    validation_settings.update((settings or {}).get('validation', {}))
+    return validation_settings
+
+def get_window_reference(mjd, detected, settings):
+    '''
+    retrieve the time the tmin/tmax window of the fits is relative to, mirroring fitting.trigger_time (None if the
+    trigger time is set manually in settings.json, in which case the window is not checked)
+    '''
+    settings = settings or {}
+    if settings.get('fit_trigger_time', True):
+        return mjd[detected].min()
+    elif settings.get('trigger_time_heuristic', False):
+        return mjd[detected].min() - 1
+    return None
+
+def validate_lightcurve(lc_path, models=None, settings=None):
+    '''
+    checks a lightcurve before it is fit
+
+    Args:
+        lc_path (str): path to lightcurve file
+        models (dict): dictionary of models from settings.json, used to check the tmin/tmax windows (default: None, not checked)
+        settings (dict): dictionary of settings from settings.json (default: None, default thresholds)
+
+    Returns:
+        report (dict): dictionary with keys object, file, format, valid (bool), errors and warnings (lists of
+            {'check', 'message'}), num_points, num_detections and detections_per_filter
+    '''
+    validation_settings = get_validation_settings(settings)
+    report = {'object':os.path.basename(lc_path).split('.')[0], 'file':os.path.abspath(lc_path), 'format':None,
+              'valid':False, 'errors':[], 'warnings':[], 'num_points':0, 'num_detections':0, 'detections_per_filter':{}}
+    error = lambda check, message: report['errors'].append({'check':check, 'message':message})
+    warning = lambda check, message: report['warnings'].append({'check':check, 'message':message})
+
+    try:
+        report['format'] = detect_format(lc_path)
+        lightcurve = load_lightcurve(lc_path)
+    except (ValueError, KeyError, AssertionError, TypeError, IndexError) as e: ## unrecognised format, missing columns, unparsable values
+        error('schema', '{}: {}'.format(type(e).__name__, e))
+        return report
+
+    mjd, filter, mag, mag_unc = lightcurve.mjd, lightcurve.filter, lightcurve.mag, lightcurve.mag_unc
+    report['num_points'] = len(mjd)
+    if len(mjd) == 0:
+        error('schema', 'no photometry')
+        return report
+
+    ## schema: each condition evaluated on whole columns
+    bad_rows = ~np.isfinite(mjd) | ~np.isfinite(mag) | np.isnan(mag_unc) | (mag_unc < 0)
+    if bad_rows.any():
+        error('schema', '{} rows with missing or invalid time, mag or mag_unc (first at row {})'.format(bad_rows.sum(), np.argmax(bad_rows)))
+
+    ## filters
+    unique_filters = np.unique(filter)
+    unknown_filters = unique_filters[~np.isin(unique_filters, validation_settings['filters'])]
+    if len(unknown_filters) > 0:
+        error('filters', 'unknown filters {} (expected one of {})'.format(', '.join(unknown_filters), ','.join(validation_settings['filters'])))
+
+    ## time ordering and duplicates
+    if (np.diff(mjd) < 0).any():
+        warning('time_order', 'times are not in increasing order')
+    order = np.lexsort((filter, mjd))
+    same_point = (np.diff(mjd[order]) == 0) & (filter[order][1:] == filter[order][:-1])
+    if same_point.any():
+        conflicting = same_point & ((mag[order][1:] != mag[order][:-1]) | (mag_unc[order][1:] != mag_unc[order][:-1]))
+        if conflicting.any():
+            error('duplicates', '{} points share a time and filter with different magnitudes'.format(conflicting.sum()))
+        else:
+            warning('duplicates', '{} duplicated points'.format(same_point.sum()))
+
+    ## detections per filter
+    detected = np.isfinite(mag_unc) & ~bad_rows
+    detection_filters, detection_counts = np.unique(filter[detected], return_counts=True)
+    report['num_detections'] = int(detected.sum())
+    report['detections_per_filter'] = {str(name):int(count) for name, count in zip(detection_filters, detection_counts)}
+    if report['num_detections'] < validation_settings['min_detections']:
+        error('detections', '{} detections (at least {} needed)'.format(report['num_detections'], validation_settings['min_detections']))
+    sparse_filters = [str(name) for name in unique_filters if report['detections_per_filter'].get(str(name), 0) < validation_settings['min_detections_per_filter']]
+    if len(sparse_filters) > 0:
+        warning('detections', 'fewer than {} detections in filters {}'.format(validation_settings['min_detections_per_filter'], ', '.join(sparse_filters)))
+
+    ## tmin/tmax windows of the models
+    reference = get_window_reference(mjd, detected, settings) if detected.any() else None
+    if models is not None and reference is not None:
+        t = mjd[detected] - reference
+        empty_models = [model['name'] for model in models.values()
+                        if ((t >= model['tmin']) & (t <= model['tmax'])).sum() < validation_settings['min_detections']]
+        if len(empty_models) == len(models):
+            error('window', 'fewer than {} detections within the tmin/tmax window of every model'.format(validation_settings['min_detections']))
+        elif len(empty_models) > 0:
+            warning('window', 'fewer than {} detections within the tmin/tmax window of {}'.format(validation_settings['min_detections'], ', '.join(empty_models)))
+
+    report['valid'] = len(report['errors']) == 0
+    return report
+
+def get_quarantine_directory(settings):
+    '''
+    retrieve the quarantine directory (settings['validation']['quarantine_directory'], default: quarantine in the state directory)
+    '''
+    return get_validation_settings(settings)['quarantine_directory'] or get_state_path(settings, 'quarantine')
+
+def quarantine_lightcurve(lc_path, report, settings):
+    '''
+    copies a lightcurve that failed validation to the quarantine directory and writes its report next to it as
+    <object>.report.json (the candidate itself is left in place, as it is tracked by git, and is checked again once it changes)
+
+    Args:
+        lc_path (str): path to lightcurve file
+        report (dict): report returned by validate_lightcurve
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        report_path (str): path to the report
+    '''
+    quarantine_directory = get_quarantine_directory(settings)
+    os.makedirs(quarantine_directory, exist_ok=True)
+    shutil.copyfile(lc_path, os.path.join(quarantine_directory, os.path.basename(lc_path)))
+    report_path = os.path.join(quarantine_directory, report['object'] + '.report.json')
+    tmp_path = report_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(report, quarantined=time.time()), f, indent=1)
+    os.replace(tmp_path, report_path)
+    return report_path
+
+def validate_objects(object_paths, models, settings):
+    '''
+    validates new candidates, quarantining the ones that fail
+
+    Args:
+        object_paths (list): paths to lightcurve files
+        models (dict): dictionary of models from settings.json
+        settings (dict): dictionary of settings from settings.json
+
+    Returns:
+        valid_paths (list): paths to the lightcurves that passed validation
+    '''
+    valid_paths = []
+    for lc_path in object_paths:
+        report = validate_lightcurve(lc_path, models=models, settings=settings)
+        for check in report['warnings']:
+            print('[{}] {}: {} ({})'.format(current_time(), report['object'], check['message'], check['check']))
+        if report['valid']:
+            valid_paths.append(lc_path)
+            continue
+        report_path = quarantine_lightcurve(lc_path, report, settings)
+        print('[{}] Quarantined {}: {} (see {})'.format(current_time(), report['object'], '; '.join(check['message'] for check in report['errors']), report_path))
+    return valid_paths
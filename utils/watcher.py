@@ -0,0 +1,162 @@
+'''
+watches the candidate directory for new or modified lightcurves, using inotify where available and adaptive polling otherwise
+'''
+import os
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+
+from utils.tools import current_time
+
+## inotify event masks (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class InotifyWatcher:
+    '''
+    thin ctypes wrapper around the linux inotify api for a single directory
+
+    Args:
+        path (str): path to directory to watch
+
+    Raises:
+        OSError: if inotify is unavailable on this platform or the watch cannot be added
+    '''
+    def __init__(self, path):
+        libc_path = ctypes.util.find_library('c')
+        if libc_path is None:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        libc = ctypes.CDLL(libc_path, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for {}'.format(path))
+
+    def wait(self, timeout):
+        '''
+        blocks until an event arrives in the watched directory or the timeout expires
+
+        Args:
+            timeout (float): maximum time to wait in seconds
+
+        Returns:
+            boolean: True if any events were received, False on timeout
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536): ## drain all queued events
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    '''
+    polls a directory for changes in the names, sizes, or modification times of its files
+
+    Args:
+        path (str): path to directory to watch
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = {}
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            snapshot[entry.name] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def wait(self, timeout):
+        '''
+        sleeps for the timeout and then checks the directory for changes
+
+        Args:
+            timeout (float): time to wait before polling in seconds
+
+        Returns:
+            boolean: True if the directory changed since the last poll, False otherwise
+        '''
+        time.sleep(timeout)
+        snapshot = self.take_snapshot()
+        changed = snapshot != self.snapshot
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class DirectoryWatcher:
+    '''
+    watches a directory for changes and debounces them, using inotify where available and falling back to polling
+
+    Polling starts at min_interval and doubles (up to max_interval) each time nothing changes, resetting on activity.
+    Even with inotify the directory is rescanned every max_interval as a safety net (e.g. for network filesystems where
+    events from other hosts are not delivered).
+
+    Args:
+        path (str): path to directory to watch
+        min_interval (float): shortest polling interval in seconds (default: 2)
+        max_interval (float): longest polling interval in seconds (default: 60)
+        settle_time (float): time in seconds without further changes before a change is reported (default: 5)
+        use_inotify (bool): whether to try inotify before falling back to polling (default: True)
+    '''
+    def __init__(self, path, min_interval=2, max_interval=60, settle_time=5, use_inotify=True):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.settle_time = settle_time
+        self.interval = min_interval
+        self.watcher = None
+        if use_inotify:
+            try:
+                self.watcher = InotifyWatcher(path)
+                print('[{}] Watching {} with inotify'.format(current_time(), path))
+            except OSError as e:
+                print('[{}] inotify unavailable ({}), falling back to polling'.format(current_time(), e))
+        self.inotify = self.watcher is not None
+        if not self.inotify:
+            self.watcher = PollingWatcher(path)
+            print('[{}] Polling {} every {}-{} s'.format(current_time(), path, min_interval, max_interval))
+
+    def wait(self):
+        '''
+        blocks until the directory has changed and then stayed quiet for settle_time, or until the polling interval expires
+
+        Args:
+            None
+
+        Returns:
+            boolean: True if a (debounced) change was detected, False if the wait timed out without changes
+        '''
+        timeout = self.max_interval if self.inotify else self.interval
+        if not self.watcher.wait(timeout):
+            self.interval = min(self.interval * 2, self.max_interval)
+            return False
+        while self.watcher.wait(self.settle_time if self.inotify else max(self.settle_time, self.min_interval)):
+            pass ## keep waiting while files are still being written
+        self.interval = self.min_interval
+        return True
+
+    def close(self):
+        self.watcher.close()